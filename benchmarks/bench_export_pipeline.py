@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import glob
+import json
+import time
+import uuid
+import shutil
+import argparse
+import tempfile
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from tds import csv2json, dir_from_request_meta, timestamp_nc_file, find_request_nc_files, write_stream_ncml, write_queue_csv
+from tds.manifest import manifest_path, load_manifest, write_manifest, publish_files
+from tds.queue_store import QueueStore
+from tds.scan import scan_requests
+from fake_uframe import netcdf_payload
+
+_NCML_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2" id="{0}">
+  <aggregation dimName="obs" type="joinExisting">
+    <scan location="{1}" suffix=".nc" subdirs="false"/>
+  </aggregation>
+</netcdf>
+'''
+
+_QUEUE_COLUMNS = ['instrument',
+    'stream',
+    'telemetry',
+    'reason',
+    'requestUUID',
+    'request_url',
+    'tds_destination']
+
+def legacy_find_request_nc_files(product_dir, stream):
+    '''The listdir, isdir and glob per bin directory lookup that
+    tds.find_request_nc_files used before tds.scan, kept as the discovery
+    baseline'''
+
+    nc_files = []
+    for product_dir_item in os.listdir(product_dir):
+        bin_dir = os.path.join(product_dir, product_dir_item)
+        if not os.path.isdir(bin_dir):
+            continue
+        nc_files.extend(glob.glob(os.path.join(bin_dir, '*{:s}.nc'.format(stream))))
+
+    return nc_files
+
+def generate_tree(root, num_requests, bins, files, file_size):
+    '''Create a synthetic ASYNC_UFRAME_NC_ROOT/<user> tree containing num_requests
+    completed request directories, each with bins bin directories of files
+    NetCDF files for the requested stream plus one file for an unrequested
+    stream, and the matching queue csv file.  Returns the queue csv file'''
+
+    user_root = os.path.join(root, 'uframe_nc', '_nouser')
+    os.makedirs(user_root)
+
+    requests = []
+    for r in range(num_requests):
+        instrument = 'CP{:02d}SYNT-N{:04d}-01-SYNTHA{:03d}'.format(r % 99 + 1, r % 10 + 1, r)
+        stream = 'synthetic_stream_{:04d}'.format(r)
+        request_uuid = str(uuid.uuid4())
+        product_dir = os.path.join(user_root, request_uuid)
+        os.makedirs(product_dir)
+        with open(os.path.join(product_dir, 'status.txt'), 'w') as fid:
+            fid.write('complete')
+
+        for b in range(bins):
+            bin_dir = os.path.join(product_dir, 'bin{:04d}'.format(b))
+            os.mkdir(bin_dir)
+            for f in range(files):
+                day = datetime.datetime(2014, 1, 1) + datetime.timedelta(days=b * files + f)
+                attributes = {'time_coverage_start' : day.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                    'time_coverage_end' : (day + datetime.timedelta(hours=23)).strftime('%Y-%m-%dT%H:%M:%SZ')}
+                for s in [stream, 'unrequested_stream']:
+                    nc_file = os.path.join(bin_dir, 'deployment{:04d}_{:s}-telemetered-{:s}.nc'.format(b * files + f + 1, instrument, s))
+                    with open(nc_file, 'wb') as fid:
+                        fid.write(netcdf_payload(file_size, attributes))
+
+        requests.append({'instrument' : instrument,
+            'stream' : stream,
+            'telemetry' : 'telemetered',
+            'reason' : 'In process',
+            'requestUUID' : request_uuid,
+            'request_url' : 'http://localhost/sensor/inv/{:s}/telemetered/{:s}'.format(instrument.replace('-', '/', 2), stream),
+            'tds_destination' : ''})
+
+    queue_csv = os.path.join(root, 'synthetic-queue.csv')
+    with open(queue_csv, 'w') as fid:
+        write_queue_csv([dict([(c, q[c]) for c in _QUEUE_COLUMNS]) for q in requests], fid)
+
+    return queue_csv
+
+def run_pipeline(root, queue_csv, processes):
+    '''Run each export stage over every queued request and return the elapsed
+    time of each stage'''
+
+    timings = []
+    uframe_nc_root = os.path.join(root, 'uframe_nc', '_nouser')
+    tds_nc_root = os.path.join(root, 'tds_nc')
+    ncml_template = os.path.join(root, 'stream-agg-template.ncml')
+    with open(ncml_template, 'w') as fid:
+        fid.write(_NCML_TEMPLATE)
+
+    t0 = time.time()
+    stream_requests = csv2json(queue_csv)
+    timings.append(('load_queue', time.time() - t0))
+
+    # Baseline: status.txt read and legacy listdir/glob lookup per request
+    t0 = time.time()
+    request_files = []
+    for stream in stream_requests:
+        product_dir = os.path.join(uframe_nc_root, stream['requestUUID'])
+        with open(os.path.join(product_dir, 'status.txt'), 'r') as fid:
+            fid.readline()
+        request_files.append(legacy_find_request_nc_files(product_dir, stream['stream']))
+    timings.append(('discovery', time.time() - t0))
+
+    # One scandir pass (tds.scan.ProductIndex) per request
+    t0 = time.time()
+    for stream in stream_requests:
+        product_dir = os.path.join(uframe_nc_root, stream['requestUUID'])
+        with open(os.path.join(product_dir, 'status.txt'), 'r') as fid:
+            fid.readline()
+        find_request_nc_files(product_dir, stream['stream'])
+    timings.append(('scan_discovery', time.time() - t0))
+
+    # The same lookups served from one batched scan of every request, in one
+    # thread and in the default threads, which only pay off when each
+    # directory read waits on the network (NFS)
+    for (stage, threads) in [('batch_discovery', 1), ('threaded_discovery', 8)]:
+        t0 = time.time()
+        indexes = scan_requests(uframe_nc_root, [stream['requestUUID'] for stream in stream_requests], threads=threads)
+        for stream in stream_requests:
+            indexes[stream['requestUUID']].status()
+            indexes[stream['requestUUID']].nc_files(stream['stream'])
+        timings.append((stage, time.time() - t0))
+
+    t0 = time.time()
+    request_pairs = []
+    for (stream, nc_files) in zip(stream_requests, request_files):
+        stream_destination = os.path.join(tds_nc_root, dir_from_request_meta(stream))
+        pairs = [(nc_file, os.path.join(stream_destination, timestamp_nc_file(nc_file))) for nc_file in nc_files]
+        request_pairs.append((stream, stream_destination, pairs))
+    timings.append(('timestamp', time.time() - t0))
+
+    t0 = time.time()
+    for (stream, stream_destination, pairs) in request_pairs:
+        os.makedirs(stream_destination)
+        dataset_id = os.path.basename(stream_destination)
+        ncml_file = os.path.join(stream_destination, '{:s}.ncml'.format(dataset_id))
+        write_stream_ncml(ncml_template, ncml_file, dataset_id, stream_destination)
+    timings.append(('ncml', time.time() - t0))
+
+    # Publish twice: the first pass copies every file, the second finds every
+    # file unchanged in the stream manifests
+    for stage in ['copy', 'republish']:
+        t0 = time.time()
+        for (stream, stream_destination, pairs) in request_pairs:
+            stream_manifest_file = manifest_path(stream_destination)
+            stream_manifest = load_manifest(stream_manifest_file)
+            publish_files(pairs, stream_manifest, processes=processes)
+            write_manifest(stream_manifest, stream_manifest_file)
+            stream['reason'] = 'Complete'
+            stream['tds_destination'] = stream_destination
+        timings.append((stage, time.time() - t0))
+
+    # Copy the published streams to a new THREDDS root, as edit_tds_datasets.py
+    # --copy does
+    t0 = time.time()
+    for (stream, stream_destination, pairs) in request_pairs:
+        rel_path = dir_from_request_meta(stream)
+        new_location = os.path.join(root, 'tds_copy', rel_path)
+        os.makedirs(new_location)
+        f_contents = [os.path.join(stream_destination, f) for f in os.listdir(stream_destination)
+            if not f.endswith('.manifest.csv')]
+        dest_manifest = {}
+        publish_files([(f, os.path.join(new_location, os.path.basename(f))) for f in f_contents],
+            dest_manifest,
+            source_manifest=load_manifest(manifest_path(stream_destination)),
+            processes=processes)
+        write_manifest(dest_manifest, manifest_path(new_location))
+    timings.append(('edit_copy', time.time() - t0))
+
+    t0 = time.time()
+    os.remove(queue_csv)
+    with open(queue_csv, 'w') as fid:
+        write_queue_csv(stream_requests, fid)
+    timings.append(('queue_rewrite', time.time() - t0))
+
+    # Record the same status changes in the journaled queue store
+    store = QueueStore(os.path.join(root, 'queue.db'))
+    store.add(csv2json(queue_csv))
+    t0 = time.time()
+    for stream in stream_requests:
+        store.update(stream)
+    timings.append(('queue_store', time.time() - t0))
+    store.close()
+
+    return timings
+
+def main(args):
+    '''Benchmark the stages of the export_uframe_nc_to_tds-agg.py and
+    edit_tds_datasets.py pipeline (queue loading, NetCDF discovery with the
+    legacy listdir/glob lookup, per-request scans and batched scans, timestamping,
+    NCML writing, copying, re-publishing unchanged files, stream copies, queue
+    rewriting and queue store updates) on synthetic UFrame request trees at several scales.  Results are
+    printed as JSON lines and optionally appended to a results file.'''
+
+    run_time = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    results = []
+    for scale in [int(s) for s in args.scales.split(',')]:
+
+        root = tempfile.mkdtemp(prefix='bench_export_', dir=args.tmpdir)
+        try:
+            t0 = time.time()
+            queue_csv = generate_tree(root, scale, args.bins, args.files, args.file_size)
+            setup_time = time.time() - t0
+            timings = run_pipeline(root, queue_csv, args.processes)
+        finally:
+            shutil.rmtree(root)
+
+        for (stage, elapsed) in timings:
+            result = {'benchmark' : 'export_pipeline',
+                'run_time' : run_time,
+                'stage' : stage,
+                'requests' : scale,
+                'files' : scale * args.bins * args.files,
+                'elapsed' : round(elapsed, 6),
+                'per_request' : round(elapsed / scale, 6),
+                'setup' : round(setup_time, 3)}
+            results.append(result)
+            sys.stdout.write('{:s}\n'.format(json.dumps(result, sort_keys=True)))
+
+    if args.output:
+        with open(args.output, 'a') as fid:
+            for result in results:
+                fid.write('{:s}\n'.format(json.dumps(result, sort_keys=True)))
+
+    return 0
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('--scales',
+        default='10,100',
+        help='Comma-separated list of the number of queued requests to benchmark (10,100 is <default>)')
+    arg_parser.add_argument('--bins',
+        type=int,
+        default=2,
+        help='Number of bin directories per request (2 is <default>)')
+    arg_parser.add_argument('--files',
+        type=int,
+        default=3,
+        help='Number of NetCDF files per bin directory (3 is <default>)')
+    arg_parser.add_argument('--file-size',
+        dest='file_size',
+        type=int,
+        default=64 * 1024,
+        help='Size, in bytes, of each synthetic NetCDF file (64 KB is <default>)')
+    arg_parser.add_argument('-p', '--processes',
+        type=int,
+        default=4,
+        help='Number of files to hash in parallel when publishing (4 is <default>)')
+    arg_parser.add_argument('--tmpdir',
+        help='Directory in which to create the synthetic trees, e.g. on the file system being benchmarked')
+    arg_parser.add_argument('-o', '--output',
+        help='Append results, as JSON lines, to this file')
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import datetime
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Modules whose import dominates start up time
+HEAVY_MODULES = ['requests', 'dateutil', 'netCDF4', 'numpy']
+
+# (name, command line arguments after the python interpreter)
+COMMANDS = [('import_uframe', ['-c', 'import uframe']),
+    ('import_tds_export', ['-c', 'import tds.export']),
+    ('cli_help', [os.path.join(REPO_ROOT, 'uframe_tds.py'), '-h']),
+    ('cli_export_validate', [os.path.join(REPO_ROOT, 'uframe_tds.py'), 'export', '-v']),
+    ('cli_index_validate', [os.path.join(REPO_ROOT, 'uframe_tds.py'), 'index', '-v']),
+    ('cli_submit_validate', [os.path.join(REPO_ROOT, 'uframe_tds.py'), 'submit', '-v', os.devnull]),
+    ('export_script_validate', [os.path.join(REPO_ROOT, 'export_uframe_nc_to_tds-agg.py'), '-v'])]
+
+def setup_environment(root):
+    '''Create a minimal ASYNC_DATA_HOME, UFrame and THREDDS NetCDF tree under
+    root and return the environment in which to run the commands'''
+
+    for d in [os.path.join(root, 'catalogs'),
+        os.path.join(root, 'uframe', '_nouser'),
+        os.path.join(root, 'tds')]:
+        os.makedirs(d)
+    with open(os.path.join(root, 'catalogs', 'stream-agg-template.ncml'), 'w') as fid:
+        fid.write('<netcdf/>\n')
+
+    env = dict(os.environ)
+    env['ASYNC_DATA_HOME'] = root
+    env['ASYNC_UFRAME_NC_ROOT'] = os.path.join(root, 'uframe')
+    env['ASYNC_TDS_NC_ROOT'] = os.path.join(root, 'tds')
+    env['PYTHONPATH'] = os.pathsep.join([p for p in [REPO_ROOT, env.get('PYTHONPATH')] if p])
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+
+    return env
+
+def heavy_modules_loaded(module, env):
+    '''Return the HEAVY_MODULES loaded by importing module'''
+
+    code = 'import sys, {:s}; sys.stdout.write(" ".join([m for m in {:s} if m in sys.modules]))'.format(module, repr(HEAVY_MODULES))
+    output = subprocess.check_output([sys.executable, '-c', code], env=env)
+
+    return output.decode('utf-8').split()
+
+def time_command(command_args, env, repeat):
+    '''Run the command repeat times and return the wall time of each run'''
+
+    elapsed = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeat):
+            t0 = time.time()
+            status = subprocess.call([sys.executable] + command_args, env=env, stdout=devnull, stderr=devnull)
+            elapsed.append(time.time() - t0)
+            if status:
+                sys.stderr.write('Command failed ({:d}): {:s}\n'.format(status, ' '.join(command_args)))
+                return None
+
+    return elapsed
+
+def main(args):
+    '''Time the start up of the package imports and of uframe_tds.py and the
+    export script with -v, the cost paid by every cron invocation, by running
+    each in a fresh interpreter --repeat times.  The minimum and median wall
+    times, and the heavy modules (requests, dateutil, netCDF4, numpy) loaded by
+    the package imports, are written as JSON lines'''
+
+    run_time = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    results = []
+
+    root = tempfile.mkdtemp(prefix='bench_startup_')
+    try:
+        env = setup_environment(root)
+        for (name, command_args) in COMMANDS:
+            elapsed = time_command(command_args, env, args.repeat)
+            if not elapsed:
+                continue
+            elapsed = sorted(elapsed)
+            result = {'benchmark' : 'startup',
+                'run_time' : run_time,
+                'command' : name,
+                'repeat' : args.repeat,
+                'min' : round(elapsed[0], 6),
+                'median' : round(elapsed[len(elapsed) // 2], 6)}
+            if command_args[0] == '-c':
+                result['heavy_modules'] = heavy_modules_loaded(command_args[1].split()[-1], env)
+            results.append(result)
+            sys.stdout.write('{:s}\n'.format(json.dumps(result, sort_keys=True)))
+    finally:
+        shutil.rmtree(root)
+
+    if args.output:
+        with open(args.output, 'a') as fid:
+            for result in results:
+                fid.write('{:s}\n'.format(json.dumps(result, sort_keys=True)))
+
+    return 0
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('-r', '--repeat',
+        type=int,
+        default=10,
+        help='Number of runs of each command (10 is <default>)')
+    arg_parser.add_argument('-o', '--output',
+        help='Append results, as JSON lines, to this file')
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from uframe import UFrame, get_uframe_array, fetch_uframe_time_bound_stream, send_async_request
+from tds import build_async_query_from_stream_meta
+from fake_uframe import start_server, subsite_names, stream_names
+
+def percentile(values, p):
+
+    if not values:
+        return None
+
+    values = sorted(values)
+    i = int(round((len(values) - 1) * p / 100.0))
+
+    return values[i]
+
+def summarize(name, elapsed, records, count):
+    '''Reduce the telemetry records for one benchmark to throughput and latency
+    statistics'''
+
+    ttfb = [r['ttfb'] for r in records if r['ttfb'] is not None]
+    nbytes = sum([r['bytes'] for r in records])
+
+    return {'benchmark' : name,
+        'requests' : count,
+        'elapsed' : round(elapsed, 6),
+        'requests_per_sec' : round(count / elapsed, 2) if elapsed else None,
+        'mb_per_sec' : round(nbytes / elapsed / 1e6, 2) if elapsed else None,
+        'ttfb_p50' : percentile(ttfb, 50),
+        'ttfb_p95' : percentile(ttfb, 95),
+        'errors' : len([r for r in records if r['code'] != 200])}
+
+def read_records(log_file):
+
+    if not os.path.exists(log_file):
+        return []
+
+    with open(log_file, 'r') as fid:
+        records = [json.loads(line) for line in fid if line.strip()]
+
+    os.remove(log_file)
+
+    return records
+
+def bench_crawl(uframe_base, config, log_file):
+    '''Crawl the entire synthetic inventory with get_uframe_array, generating
+    urls only'''
+
+    t0 = time.time()
+    urls = []
+    for subsite in subsite_names(config):
+        urls.extend(get_uframe_array(subsite, urlonly=True, uframe_base=uframe_base) or [])
+    elapsed = time.time() - t0
+
+    records = read_records(log_file)
+
+    result = summarize('crawl', elapsed, records, len(records))
+    result['cache'] = uframe_base.cache.stats()
+
+    return result
+
+def bench_download(uframe_base, config, log_file, out_dir, count, unzip=True, json_to_nc=False):
+    '''Download count synthetic NetCDF or zip payloads with
+    fetch_uframe_time_bound_stream, extracting zip payloads while downloading
+    unless unzip is False.  If json_to_nc is True, JSON payloads are downloaded
+    instead and decoded into NetCDF files while downloading'''
+
+    subsite = subsite_names(config)[0]
+    stream = stream_names(config)[0]
+
+    # fetch_uframe_time_bound_stream writes progress to stdout
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    t0 = time.time()
+    try:
+        for i in range(count):
+            fetch_uframe_time_bound_stream(uframe_base=uframe_base,
+                subsite=subsite,
+                node='N0001',
+                sensor='01-SYNTHA001',
+                method='telemetered',
+                stream=stream,
+                begin_datetime='2016-01-{:02d}T00:00:00.000Z'.format(i % 28 + 1),
+                end_datetime='2016-01-{:02d}T23:59:59.000Z'.format(i % 28 + 1),
+                file_format='json' if json_to_nc else 'netcdf',
+                exec_dpa=True,
+                urlonly=False,
+                dest_dir=out_dir,
+                provenance=False,
+                limit='-1',
+                unzip=unzip,
+                json_to_nc=json_to_nc)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    elapsed = time.time() - t0
+
+    records = read_records(log_file)
+
+    return summarize('download', elapsed, records, count)
+
+def bench_async_submit(uframe_base, config, log_file, count):
+    '''Build count asynchronous request urls and submit them'''
+
+    streams = []
+    for i in range(count):
+        streams.append({'sensor' : '{:s}-N0001-01-SYNTHA001'.format(subsite_names(config)[0]),
+            'method' : 'telemetered',
+            'stream' : stream_names(config)[i % config['streams']],
+            'beginTime' : '2014-04-17T18:00:00.000Z',
+            'endTime' : '2016-01-01T12:30:00.000Z'})
+
+    t0 = time.time()
+    async_urls = build_async_query_from_stream_meta(uframe_base, streams, user='benchmark')
+    for url in async_urls:
+        # Errors are reported by send_async_request
+        send_async_request(url, uframe_base)
+    elapsed = time.time() - t0
+
+    records = read_records(log_file)
+
+    return summarize('async_submit', elapsed, records, len(async_urls))
+
+def compare(results, baseline_file):
+    '''Print each result relative to the most recent matching baseline record'''
+
+    baselines = {}
+    with open(baseline_file, 'r') as fid:
+        for line in fid:
+            if line.strip():
+                record = json.loads(line)
+                baselines[record['benchmark']] = record
+
+    for result in results:
+        baseline = baselines.get(result['benchmark'])
+        if not baseline or not baseline['requests_per_sec']:
+            continue
+        ratio = result['requests_per_sec'] / baseline['requests_per_sec']
+        sys.stdout.write('{:s}: {:.2f}x baseline requests/sec\n'.format(result['benchmark'], ratio))
+
+def main(args):
+    '''Benchmark uFrame inventory crawls, data downloads and asynchronous request
+    submission against a local fake uFrame server serving a synthetic inventory.
+    Results are printed as JSON lines and optionally appended to a results file
+    for regression tracking.'''
+
+    config = {'subsites' : args.subsites,
+        'nodes' : args.nodes,
+        'sensors' : args.sensors,
+        'streams' : args.streams,
+        'payload_size' : args.payload_size,
+        'zip' : args.zip,
+        'inventory_latency' : args.inventory_latency / 1000.0,
+        'data_latency' : args.data_latency / 1000.0}
+    server = start_server(**config)
+    config = server.config
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench_uframe_')
+    log_file = os.path.join(tmp_dir, 'requests.jsonl')
+    uframe_base = UFrame(base_url='http://127.0.0.1', port=server.server_address[1], request_log=log_file)
+
+    results = []
+    try:
+        results.append(bench_crawl(uframe_base, config, log_file))
+        results.append(bench_download(uframe_base, config, log_file, os.path.join(tmp_dir, 'nc'), args.downloads, unzip=not args.no_unzip, json_to_nc=args.json_to_nc))
+        results.append(bench_async_submit(uframe_base, config, log_file, args.submits))
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp_dir)
+
+    run_time = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    for result in results:
+        result['run_time'] = run_time
+        result['config'] = config
+        result['unzip'] = not args.no_unzip
+        result['json_to_nc'] = args.json_to_nc
+        sys.stdout.write('{:s}\n'.format(json.dumps(result, sort_keys=True)))
+
+    if args.baseline and os.path.exists(args.baseline):
+        compare(results, args.baseline)
+
+    if args.output:
+        with open(args.output, 'a') as fid:
+            for result in results:
+                fid.write('{:s}\n'.format(json.dumps(result, sort_keys=True)))
+
+    return 0
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('--subsites',
+        type=int,
+        default=2,
+        help='Number of synthetic subsites (2 is <default>)')
+    arg_parser.add_argument('--nodes',
+        type=int,
+        default=3,
+        help='Number of nodes per subsite (3 is <default>)')
+    arg_parser.add_argument('--sensors',
+        type=int,
+        default=4,
+        help='Number of sensors per node (4 is <default>)')
+    arg_parser.add_argument('--streams',
+        type=int,
+        default=2,
+        help='Number of streams per sensor (2 is <default>)')
+    arg_parser.add_argument('--payload-size',
+        dest='payload_size',
+        type=int,
+        default=1024 * 1024,
+        help='Size, in bytes, of each synthetic data response (1 MB is <default>)')
+    arg_parser.add_argument('--zip',
+        action='store_true',
+        help='Serve data responses as zip archives of NetCDF files')
+    arg_parser.add_argument('--no-unzip',
+        dest='no_unzip',
+        action='store_true',
+        help='Write zip data responses to disk instead of extracting them while downloading')
+    arg_parser.add_argument('--json-to-nc',
+        dest='json_to_nc',
+        action='store_true',
+        help='Download JSON data responses and decode them into NetCDF files while downloading')
+    arg_parser.add_argument('--inventory-latency',
+        dest='inventory_latency',
+        type=float,
+        default=0.0,
+        help='Milliseconds of latency added to each inventory request')
+    arg_parser.add_argument('--data-latency',
+        dest='data_latency',
+        type=float,
+        default=0.0,
+        help='Milliseconds of latency added to each data request')
+    arg_parser.add_argument('--downloads',
+        type=int,
+        default=20,
+        help='Number of data responses to download (20 is <default>)')
+    arg_parser.add_argument('--submits',
+        type=int,
+        default=50,
+        help='Number of asynchronous requests to submit (50 is <default>)')
+    arg_parser.add_argument('-o', '--output',
+        help='Append results, as JSON lines, to this file')
+    arg_parser.add_argument('-b', '--baseline',
+        help='Results file to compare this run against')
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))
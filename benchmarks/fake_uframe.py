@@ -0,0 +1,234 @@
+"""
+Local HTTP stand-in for a uFrame server, for benchmarking the uframe client.
+
+Serves a synthetic /sensor/inv tree (subsites, nodes, sensors and metadata
+documents) of configurable size along with synthetic NetCDF, zip or JSON
+payloads of configurable size.  Requests containing a user= query parameter are treated as
+asynchronous requests and answered with a JSON document containing a
+requestUUID.  Latency can be injected separately for inventory and data
+requests.
+"""
+
+import io
+import json
+import time
+import uuid
+import struct
+import zipfile
+import threading
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+DEFAULT_CONFIG = {'arrays' : ['CP'],
+    'subsites' : 2,
+    'nodes' : 3,
+    'sensors' : 4,
+    'streams' : 2,
+    'parameters' : 20,
+    'payload_size' : 1024 * 1024,
+    'zip' : False,
+    'zip_members' : 2,
+    'inventory_latency' : 0.0,
+    'data_latency' : 0.0}
+
+def subsite_names(config):
+    return ['{:s}{:02d}SYNT'.format(a, i + 1) for a in config['arrays'] for i in range(config['subsites'])]
+
+def node_names(config):
+    return ['N{:04d}'.format(i + 1) for i in range(config['nodes'])]
+
+def sensor_names(config):
+    return ['{:02d}-SYNTHA{:03d}'.format(i + 1, i + 1) for i in range(config['sensors'])]
+
+def stream_names(config):
+    return ['synthetic_stream_{:02d}'.format(i + 1) for i in range(config['streams'])]
+
+def sensor_metadata(config):
+    '''Metadata document for a synthetic sensor, in the format returned by the
+    uFrame /metadata endpoint'''
+
+    times = []
+    parameters = []
+    for (i, stream) in enumerate(stream_names(config)):
+        for method in ['telemetered', 'recovered_host']:
+            times.append({'stream' : stream,
+                'method' : method,
+                'beginTime' : '2014-04-17T18:00:00.000Z',
+                'endTime' : '2016-0{:d}-01T12:30:00.000Z'.format(i % 9 + 1),
+                'count' : 1000})
+        for p in range(config['parameters']):
+            parameters.append({'particleKey' : '{:s}_param_{:03d}'.format(stream, p),
+                'pdId' : 'PD{:d}'.format(1000 * (i + 1) + p),
+                'stream' : stream,
+                'type' : 'FLOAT',
+                'unit' : '1'})
+
+    return {'times' : times, 'parameters' : parameters}
+
+def netcdf_payload(size, attributes=None):
+    '''Return a valid classic (CDF-1) NetCDF file of approximately size bytes
+    containing a single byte variable, data(obs), and the optional string
+    global attributes'''
+
+    def name(s):
+        s = s.encode('ascii')
+        return struct.pack('>i', len(s)) + s + b'\x00' * (-len(s) % 4)
+
+    def header(n, begin):
+        h = b'CDF\x01' + struct.pack('>i', 0)
+        # dim_list: NC_DIMENSION, 1 dimension
+        h += struct.pack('>ii', 0x0A, 1) + name('obs') + struct.pack('>i', n)
+        # gatt_list: NC_ATTRIBUTE of NC_CHAR values, or ABSENT
+        if attributes:
+            h += struct.pack('>ii', 0x0C, len(attributes))
+            for k in sorted(attributes.keys()):
+                h += name(k) + struct.pack('>i', 2) + name(attributes[k])
+        else:
+            h += struct.pack('>ii', 0, 0)
+        # var_list: NC_VARIABLE, 1 variable of type NC_BYTE
+        h += struct.pack('>ii', 0x0B, 1) + name('data') + struct.pack('>ii', 1, 0)
+        h += struct.pack('>ii', 0, 0) + struct.pack('>iii', 1, n + (-n % 4), begin)
+        return h
+
+    header_size = len(header(0, 0))
+    n = max(size - header_size, 4)
+
+    return header(n, header_size) + b'\x00' * (n + (-n % 4))
+
+def json_payload(size, config):
+    '''Return a JSON array of particles, in the format returned by uFrame for
+    format=application/json, totalling approximately size bytes'''
+
+    stream = stream_names(config)[0]
+    particle = {'pk' : {'subsite' : subsite_names(config)[0],
+            'node' : 'N0001',
+            'sensor' : '01-SYNTHA001',
+            'method' : 'telemetered',
+            'stream' : stream,
+            'deployment' : 1,
+            'time' : 0.0},
+        'time' : 0.0,
+        'preferred_timestamp' : 'port_timestamp',
+        'provenance' : str(uuid.UUID(int=0))}
+    for p in range(config['parameters']):
+        particle['{:s}_param_{:03d}'.format(stream, p)] = p + 0.5
+    n = max(size // len(json.dumps(particle)), 1)
+
+    particles = []
+    for i in range(n):
+        particle['time'] = particle['pk']['time'] = 3.6e9 + i
+        particles.append(json.dumps(particle))
+
+    return '[{:s}]'.format(','.join(particles)).encode('utf-8')
+
+def zip_payload(size, members, stream):
+    '''Return a zip archive containing members NetCDF files totalling
+    approximately size bytes'''
+
+    buf = io.BytesIO()
+    archive = zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED)
+    for m in range(members):
+        archive.writestr('deployment{:04d}_{:s}.nc'.format(m + 1, stream), netcdf_payload(size // members))
+    archive.close()
+
+    return buf.getvalue()
+
+class FakeUFrameHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Avoid delayed-ACK stalls between the header and body writes
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type, headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for (k, v) in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, obj):
+        self.send_body(json.dumps(obj).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+
+        config = self.server.config
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        tokens = [t for t in url.path.split('/') if t]
+        if tokens[:2] != ['sensor', 'inv']:
+            self.send_error(404)
+            return
+        tokens = tokens[2:]
+
+        with self.server.lock:
+            self.server.requests += 1
+
+        if len(tokens) <= 3 or tokens[-1] == 'metadata':
+            time.sleep(config['inventory_latency'])
+        else:
+            time.sleep(config['data_latency'])
+
+        if not tokens:
+            self.send_json(subsite_names(config))
+        elif len(tokens) == 1:
+            self.send_json(node_names(config))
+        elif len(tokens) == 2:
+            self.send_json(sensor_names(config))
+        elif len(tokens) == 4 and tokens[3] == 'metadata':
+            self.send_json(sensor_metadata(config))
+        elif len(tokens) == 5:
+            if 'user' in query:
+                self.send_json({'requestUUID' : str(uuid.uuid4()),
+                    'outputURL' : 'http://localhost/async_results/{:s}'.format(query['user'][0])})
+            elif config['zip']:
+                self.send_body(self.server.zip_body,
+                    'application/octet-stream',
+                    {'Content-Disposition' : 'attachment; filename="{:s}.zip"'.format(tokens[4])})
+            elif query.get('format', [''])[0] == 'application/json':
+                self.send_body(self.server.json_body, 'application/json')
+            else:
+                self.send_body(self.server.nc_body, 'application/netcdf')
+        else:
+            self.send_error(404)
+
+class FakeUFrameServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, server_address, config):
+        HTTPServer.__init__(self, server_address, FakeUFrameHandler)
+        self.config = config
+        self.lock = threading.Lock()
+        self.requests = 0
+        # Payloads are built once so that the benchmark measures transfer, not
+        # payload generation
+        self.nc_body = netcdf_payload(config['payload_size'])
+        self.zip_body = zip_payload(config['payload_size'], config['zip_members'], 'synthetic')
+        self.json_body = json_payload(config['payload_size'], config)
+
+def start_server(port=0, **kwargs):
+    '''Start a fake uFrame server on localhost in a background thread.  Keyword
+    arguments override DEFAULT_CONFIG.  Returns the server instance; the port
+    is available as server.server_address[1]'''
+
+    config = dict(DEFAULT_CONFIG)
+    config.update(kwargs)
+
+    server = FakeUFrameServer(('127.0.0.1', port), config)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
@@ -6,13 +6,20 @@ import argparse
 import csv
 import glob
 import shutil
+from tds.manifest import MANIFEST_SUFFIX, manifest_path, load_manifest, write_manifest, publish_files, update_manifest, verify_manifest
+from tds.volumes import VolumeSet, invalid_roots, split_roots, rewrite_ncml
+from tds.lease import LeaseDir
+from tds.export import lease_key
+from tds.queue_store import DEFAULT_STORE
+from tds.timing import stage, add_profile_arguments, run_profiled
 
 def main(args):
     '''Parses CSV_FILE for records containing a reference designator, telemetry type
     and stream name.  Each record is used to create and validate a THREDDS stream location
     (.ncml and .nc files) and the list of files is printed to STDOUT.  Additional
     options are available to copy, move or delete the found files and resulting
-    degenerate directory tree.'''
+    degenerate directory tree, or to move streams to another THREDDS root when
+    ASYNC_TDS_NC_ROOT is a list of roots.'''
     
     _OOI_ARRAYS = {'CP' : 'Coastal_Pioneer',
         'CE' : 'Coastal_Endurance',
@@ -40,11 +47,28 @@ def main(args):
             sys.stderr.flush()
             return 1
         
-    if not os.path.exists(TDS_NC_ROOT):
-        sys.stderr.write('ASYNC_TDS_NC_ROOT is invalid: {:s}\n'.format(TDS_NC_ROOT))
+    if invalid_roots(TDS_NC_ROOT):
+        sys.stderr.write('ASYNC_TDS_NC_ROOT is invalid: {:s}\n'.format(', '.join(invalid_roots(TDS_NC_ROOT))))
         sys.stderr.flush()
         return 1
     
+    # Streams are rebalanced only between the roots of ASYNC_TDS_NC_ROOT
+    if args.volume and os.path.normpath(args.volume) not in split_roots(TDS_NC_ROOT):
+        sys.stderr.write('Destination volume is not an ASYNC_TDS_NC_ROOT root: {:s}\n'.format(args.volume))
+        return status
+    
+    # Streams are moved under the export lease of their stream destination, so
+    # that no export publishes into a stream while it is being moved
+    leases = None
+    if args.volume:
+        lease_root = args.leases
+        if not lease_root and os.getenv('ASYNC_DATA_HOME'):
+            lease_root = os.path.join(os.getenv('ASYNC_DATA_HOME'), os.path.dirname(DEFAULT_STORE), 'leases')
+        if not lease_root:
+            sys.stderr.write('No lease directory: set ASYNC_DATA_HOME or specify --leases\n')
+            return status
+        leases = LeaseDir(lease_root)
+    
     # If move or copy was specified, check args.location to ensure it is valid
     location = args.location
     if args.move or args.copy:
@@ -57,7 +81,8 @@ def main(args):
                 
     csv_file = args.csv_file
     # convert the csv file rows to a dictionary
-    streams = csv2json(csv_file)
+    with stage('load_csv'):
+        streams = csv2json(csv_file)
     if not streams:
         sys.stderr.write('No streams parsed from csv file: {:s}\n'.format(csv_file))
         return status
@@ -67,6 +92,12 @@ def main(args):
         sys.stderr.write('Invalid csv file format\n')
         return status
         
+    # Stream directories moved or deleted, whose catalogs are updated
+    edited_dirs = []
+    
+    # Index of the stream directories on the ASYNC_TDS_NC_ROOT roots
+    volumes = VolumeSet(TDS_NC_ROOT)
+    
     # The rest of the rows are datasets
     for stream in streams:
         
@@ -86,20 +117,54 @@ def main(args):
             stream['stream'],
             stream['telemetry'])
             
-        tds_path = os.path.join(TDS_NC_ROOT, rel_path)
-        
-        if not os.path.exists(tds_path):
-            sys.stderr.write('Invalid THREDDS stream location: {:s}\n'.format(tds_path))
+        tds_root = volumes.locate(rel_path)
+        if not tds_root:
+            sys.stderr.write('Invalid THREDDS stream location: {:s}\n'.format(rel_path))
             continue
+        tds_path = os.path.join(tds_root, rel_path)
         
         sys.stdout.write('Valid THREDDS stream location: {:s}\n'.format(tds_path))
           
         # Get the list of .ncml and .nc files in tds_path
-        f_contents = glob.glob(os.path.join(tds_path, '*.*'))
+        with stage('scan'):
+            f_contents = glob.glob(os.path.join(tds_path, '*.*'))
         if not f_contents:
             sys.stderr.write('No files found: {:s}\n'.format(tds_path))
             continue
             
+        if args.verify:
+            # Bring the manifest up to date, then check the archived files
+            # against it
+            if not os.path.exists(manifest_path(tds_path)):
+                sys.stdout.write('Creating stream manifest: {:s}\n'.format(manifest_path(tds_path)))
+                with stage('verify'):
+                    update_manifest(tds_path, processes=args.processes)
+                continue
+            with stage('verify'):
+                problems = verify_manifest(tds_path, full=args.full, processes=args.processes)
+            for (filename, problem) in problems:
+                sys.stderr.write('Manifest mismatch ({:s}): {:s}\n'.format(problem, os.path.join(tds_path, filename)))
+            if not problems:
+                sys.stdout.write('Stream matches manifest: {:s}\n'.format(tds_path))
+            continue
+            
+        if args.volume:
+            # Move the stream to another root, rewriting its NCML aggregation
+            # file to scan the new location
+            lease = leases.acquire(lease_key({'instrument' : stream['reference designator'],
+                'stream' : stream['stream'],
+                'telemetry' : stream['telemetry']}))
+            if not lease:
+                sys.stderr.write('Stream is being exported, not moved: {:s}\n'.format(tds_path))
+                continue
+            with lease:
+                with stage('move'):
+                    new_location = volumes.move_stream(rel_path, args.volume)
+            if new_location and new_location != tds_path:
+                sys.stdout.write('Moved THREDDS stream to {:s}\n'.format(new_location))
+                edited_dirs.extend([tds_path, new_location])
+            continue
+            
         if not args.delete and not args.copy and not args.move:
             sys.stdout.write('No file operations will be performed\n')
             # Print the list of files found, then skip since we're not operating on
@@ -127,18 +192,27 @@ def main(args):
                     sys.stderr.write('{:s}: {:s}\n'.format(e.strerror, new_location))
                     continue
                     
-            for f in f_contents:
-                # Copy the file only if it doesn't already exist
-                dest_nc = os.path.join(new_location, os.path.basename(f))
-                if os.path.exists(dest_nc):
-                    sys.stderr.write('Destination file already exists: {:s}\n'.format(dest_nc))
-                    continue
-                try:
-                    sys.stdout.write('Copying {:s}: {:s}\n'.format(os.path.basename(f), new_location))
-                    shutil.copy(f, new_location)
-                except IOError as e:
-                    sys.stderr.write('{:s}: {:s}\n'.format(e.strerror, f))
-                    continue
+            # Copy only the files whose contents differ from those already at
+            # the destination, using the source and destination manifests to
+            # avoid re-reading unchanged files
+            source_manifest = load_manifest(manifest_path(tds_path))
+            dest_manifest_file = manifest_path(new_location)
+            dest_manifest = load_manifest(dest_manifest_file)
+            copy_pairs = [(f, os.path.join(new_location, os.path.basename(f))) for f in f_contents
+                if not f.endswith(MANIFEST_SUFFIX)]
+            with stage('copy'):
+                copied = publish_files(copy_pairs,
+                    dest_manifest,
+                    source_manifest=source_manifest,
+                    processes=args.processes)
+            for (f, dest_nc, action) in copied:
+                if action == 'skipped':
+                    sys.stdout.write('Destination file is identical: {:s}\n'.format(dest_nc))
+                elif action == 'failed':
+                    sys.stderr.write('Failed to copy {:s}: {:s}\n'.format(os.path.basename(f), new_location))
+                else:
+                    sys.stdout.write('Copying {:s}: {:s} ({:s})\n'.format(os.path.basename(f), new_location, action))
+            write_manifest(dest_manifest, dest_manifest_file)
                 
         elif args.move:
             sys.stdout.write('Moving THREDDS stream to {:s}\n'.format(location))
@@ -160,7 +234,8 @@ def main(args):
                     continue
                 try:
                     sys.stdout.write('Moving {:s}: {:s}\n'.format(os.path.basename(f), new_location))
-                    shutil.move(f, new_location)
+                    with stage('move'):
+                        shutil.move(f, new_location)
                 except IOError as e:
                     sys.stderr.write('{:s}: {:s}\n'.format(e.strerror, f))
                     move_status = False
@@ -170,8 +245,13 @@ def main(args):
                 sys.stderr.write('Keeping stream source (1 or more move errors)\n')
                 continue
                 
+            # Point the NCML aggregation at the new stream location
+            for f in glob.glob(os.path.join(new_location, '*.ncml')):
+                rewrite_ncml(f, tds_path, new_location)
+                
             # Prune the empty source directory if the move was successful
-            deleted_dirs = prune_empty_directories(TDS_NC_ROOT, rel_path)
+            edited_dirs.append(tds_path)
+            deleted_dirs = prune_empty_directories(tds_root, rel_path)
             for d in deleted_dirs:
                 sys.stdout.write('Deleted directory: {:s}\n'.format(d))
             
@@ -183,17 +263,28 @@ def main(args):
             for f in f_contents:
                 try:
                     sys.stdout.write('Deleting file: {:s}\n'.format(f))
-                    os.remove(f)
+                    with stage('delete'):
+                        os.remove(f)
                 except OSError as e:
                     sys.stderr.write('{:s}: {:s}\n'.format(e.strerror, f))
                     continue
             # Recursively delete the directories from the bottom up provided they
             # are empty
             sys.stdout.write('Pruning path: {:s}\n'.format(rel_path))
-            deleted_dirs = prune_empty_directories(TDS_NC_ROOT, rel_path)
+            edited_dirs.append(tds_path)
+            deleted_dirs = prune_empty_directories(tds_root, rel_path)
             for d in deleted_dirs:
                 sys.stdout.write('Deleted directory: {:s}\n'.format(d))
     
+    volumes.close()
+    
+    if args.catalog and edited_dirs:
+        # Only the catalogs of the edited streams are rewritten or removed
+        from tds.catalog import update_catalogs
+        with stage('catalog'):
+            counts = update_catalogs(TDS_NC_ROOT, args.catalog, stream_dirs=edited_dirs)
+        sys.stdout.write('Catalogs: {:d} stream catalogs written, {:d} removed\n'.format(counts['written'], counts['removed']))
+    
     status = 0
               
     return status
@@ -273,13 +364,33 @@ if __name__ == '__main__':
     arg_parser.add_argument('-c', '--copy',
         action='store_true',
         help='Verbose display')
+    arg_parser.add_argument('--verify',
+        action='store_true',
+        help='Verify each stream against its content-hash manifest, creating the manifest if it does not exist')
+    arg_parser.add_argument('--full',
+        action='store_true',
+        help='Re-hash every file when verifying, rather than only files whose size or modification time changed')
+    arg_parser.add_argument('-p', '--processes',
+        type=int,
+        default=4,
+        help='Number of files to hash in parallel (4 is <default>)')
     arg_parser.add_argument('--tdsroot',
         type=str,
         help='Location of the THREDDS root directory containing the source files.  Must be specified if ASYNC_TDS_NC_ROOT is not set')
+    arg_parser.add_argument('--volume',
+        type=str,
+        help='Move each stream to this root of ASYNC_TDS_NC_ROOT, when it is a list of roots, and rewrite its NCML aggregation file')
+    arg_parser.add_argument('-l', '--leases',
+        type=str,
+        help='Export lease directory, under which streams are claimed before being moved with --volume (ASYNC_DATA_HOME/stream-queue/leases is <default>)')
+    arg_parser.add_argument('--catalog',
+        type=str,
+        help='THREDDS catalog root in which the catalogs of the moved or deleted streams are updated')
     arg_parser.add_argument('--location',
         type=str,
         help='Location to move or copy directory tree.  Must be specified if the --copy or --move option is used')
+    add_profile_arguments(arg_parser)
 
     parsed_args = arg_parser.parse_args()
 
-    sys.exit(main(parsed_args))
+    sys.exit(run_profiled(main, parsed_args, 'edit'))
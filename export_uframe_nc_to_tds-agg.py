@@ -3,11 +3,16 @@
 import os
 import sys
 import argparse
-import csv
-import glob
-import shutil
+import multiprocessing
 from uframe import *
 from tds import *
+from tds.export import export_stream_request, drain_requests
+from tds.lease import LeaseDir
+from tds.scan import scan_requests
+from tds.transcode import transcode_copy_function
+from tds.queue_store import QUEUED, DEFAULT_STORE, open_store
+from tds.volumes import invalid_roots
+from tds.timing import stage, enable_timing, merge_stages, add_profile_arguments, run_profiled
 
 _OOI_ARRAYS = {'CP' : 'Coastal_Pioneer',
     'CE' : 'Coastal_Endurance',
@@ -16,20 +21,64 @@ _OOI_ARRAYS = {'CP' : 'Coastal_Pioneer',
     'GA' : 'Global_Argentine_Basin',
     'GS' : 'Global_Southern_Ocean',
     'RS' : 'Cabled_Array'}
-    
+
+def drain_worker(worker_args):
+    '''Export worker: drain the queue store, with its own store connection and
+    leases, and return the THREDDS destinations of the requests exported, the
+    transcode reports and, with --profile in a worker process, the stage
+    times'''
+
+    (store_file, lease_root, lease_ttl, uframe_nc_root, tds_nc_root, ncml_template, quarantine_root, urls, args) = worker_args
+
+    # Worker processes time their stages separately, for the parent to merge
+    timer = enable_timing() if args.profile and args.workers > 1 else None
+
+    store = open_store(store_file)
+    if not store:
+        return ([], [], {})
+
+    transcode = None
+    transcode_reports = []
+    if args.transcode:
+        transcode = transcode_copy_function(complevel=args.complevel, reports=transcode_reports)
+
+    try:
+        exported = drain_requests(store,
+            LeaseDir(lease_root, ttl=lease_ttl),
+            uframe_nc_root,
+            tds_nc_root,
+            ncml_template,
+            urls=urls,
+            delete=args.delete,
+            processes=args.processes,
+            transcode=transcode,
+            quarantine_dir=quarantine_root)
+    finally:
+        store.close()
+
+    return ([r['tds_destination'] for r in exported], transcode_reports, timer.stages() if timer else {})
+
 def main(args):
     '''Check the status of queued UFrame requests.  No files are moved and no
     NCML aggregation files are written.  Use the -m or --move option to
     timestamp any generated NetCDF files to THREDDS and write the NCML
-    aggregation files'''
+    aggregation files.  Request status is kept in the queue store
+    (stream-queue/queue.db by default): requests in the queue csv files that are
+    not in the store are added to it and, if no queue csv files are specified,
+    all pending requests in the store are checked.  With -m, each request's
+    THREDDS destination is claimed with a lease file before it is exported, so
+    that overlapping runs, and the -w worker processes of one run, never export
+    the same dataset at the same time.  Files that are not complete NetCDF files
+    are never published and, with -m, are moved to the quarantine directory
+    (ASYNC_DATA_HOME/quarantine by default) with the reason'''
 
     USER = args.user
-    QUEUE_CSV = args.queue_csv
     
-    # Make sure the queue file exists
-    if not os.path.exists(QUEUE_CSV):
-        sys.stderr.write('Invalid queue csv file: {:s}\n'.format(QUEUE_CSV))
-        return 1
+    # Make sure the queue files exist
+    for queue_csv in args.queue_csv:
+        if not os.path.exists(queue_csv):
+            sys.stderr.write('Invalid queue csv file: {:s}\n'.format(queue_csv))
+            return 1
         
     # File locations from environment
     ASYNC_DATA_ROOT = os.getenv('ASYNC_DATA_HOME')
@@ -60,8 +109,8 @@ def main(args):
         sys.stderr.write('ASYNC_TDS_NC_ROOT environment variable not set\n')
         sys.stderr.flush()
         return 1
-    elif not os.path.exists(TDS_NC_ROOT):
-        sys.stderr.write('ASYNC_TDS_NC_ROOT is invalid: {:s}\n'.format(TDS_NC_ROOT))
+    elif invalid_roots(TDS_NC_ROOT):
+        sys.stderr.write('ASYNC_TDS_NC_ROOT is invalid: {:s}\n'.format(', '.join(invalid_roots(TDS_NC_ROOT))))
         sys.stderr.flush()
         return 1
 
@@ -85,237 +134,117 @@ def main(args):
     sys.stdout.write('THREDDS NetCDF Root: {:s}\n'.format(TDS_NC_ROOT))
     #sys.stdout.write('THREDDS NCML Root  : {:s}\n'.format(TDS_NCML_ROOT))
     sys.stdout.write('NCML Agg Template  : {:s}\n'.format(NCML_TEMPLATE))
+
+    QUEUE_STORE = args.store or os.path.join(ASYNC_DATA_ROOT, DEFAULT_STORE)
+    sys.stdout.write('Queue store        : {:s}\n'.format(QUEUE_STORE))
+    LEASE_ROOT = args.leases or os.path.join(os.path.dirname(QUEUE_STORE), 'leases')
+    QUARANTINE_ROOT = args.quarantine or os.path.join(ASYNC_DATA_ROOT, 'quarantine')
+    if args.move:
+        sys.stdout.write('Lease directory    : {:s}\n'.format(LEASE_ROOT))
+        sys.stdout.write('Quarantine         : {:s}\n'.format(QUARANTINE_ROOT))
    
     # Exit if we're just validating our environment setup (-v)
     if args.validate:
         return 0
 
-    # Convert the queue_csv csv records to an array of dicts
-    stream_requests = csv2json(QUEUE_CSV)
-    if not stream_requests:
-        return 0
-
-    remaining_streams = []
-    for stream in stream_requests:
+    store = open_store(QUEUE_STORE)
+    if not store:
+        return 1
 
-        if 'tds_destination' not in stream.keys():
-            stream['tds_destination'] = None
+    # Convert the queue_csv csv records to an array of dicts
+    csv_requests = []
+    with stage('load_csv'):
+        for queue_csv in args.queue_csv:
+            csv_requests.extend(csv2json(queue_csv) or [])
 
-        sys.stdout.write('\nProcessing Stream: {:s}-{:s}\n'.format(stream['instrument'], stream['stream']))
+    # Add new requests to the store, unless in debug mode
+    if not args.move:
+        stream_requests = store.pending() + [r for r in csv_requests if not store.get(r['request_url'])]
+    else:
+        with stage('write_queue'):
+            added = store.add(csv_requests)
+        if added:
+            sys.stdout.write('Added {:d} requests to queue store\n'.format(added))
+        stream_requests = store.pending()
 
-        if stream['reason'].find('Complete') == 0:
-            sys.stdout.write('Request already complete and available on thredds: {:s}\n'.format(stream['tds_destination']))
-            continue
-        elif not stream['requestUUID']:
-            sys.stderr.write('Request failed (No requestUUID): {:s}\n'.format(stream['request_url']));
-            stream['reason'] = 'No requestUUID created'
-            remaining_streams.append(stream)
-            continue
+    # Requests queued by uframe_tds_harvester.py have not been sent yet
+    stream_requests = [r for r in stream_requests if r['reason'] != QUEUED]
 
-        sys.stdout.write('Request: {:s}\n'.format(stream['requestUUID']))
+    # Only check the requests in the specified queue files
+    if args.queue_csv:
+        urls = set([r['request_url'] for r in csv_requests])
+        stream_requests = [r for r in stream_requests if r['request_url'] in urls]
 
-        # A UFrame request is complete when complete_file exists and contains the
-        # string 'complete'.
-        product_dir = os.path.join(UFRAME_NC_ROOT, stream['requestUUID'])
-        complete_file = os.path.join(product_dir, 'status.txt')
-        if not os.path.exists(complete_file):
-            sys.stderr.write('Request not completed yet: {:s}\n'.format(stream['request_url']))
-            # If it doesn't exist, add it to remaining streams
-            stream['reason'] = 'In process'
-            remaining_streams.append(stream)
-            continue
-        
-        try:
-            fid = open(complete_file, 'r')
-        except IOError as e:
-            sys.stderr.write('{:s}: {:s}\n'.format(complete_file, e.strerror))
-            remaining_streams.append(stream)
-            continue
-        
-        status = fid.readline()
-        if status != 'complete':
-            sys.stderr.write('Request not completed yet: {:s}\n'.format(stream['request_url']))
-            # If it doesn't exist, add it to remaining streams
-            stream['reason'] = 'In process'
-            remaining_streams.append(stream)
-        
-        sys.stdout.write('NetCDF Source Directory: {:s}\n'.format(product_dir))
-        product_dir_items = os.listdir(product_dir)
-        nc_files = []
-        for product_dir_item in product_dir_items:
-            bin_dir = os.path.join(product_dir, product_dir_item)
-            if not os.path.isdir(bin_dir):
-                continue
-            
-            target_nc_files = glob.glob(os.path.join(bin_dir, '*{:s}.nc'.format(stream['stream'])))
-            if not target_nc_files:
-                continue
-                
-            for target_nc_file in target_nc_files:
-                nc_files.append(target_nc_file)
-                
-        if not nc_files:
-#            sys.stderr.write('No NetCDF product files found: {:s}\n'.format(product_dir))
-            sys.stderr.write('No NetCDF files found\n')
-            stream['reason'] = 'No NetCDF files found'
-            remaining_streams.append(stream)
-            continue
-            
-        # Create the name of the stream destination directory
-        destination = dir_from_request_meta(stream)
-        if not destination:
-            sys.stderr.write('Cannot determine stream destination\n')
-            continue
-        
-        # See if the fully qualified NetCDF stream destination directory needs to be created    
-        stream_destination = os.path.join(TDS_NC_ROOT, destination)
-        sys.stdout.write('NetCDF TDS Destination : {:s}\n'.format(stream_destination))
-       
-        # Add the tds_destination
-        stream['tds_destination'] = stream_destination
+    if not stream_requests:
+        store.close()
+        return 0
 
-        #NCML
-        ncml_destination = stream_destination
-        sys.stdout.write('NCML file destination  : {:s}\n'.format(ncml_destination))
-        if not os.path.exists(stream_destination):
-            
-            if  not args.move:
-                sys.stdout.write('DEBUG> Skipping creation of stream destination\n')
-            else:
-                sys.stdout.write('Creating stream destination: {:s}\n'.format(stream_destination))
-                try:
-                    os.makedirs(stream_destination)
-                except OSError as e:
-                    sys.stderr.write('{:s}\n'.format(e.strerror))
-                    continue
-        
-        # See if the fully qualified NCML destination directory needs to be created    
-        if not os.path.exists(ncml_destination):
-            
-            if not args.move:
-                sys.stdout.write('DEBUG> Skipping creation of NCML destination\n')
-            else:
-                sys.stdout.write('Creating stream destination: {:s}\n'.format(ncml_destination))
-                try:
-                    os.makedirs(ncml_destination)
-                except OSError as e:
-                    sys.stderr.write('{:s}\n'.format(e.strerror))
-                    continue
-                    
-        # Write the NCML aggregation file using NCML_TEMPLATE        
-        dataset_id = '{:s}-{:s}-{:s}'.format(
-            stream['instrument'],
-            stream['stream'],
-            stream['telemetry'])
-        
-        ncml_file = os.path.join(ncml_destination, '{:s}.ncml'.format(dataset_id))
-        sys.stdout.write('NCML aggregation file: {:s}\n'.format(os.path.split(ncml_file)[1]))
-        # Write the NCML file, using NCML_TEMPLATE, if it doesn't already exist
-        if not os.path.exists(ncml_file):
-            
-            if not args.move:
-                sys.stdout.write('DEBUG> Skipping NCML aggregation file creation\n')
-            else:
-                try:
-                    sys.stdout.write('Loading NCML aggregation template: {:s}\n'.format(ncml_file))
-                    template_fid = open(NCML_TEMPLATE, 'r')
-                    ncml_template = template_fid.read()
-                    template_fid.close()
-                    
-                    sys.stdout.write('Writing NCML aggregation file: {:s}\n'.format(ncml_file))
-                    stream_ncml = ncml_template.format(dataset_id, stream_destination)
-                    
-                    ncml_fid = open(ncml_file, 'w')
-                    ncml_fid.write(stream_ncml)
-                    ncml_fid.close()
-                except IOError as e:
-                    sys.stderr.write('{:s}: {:s}\n'.format(e.filename, e.strerror))
-                    continue
-        
-        #sys.stdout.write('Stopping before we do any damage')
-        #continue
-            
-        # Rename the files and move them to TDS_NC_ROOT
-        ts_nc_files = []
-        for nc_file in nc_files:
+    transcode_reports = []
+    exported_dirs = []
+    if args.move:
+        # Drain the store with args.workers processes, each claiming requests
+        # with leases
+        urls = set([r['request_url'] for r in csv_requests]) if args.queue_csv else None
+        store.close()
+        worker_args = (QUEUE_STORE, LEASE_ROOT, args.lease_ttl, UFRAME_NC_ROOT, TDS_NC_ROOT, NCML_TEMPLATE, QUARANTINE_ROOT, urls, args)
+        if args.workers > 1:
+            pool = multiprocessing.Pool(args.workers)
+            try:
+                results = pool.map(drain_worker, [worker_args] * args.workers)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [drain_worker(worker_args)]
+        for (destinations, reports, stages) in results:
+            exported_dirs.extend(destinations)
+            transcode_reports.extend(reports)
+            merge_stages(stages)
+        sys.stdout.write('Exported {:d} requests\n'.format(len(exported_dirs)))
+    else:
+        # Optionally rewrite each published file as compressed, time-chunked
+        # NetCDF4
+        transcode = None
+        if args.transcode:
+            transcode = transcode_copy_function(complevel=args.complevel, reports=transcode_reports)
 
-            (nc_path, nc_filename) = os.path.split(nc_file)
-            sys.stdout.write('UFrame NetCDF : {:s}/{:s}\n'.format(os.path.split(nc_path)[-1], nc_filename))
+        # Scan the product directories of all the requests at once
+        with stage('scan'):
+            indexes = scan_requests(UFRAME_NC_ROOT, [r['requestUUID'] for r in stream_requests])
+        for stream in stream_requests:
+            export_stream_request(stream,
+                UFRAME_NC_ROOT,
+                TDS_NC_ROOT,
+                NCML_TEMPLATE,
+                move=args.move,
+                delete=args.delete,
+                processes=args.processes,
+                transcode=transcode,
+                index=indexes.get(stream['requestUUID']))
 
-            # Timestamp the file but do not prepend a destination directory
-            ts_nc_file = timestamp_nc_file(nc_file, dest_dir=None)
-            if not ts_nc_file:
-                sys.stderr.write('Failed to timestamp UFrame NetCDF file: {:s}\n'.format(nc_file))
-                continue
-            
-            sys.stdout.write('THREDDS NetCDF: {:s}\n'.format(ts_nc_file))
-            # Create the NetCDF destination file        
-            tds_nc_file = os.path.join(stream_destination, ts_nc_file)
-            ts_nc_files.append(tds_nc_file)
+        store.close()
 
-            # Skip moving the file if in debug mode, but tell me what the new
-            # filename is
-            if not args.move:
-#                sys.stdout.write('DEBUG> Skipping file creation\n')
-                continue
-            
-            # Move the file
-            try:
-                sys.stdout.write('Moving UFrame NetCDF file: {:s}\n'.format(nc_file))
-                sys.stdout.write('Timestamp NetCDF file    : {:s}\n'.format(ts_nc_file))
-                shutil.copyfile(nc_file, tds_nc_file)
-            except IOError as e:
-                sys.stderr.write('{:s}: {:s}\n'.format(e.strerr, ts_nc_file))
-     
-        ts_nc_files.sort()
-        sys.stdout.write('Found {:d} files\n'.format(len(ts_nc_files)))
-        for ts_nc_file in ts_nc_files:
-            (ts_nc_dir, ts_nc_name) = os.path.split(ts_nc_file)
-            sys.stdout.write('Timestamp NetCDF File: {:s}\n'.format(ts_nc_name))
+    if transcode_reports:
+        size_before = sum([r['size_before'] for r in transcode_reports])
+        size_after = sum([r['size_after'] for r in transcode_reports])
+        sys.stdout.write('Transcoded {:d} files: {:d} -> {:d} bytes ({:0.1f}%), read {:0.3f} -> {:0.3f} s\n'.format(
+            len(transcode_reports),
+            size_before,
+            size_after,
+            100.0 * size_after / max(size_before, 1),
+            sum([r['read_before'] for r in transcode_reports]),
+            sum([r['read_after'] for r in transcode_reports])))
 
-        # Mark the request as complete if we've moved at least one NetCDF file
-        # to stream_destination
-        stream['reason'] = 'Complete'
+    if args.catalog and exported_dirs:
+        # Only the catalogs of the streams just exported are rewritten
+        from tds.catalog import update_catalogs
+        with stage('catalog'):
+            counts = update_catalogs(TDS_NC_ROOT, args.catalog, stream_dirs=sorted(set(exported_dirs)))
+        sys.stdout.write('Catalogs: {:d} stream catalogs written, {:d} parent catalogs written\n'.format(counts['written'], counts['parents']))
 
-        if args.delete:
-            sys.stdout.write('Deleting UFrame product destination: {:s}\n'.format(product_dir))
-            try:
-                os.rmdir(product_dir)
-            except OSError as e:
-                sys.stderr.write('Failed to delete UFrame product destination: {:s} (Reason: {:s})\n'.format(product_dir, e.strerror))
-                sys.stderr.flush()
-                continue
-                
-    # Delete the request_queue file
-    if not args.move:
-        sys.stdout.write('DEBUG> Keeping stream request file: {:s}\n'.format(args.queue_csv))
-    else:
-        try:
-            os.remove(args.queue_csv)
-        except OSError as e:
-            sys.stderr.write('Failed to remove request queue file: {:s} (Reason: {:s})\n'.format(args.queue_csv, e.strerror))
-            sys.stderr.flush()
-            return 1
-                
-    # Write updated requests back to args.queue_csv
     if not args.move:
         sys.stdout.write('DEBUG> Stream status:\n')
-        csv_writer = csv.writer(sys.stdout)
-    else:
-        sys.stdout.write('Saving updated requests: {:s}\n'.format(args.queue_csv))
-        try:
-            fid = open(args.queue_csv, 'w')
-            csv_writer = csv.writer(fid)
-        except IOError as e:
-            sys.stderr.write('{:s}: {:s}\n'.format(args.queue_csv, e.strerror))
-            return 1
-   
-    # Write all requests back to the args.queue_csv
-    cols = stream_requests[0].keys()
-    csv_writer.writerow(cols)
-    for stream in stream_requests:
-        row = [stream[k] for k in cols]
-        csv_writer.writerow(row)
+        write_queue_csv(stream_requests, sys.stdout)
                 
     return 0
     
@@ -323,7 +252,10 @@ if __name__ == '__main__':
 
     arg_parser = argparse.ArgumentParser(description=main.__doc__)
     arg_parser.add_argument('queue_csv',
-        help='Filename containing queued request information.')
+        nargs='*',
+        help='Filenames containing queued request information.')
+    arg_parser.add_argument('-s', '--store',
+        help='Alternate queue store (ASYNC_DATA_HOME/stream-queue/queue.db is <default>)')
     arg_parser.add_argument('-u', '--user',
         default='_nouser',
         help='Alternate user name (_nouser is <default>)')
@@ -335,10 +267,37 @@ if __name__ == '__main__':
         dest='move',
         action='store_true',
         help='Create NCML file and move NetCDF files to THREDDS');
+    arg_parser.add_argument('-p', '--processes',
+        type=int,
+        default=4,
+        help='Number of files to hash in parallel when publishing (4 is <default>)')
+    arg_parser.add_argument('-w', '--workers',
+        type=int,
+        default=1,
+        help='Number of worker processes exporting requests with -m (1 is <default>)')
+    arg_parser.add_argument('-l', '--leases',
+        help='Alternate lease directory, shared by all workers (stream-queue/leases next to the queue store is <default>)')
+    arg_parser.add_argument('--lease-ttl',
+        dest='lease_ttl',
+        type=float,
+        default=3600.0,
+        help='Seconds after which a lease that is no longer renewed may be broken (3600 is <default>)')
+    arg_parser.add_argument('-q', '--quarantine',
+        help='Directory to which NetCDF files that fail verification are moved with -m (ASYNC_DATA_HOME/quarantine is <default>)')
+    arg_parser.add_argument('-c', '--catalog',
+        help='THREDDS catalog root in which the catalogs of the exported streams are updated with -m')
+    arg_parser.add_argument('-t', '--transcode',
+        action='store_true',
+        help='Rewrite published files as zlib compressed NetCDF4 chunked along the time dimension')
+    arg_parser.add_argument('--complevel',
+        type=int,
+        default=4,
+        help='zlib compression level used with --transcode (4 is <default>)')
     arg_parser.add_argument('-v', '--validate',
         dest='validate',
         action='store_true',
         help='Validate environment set up only.')
+    add_profile_arguments(arg_parser)
     parsed_args = arg_parser.parse_args()
 
-    sys.exit(main(parsed_args))
+    sys.exit(run_profiled(main, parsed_args, 'export'))
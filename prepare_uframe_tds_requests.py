@@ -5,11 +5,12 @@ import sys
 import csv
 import argparse
 import copy
-import requests
 import datetime
 from uframe import UFrame
-from dateutil import parser
 from tds import *
+from uframe.inventory import InventorySnapshot
+from tds.volumes import invalid_roots
+from tds.timing import stage, add_profile_arguments, run_profiled
 
 def main(args):
     
@@ -32,7 +33,7 @@ def main(args):
         sys.stderr.write('ASYNC_TDS_NC_ROOT environment variable not set\n')
         sys.stderr.flush()
         return 1
-    elif not os.path.exists(TDS_NC_ROOT):
+    elif invalid_roots(TDS_NC_ROOT):
         sys.stderr.write('ASYNC_TDS_NC_ROOT is invalid\n')
         sys.stderr.flush()
         return 1
@@ -78,15 +79,16 @@ def main(args):
             sys.stderr.flush()
             return 1
             
-    # Configure UFrame instance    
-    if args.base_url:
-        uframe_base = UFrame(base_url=args.base_url)
+    # Configure UFrame instance.  A comma-separated list of urls distributes
+    # requests across uFrame replicas, with the first url used to build request
+    # urls
+    uframe_urls = args.base_url or os.getenv('UFRAME_BASE_URL')
+    if uframe_urls:
+        uframe_urls = [u.strip() for u in uframe_urls.split(',') if u.strip()]
+        uframe_base = UFrame(base_url=uframe_urls[0],
+            endpoints=uframe_urls if len(uframe_urls) > 1 else None)
     else:
-        uframe_env_url = os.getenv('UFRAME_BASE_URL')
-        if uframe_env_url:
-            uframe_base = UFrame(base_url=uframe_env_url)
-        else:
-            uframe_base = UFrame()
+        uframe_base = UFrame()
     
     master_streams_file = args.master_stream_csv
     if not os.path.exists(master_streams_file):
@@ -98,7 +100,8 @@ def main(args):
     
     # Load the stream_master_file csv and convert to dict
     sys.stdout.write('Reading master stream file: {:s}\n'.format(master_streams_file))
-    master_streams = csv2json(master_streams_file)
+    with stage('load_csv'):
+        master_streams = csv2json(master_streams_file)
     if not master_streams:
         sys.stderr.write('No streams found: {:s}\n'.format(master_streams_file))
         sys.stderr.flush()
@@ -115,14 +118,30 @@ def main(args):
     known_streams = []
     if os.path.exists(known_streams_file):
         sys.stdout.write('Reading known streams file: {:s}\n'.format(known_streams_file))
-        known_streams = csv2json(known_streams_file)
+        with stage('load_csv'):
+            known_streams = csv2json(known_streams_file)
     else:
         sys.stdout.write('No known streams file: {:s}\n'.format(known_streams_file))
         sys.stdout.write('Processing all streams from {:s}\n'.format(master_streams_file))
         sys.stdout.flush()
         
+    # Inventory snapshot (uframe_tds.py snapshot) to check for updates against
+    inventory = None
+    if args.snapshot:
+        if not args.update:
+            sys.stderr.write('-s/--snapshot is only used with --update\n')
+            return 1
+        if not os.path.exists(args.snapshot):
+            sys.stderr.write('Invalid inventory snapshot: {:s}\n'.format(args.snapshot))
+            return 1
+        sys.stdout.write('Reading inventory snapshot: {:s}\n'.format(args.snapshot))
+        with stage('load_snapshot'):
+            inventory = InventorySnapshot.load(args.snapshot)
+
     # compare master_streams to known_streams to see if there any new streams to request
-    new_streams = find_new_streams(master_streams, known_streams)
+    with stage('compare'):
+        new_streams = find_new_streams(master_streams, known_streams)
+    request_streams = []
         
     sys.stdout.write('Found {:d} new streams\n'.format(len(new_streams)))
     sys.stdout.flush()
@@ -138,71 +157,36 @@ def main(args):
         sys.stdout.write('Checking for updates to existing streams\n')
         sys.stdout.flush()
         
-        for s in known_streams:
-            
-            meta_url = create_stream_metadata_url(uframe_base, s)
-            if not meta_url:
-                continue
-                
-            try:
-                r = requests.get(meta_url)
-                if r.status_code != 200:
-                    sys.stderr.write('{:s}: {:s}\n'.format(r.reason, meta_url))
-                    continue
-            except requests.ConnectionError as e:
-                sys.stderr.write('{:s}: {:s}\n'.format(e[0][1], meta_url))
-                continue
-                
-            meta_streams = r.json()['times']
-            stream_names = [m['stream'] for m in meta_streams]
-            if s['stream'] not in stream_names:
-                sys.stderr.write('{:s}: Stream not found: {:s}\n'.format(s['sensor'], s['stream']))
-                continue
-                
-            i = stream_names.index(s['stream'])
-            
-            # Parse the beginTime and endTime for both s and meta_streams[i] to see
-            # if any data has been added/removed
-            st0 = parser.parse(s['beginTime'])
-            st1 = parser.parse(s['endTime'])
-            mt0 = parser.parse(meta_streams[i]['beginTime'])
-            mt1 = parser.parse(meta_streams[i]['endTime'])
-            
-            if st0 != mt0 or st1 != mt1:
-                sys.stdout.write('Stream updated: {:s}\n'.format(s['stream']))
-                new_streams.append(s)
+        if inventory is not None:
+            # Compare against the inventory snapshot and request only the
+            # changed time windows
+            with stage('compare'):
+                (updated_streams, request_streams) = find_snapshot_updated_streams(known_streams, inventory)
+                merge_streams(known_streams, updated_streams)
+        else:
+            with stage('metadata_fetch'):
+                new_streams.extend(find_updated_streams(known_streams, uframe_base))
                 
     # Merge known_streams and new_streams
     if new_streams:
         sys.stdout.write('Merging new and known streams\n')
         sys.stdout.flush()
         
-    for s in new_streams:
-        
-        streams = ['{:s}-{:s}'.format(r['sensor'], r['stream']) for r in known_streams]
-        
-        if not streams:
-            known_streams.append(s)
-            continue
-        
-        stream_id = '{:s}-{:s}'.format(s['sensor'], s['stream'])
-        if stream_id not in streams:
-            known_streams.append(s)
-            continue
-            
-        i = streams.index(stream_id)
-        known_streams[i] = s
+    with stage('compare'):
+        merge_streams(known_streams, new_streams)
         
     # Write known_streams to the known_streams_file
     if not args.debug:
         sys.stdout.write('Saving new known streams: {:s}\n'.format(known_streams_file))
         sys.stdout.flush()
-        status = write_streams_to_csv(known_streams, known_streams_file)
+        with stage('write_known'):
+            status = write_streams_to_csv(known_streams, known_streams_file)
         if not status:
             return status
     
     # Write the new async requests to stream_request_file
-    async_urls = build_async_query_from_stream_meta(uframe_base, new_streams, user=args.user)
+    with stage('build_urls'):
+        async_urls = build_async_query_from_stream_meta(uframe_base, new_streams + request_streams, user=args.user)
     if async_urls:
         
         if args.debug:
@@ -212,10 +196,11 @@ def main(args):
         else:
             sys.stdout.write('Writing new asynchronous queries: {:s}\n'.format(stream_request_file))
             try:
-                fid = open(stream_request_file, 'w')
-                for url in async_urls:
-                    fid.write('{:s}\n'.format(url))
-                fid.close()
+                with stage('write_queue'):
+                    fid = open(stream_request_file, 'w')
+                    for url in async_urls:
+                        fid.write('{:s}\n'.format(url))
+                    fid.close()
             except IOError as e:
                 sys.stderr.write('{:s}: {:s}\n'.format(e.strerror, stream_request_file))
                 return 1
@@ -233,13 +218,16 @@ if __name__ == '__main__':
     arg_parser.add_argument('--update',
         action='store_true',
         help='Check known streams for metadata updates')
+    arg_parser.add_argument('-s', '--snapshot',
+        help='Check known streams for updates (--update) against this inventory snapshot, created with uframe_tds.py snapshot, instead of sending metadata requests')
     arg_parser.add_argument('-x', '--debug',
         dest='debug',
         action='store_true',
         help='Print completed request info, but do not move files')
     arg_parser.add_argument('-b', '--baseurl',
         dest='base_url',
-        help='Specify an alternate uFrame server URL. Must start with \'http://\'.')
+        help='Specify an alternate uFrame server URL, or a comma-separated list of uFrame replica URLs. Must start with \'http://\'.')
+    add_profile_arguments(arg_parser)
     parsed_args = arg_parser.parse_args()
 
-    sys.exit(main(parsed_args))
+    sys.exit(run_profiled(main, parsed_args, 'prepare'))
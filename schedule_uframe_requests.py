@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import glob
+import argparse
+from tds.scheduler import *
+from tds.queue_store import DEFAULT_STORE, open_store
+from tds.volumes import invalid_roots
+
+def main(args):
+    '''Select the next batch of asynchronous UFrame requests to send.  Unsent
+    request urls are read from URL_FILES (all stream-requests/*-urls.csv files
+    by default), their cost is estimated from the requested time range and the
+    stream's historical bytes per day on THREDDS, and they are ordered by
+    instrument type priority (the order of stream-requests/instrument-types.txt)
+    and staleness.  Requests are selected without exceeding the number of
+    requests in flight allowed per instrument type and per array, and the
+    selected urls are written, one per line, for send_requests_from_csv.sh.'''
+
+    ASYNC_DATA_ROOT = os.getenv('ASYNC_DATA_HOME')
+    if not ASYNC_DATA_ROOT:
+        sys.stderr.write('ASYNC_DATA_HOME environment variable not set\n')
+        sys.stderr.flush()
+        return 1
+    elif not os.path.exists(ASYNC_DATA_ROOT):
+        sys.stderr.write('ASYNC_DATA_HOME is invalid: {:s}\n'.format(ASYNC_DATA_ROOT))
+        sys.stderr.flush()
+        return 1
+
+    UFRAME_NC_ROOT = os.getenv('ASYNC_UFRAME_NC_ROOT')
+    if not UFRAME_NC_ROOT:
+        sys.stderr.write('ASYNC_UFRAME_NC_ROOT environment variable not set\n')
+        sys.stderr.flush()
+        return 1
+    UFRAME_NC_ROOT = os.path.join(UFRAME_NC_ROOT, args.user)
+
+    # Historical stream sizes are taken from THREDDS, if available
+    TDS_NC_ROOT = os.getenv('ASYNC_TDS_NC_ROOT')
+    if not TDS_NC_ROOT or invalid_roots(TDS_NC_ROOT):
+        sys.stderr.write('ASYNC_TDS_NC_ROOT not set or invalid: using default stream sizes\n')
+        TDS_NC_ROOT = None
+
+    STREAMS_REQUEST_ROOT = os.path.join(ASYNC_DATA_ROOT, 'stream-requests')
+    STREAMS_QUEUE_ROOT = os.path.join(ASYNC_DATA_ROOT, 'stream-queue')
+    PROCESSED_URLS_ROOT = os.path.join(STREAMS_REQUEST_ROOT, 'processed')
+    INSTRUMENTS_FILE = os.path.join(STREAMS_REQUEST_ROOT, 'instrument-types.txt')
+
+    url_files = args.url_files
+    if not url_files:
+        url_files = sorted(glob.glob(os.path.join(STREAMS_REQUEST_ROOT, '*-urls.csv')))
+    if not url_files:
+        sys.stderr.write('No request url files found\n')
+        return 0
+
+    # Skip urls that have already been sent
+    sent_urls = submitted_urls(STREAMS_QUEUE_ROOT, PROCESSED_URLS_ROOT)
+
+    requests = load_url_files(url_files, exclude_urls=sent_urls)
+    if not requests:
+        sys.stdout.write('No unsent requests\n')
+        return 0
+
+    # Request status recorded in the queue store overrides the queue csv files
+    QUEUE_STORE = os.path.join(ASYNC_DATA_ROOT, DEFAULT_STORE)
+    store = open_store(QUEUE_STORE) if os.path.exists(QUEUE_STORE) else None
+
+    in_flight = requests_in_flight(STREAMS_QUEUE_ROOT, UFRAME_NC_ROOT, store=store)
+    sys.stderr.write('{:d} unsent requests, {:d} requests in flight\n'.format(len(requests), len(in_flight)))
+
+    estimate_costs(requests, TDS_NC_ROOT)
+    scheduled = schedule_requests(requests,
+        in_flight=in_flight,
+        priorities=load_instrument_priorities(INSTRUMENTS_FILE),
+        max_per_type=args.max_per_type,
+        max_per_array=args.max_per_array,
+        max_total=args.max_total)
+
+    sys.stderr.write('Scheduled {:d} requests\n'.format(len(scheduled)))
+    for r in scheduled:
+        sys.stderr.write('Priority {:d} {:s} {:s} {:0.1f} days, {:0.1f} MB est., waiting {:0.1f} days: {:s}-{:s}\n'.format(
+            r['priority'],
+            r['instrument_type'],
+            r['array'],
+            r['days'],
+            r['cost'] / 1024. / 1024.,
+            r['staleness'],
+            r['instrument'],
+            r['stream']))
+
+    if args.debug or not scheduled:
+        return 0
+
+    if args.outfile:
+        try:
+            fid = open(args.outfile, 'w')
+        except IOError as e:
+            sys.stderr.write('{:s}: {:s}\n'.format(e.strerror, args.outfile))
+            return 1
+    else:
+        fid = sys.stdout
+
+    for r in scheduled:
+        fid.write('{:s}\n'.format(r['request_url']))
+
+    if fid is not sys.stdout:
+        fid.close()
+
+    return 0
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('url_files',
+        nargs='*',
+        help='Files containing request urls, one per line')
+    arg_parser.add_argument('--user',
+        default='_nouser',
+        help='Alternate user name (_nouser is <default>)')
+    arg_parser.add_argument('-t', '--max-per-type',
+        dest='max_per_type',
+        type=int,
+        default=4,
+        help='Maximum number of requests in flight per instrument type (4 is <default>)')
+    arg_parser.add_argument('-a', '--max-per-array',
+        dest='max_per_array',
+        type=int,
+        default=10,
+        help='Maximum number of requests in flight per array (10 is <default>)')
+    arg_parser.add_argument('-n', '--max-total',
+        dest='max_total',
+        type=int,
+        help='Maximum total number of requests in flight')
+    arg_parser.add_argument('-o', '--outfile',
+        help='Write the scheduled urls to this file instead of STDOUT')
+    arg_parser.add_argument('-x', '--debug',
+        dest='debug',
+        action='store_true',
+        help='Print the schedule, but do not write the scheduled urls')
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))
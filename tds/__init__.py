@@ -4,9 +4,9 @@ import sys
 import csv
 import copy
 import re
-from netCDF4 import Dataset
-from uframe import UFrame
-from dateutil import parser
+from uframe import UFrame, get_sensor_metadata, stream_parameter_ids
+from uframe.timestamps import parse_timestamp
+from tds.scan import ProductIndex
 
 _OOI_ARRAYS = {'CP' : 'Coastal_Pioneer',
     'CE' : 'Coastal_Endurance',
@@ -32,7 +32,7 @@ def csv2json(csv_filename):
         return json_array
         
     csv_reader = csv.reader(fid)
-    cols = csv_reader.next()
+    cols = next(csv_reader)
     col_range = range(0,len(cols))
     
     for r in csv_reader:
@@ -70,7 +70,160 @@ def find_new_streams(master_streams, known_streams):
             
     return new_streams
 
-def create_data_request_url(uframe_base, stream_meta):
+def find_updated_streams(known_streams, uframe_base):
+    '''Send a metadata request for each of the known_streams and return copies
+    of the streams whose beginTime or endTime has changed, with their current
+    beginTime and endTime, so that merging them into the known streams records
+    the update once'''
+
+    updated_streams = []
+    for s in known_streams:
+
+        meta_url = create_stream_metadata_url(uframe_base, s)
+        if not meta_url:
+            continue
+
+        # Streams of the same sensor share one metadata request
+        meta = uframe_base.get_inventory(meta_url)
+        if meta is None:
+            continue
+
+        meta_streams = meta['times']
+        stream_names = [m['stream'] for m in meta_streams]
+        if s['stream'] not in stream_names:
+            sys.stderr.write('{:s}: Stream not found: {:s}\n'.format(s['sensor'], s['stream']))
+            continue
+
+        i = stream_names.index(s['stream'])
+
+        # Parse the beginTime and endTime for both s and meta_streams[i] to see
+        # if any data has been added/removed
+        st0 = parse_timestamp(s['beginTime'])
+        st1 = parse_timestamp(s['endTime'])
+        mt0 = parse_timestamp(meta_streams[i]['beginTime'])
+        mt1 = parse_timestamp(meta_streams[i]['endTime'])
+
+        if st0 != mt0 or st1 != mt1:
+            sys.stdout.write('Stream updated: {:s}\n'.format(s['stream']))
+            stream = copy.deepcopy(s)
+            stream.update(beginTime=meta_streams[i]['beginTime'], endTime=meta_streams[i]['endTime'])
+            updated_streams.append(stream)
+
+    return updated_streams
+
+def find_snapshot_updated_streams(known_streams, inventory):
+    '''Compare the beginTime and endTime of each of the known_streams to the
+    uframe.inventory.InventorySnapshot inventory, without sending metadata
+    requests, and return (updated_streams, request_streams).  updated_streams
+    are copies of the changed known streams with their current beginTime and
+    endTime.  request_streams are copies with the time windows to request: the
+    new data before the known beginTime and after the known endTime, or the
+    whole stream if data has been removed.  Known streams that are not in
+    inventory are not checked'''
+
+    import numpy as np
+    from uframe.inventory import InventorySnapshot
+    from uframe.diff import diff_snapshots
+
+    required_cols = ['sensor', 'method', 'stream', 'beginTime', 'endTime']
+    known_streams = [s for s in known_streams if all([c in s for c in required_cols])]
+    known = dict([((s['sensor'], s['method'], s['stream']), s) for s in known_streams])
+
+    diff = diff_snapshots(InventorySnapshot.from_records(known_streams), inventory)
+
+    # Streams whose time bounds could not be parsed are reported, not updated
+    for r in diff.invalid_records():
+        if (r['sensor'], r['method'], r['stream']) in known:
+            sys.stderr.write('Invalid inventory time bounds: {:s}-{:s}\n'.format(r['sensor'], r['stream']))
+
+    changed = np.zeros(len(inventory), dtype=bool)
+    changed[diff.matched_current[~diff.unchanged]] = True
+    changed[diff.invalid] = False
+    updated_streams = []
+    for r in inventory.records(changed):
+        stream = copy.deepcopy(known[(r['sensor'], r['method'], r['stream'])])
+        stream.update(beginTime=r['beginTime'], endTime=r['endTime'])
+        updated_streams.append(stream)
+
+    request_streams = []
+    for w in diff.request_windows(changes=('extended_forward', 'extended_backward', 'truncated')):
+        sys.stdout.write('Stream updated ({:s}): {:s}\n'.format(w['change'], w['stream']))
+        stream = copy.deepcopy(known[(w['sensor'], w['method'], w['stream'])])
+        stream.update(beginTime=w['beginTime'], endTime=w['endTime'])
+        request_streams.append(stream)
+
+    return (updated_streams, request_streams)
+
+def merge_streams(known_streams, new_streams):
+    '''Merge new_streams into known_streams, replacing known streams with the
+    same sensor and stream name.  known_streams is modified in place and
+    returned'''
+
+    for s in new_streams:
+
+        streams = ['{:s}-{:s}'.format(r['sensor'], r['stream']) for r in known_streams]
+
+        if not streams:
+            known_streams.append(s)
+            continue
+
+        stream_id = '{:s}-{:s}'.format(s['sensor'], s['stream'])
+        if stream_id not in streams:
+            known_streams.append(s)
+            continue
+
+        i = streams.index(stream_id)
+        known_streams[i] = s
+
+    return known_streams
+
+def stream_parameters(stream_meta):
+    '''Return the list of parameters (particleKeys or pdIds) in the optional
+    parameters column of stream_meta.  Parameters are separated by spaces,
+    commas or semicolons'''
+
+    return [p for p in re.split(r'[\s,;]+', stream_meta.get('parameters') or '') if p]
+
+def stream_provenance(stream_meta):
+    '''Return False if the optional provenance column of stream_meta turns off
+    provenance, which is included by default'''
+
+    return (stream_meta.get('provenance') or 'true').strip().lower() not in ['false', 'f', 'no', 'n', '0']
+
+def resolve_stream_parameters(uframe_base, stream_meta, metadata_cache=None):
+    '''Return the pdIds of the parameters listed in the parameters column of
+    stream_meta, or None if the column is empty.  particleKeys are converted to
+    pdIds using the sensor metadata, which is fetched once per sensor if
+    metadata_cache, a dict, is specified'''
+
+    parameters = stream_parameters(stream_meta)
+    if not parameters:
+        return None
+
+    if all([re.match(r'^PD\d+$', p) for p in parameters]):
+        return parameters
+
+    if metadata_cache is None:
+        metadata_cache = {}
+    sensor = stream_meta['sensor']
+    if sensor not in metadata_cache:
+        tokens = sensor.split('-')
+        metadata_cache[sensor] = get_sensor_metadata(tokens[0],
+            tokens[1],
+            '{:s}-{:s}'.format(tokens[2], tokens[3]),
+            uframe_base=uframe_base)
+
+    pd_ids = stream_parameter_ids(metadata_cache[sensor], stream_meta['stream'], parameters)
+    if not pd_ids:
+        sys.stderr.write('{:s}-{:s}: No valid parameters: requesting all parameters\n'.format(sensor, stream_meta['stream']))
+        return None
+
+    return pd_ids
+
+def create_data_request_url(uframe_base, stream_meta, user=None, metadata_cache=None):
+    '''Create the asynchronous NetCDF request url for stream_meta.  Only the
+    parameters in the optional parameters column are requested and provenance
+    is included unless turned off in the optional provenance column'''
     
     tokens = stream_meta['sensor'].split('-')
     if len(tokens) != 4:
@@ -78,7 +231,7 @@ def create_data_request_url(uframe_base, stream_meta):
         sys.stderr.flush()
         return None
         
-    async_url = '{:s}/{:s}/{:s}/{:s}-{:s}/{:s}/{:s}?beginDT={:s}&endDT={:s}&limit=-1&execDPA=true&format=application/netcdf&include_provenance=true'.format(
+    async_url = '{:s}/{:s}/{:s}/{:s}-{:s}/{:s}/{:s}?beginDT={:s}&endDT={:s}&limit=-1&execDPA=true&format=application/netcdf&include_provenance={:s}'.format(
         uframe_base.url,
         tokens[0],
         tokens[1],
@@ -87,7 +240,15 @@ def create_data_request_url(uframe_base, stream_meta):
         stream_meta['method'],
         stream_meta['stream'],
         stream_meta['beginTime'],
-        stream_meta['endTime'])
+        stream_meta['endTime'],
+        str(stream_provenance(stream_meta)).lower())
+
+    if user:
+        async_url = '{:s}&user={:s}'.format(async_url, user)
+
+    pd_ids = resolve_stream_parameters(uframe_base, stream_meta, metadata_cache)
+    if pd_ids:
+        async_url = '{:s}&parameters={:s}'.format(async_url, ','.join(pd_ids))
         
     return async_url
     
@@ -117,11 +278,16 @@ def write_streams_to_csv(streams, out_file):
         return 1
         
     csv_writer = csv.writer(fid)
-    cols = streams[0].keys()
+    # Streams read from an older known streams file may lack columns (e.g.
+    # parameters, provenance) that newly merged streams have: write every
+    # column, in the order first seen, leaving missing values empty
+    cols = []
+    for s in streams:
+        cols.extend([c for c in s.keys() if c not in cols])
     csv_writer.writerow(cols)
     
     for s in streams:
-        r = [s[c] for c in cols]
+        r = [s.get(c, '') for c in cols]
         csv_writer.writerow(r)
         
     fid.close()
@@ -136,6 +302,9 @@ def build_async_query_from_stream_meta(uframe_base, streams, user=None):
         'sensor',
         'method']
     
+    # Sensor metadata used to convert parameter particleKeys to pdIds
+    metadata_cache = {}
+
     async_urls = []
     for s in streams:
         
@@ -145,36 +314,9 @@ def build_async_query_from_stream_meta(uframe_base, streams, user=None):
             sys.stderr.flush()
             continue
     
-        tokens = s['sensor'].split('-')
-        if len(tokens) != 4:
-            sys.stderr.write('Invalid sensor/reference designator specified: {:s}\n'.format(s['sensor']))
-            sys.stderr.flush()
+        async_url = create_data_request_url(uframe_base, s, user=user, metadata_cache=metadata_cache)
+        if not async_url:
             continue
-           
-        if not user:
-	        async_url = '{:s}/{:s}/{:s}/{:s}-{:s}/{:s}/{:s}?beginDT={:s}&endDT={:s}&limit=-1&execDPA=true&format=application/netcdf&include_provenance=true'.format(
-	            uframe_base.url,
-	            tokens[0],
-	            tokens[1],
-	            tokens[2],
-	            tokens[3],
-	            s['method'],
-	            s['stream'],
-	            s['beginTime'],
-	            s['endTime'])
-        else:
-	        async_url = '{:s}/{:s}/{:s}/{:s}-{:s}/{:s}/{:s}?beginDT={:s}&endDT={:s}&limit=-1&execDPA=true&format=application/netcdf&include_provenance=true&user={:s}'.format(
-	            uframe_base.url,
-	            tokens[0],
-	            tokens[1],
-	            tokens[2],
-	            tokens[3],
-	            s['method'],
-	            s['stream'],
-	            s['beginTime'],
-	            s['endTime'],
-                user)
-
             
         async_urls.append(async_url)
         
@@ -196,6 +338,7 @@ def timestamp_nc_file(nc_file, dest_dir=None):
         return None
         
     try:
+        from netCDF4 import Dataset
         nci = Dataset(nc_file, 'r')
     except RuntimeError as e:
         sys.stderr.write('{:s}: {:s}\n'.format(e.message, nc_file))
@@ -215,6 +358,50 @@ def timestamp_nc_file(nc_file, dest_dir=None):
     
     return ts_nc_file
 
+def find_request_nc_files(product_dir, stream, index=None):
+    '''Return the list of NetCDF files for the specified stream name contained in
+    the bin directories of the UFrame request product directory.  The product
+    directory is scanned once (see tds.scan) unless its ProductIndex, index, is
+    specified'''
+
+    if index is None:
+        index = ProductIndex(product_dir)
+
+    return index.nc_files(stream)
+
+def write_stream_ncml(ncml_template_file, ncml_file, dataset_id, stream_destination):
+    '''Write the NCML aggregation file for dataset_id, aggregating the NetCDF files
+    in stream_destination, using the NCML aggregation template file.  Returns
+    True if the file was written'''
+
+    try:
+        template_fid = open(ncml_template_file, 'r')
+        ncml_template = template_fid.read()
+        template_fid.close()
+
+        stream_ncml = ncml_template.format(dataset_id, stream_destination)
+
+        ncml_fid = open(ncml_file, 'w')
+        ncml_fid.write(stream_ncml)
+        ncml_fid.close()
+    except IOError as e:
+        sys.stderr.write('{:s}: {:s}\n'.format(e.filename, e.strerror))
+        return False
+
+    return True
+
+def write_queue_csv(stream_requests, fid):
+    '''Write the stream request records, with a header row, to the open file
+    object fid'''
+
+    csv_writer = csv.writer(fid)
+
+    cols = stream_requests[0].keys()
+    csv_writer.writerow(cols)
+    for stream in stream_requests:
+        row = [stream[k] for k in cols]
+        csv_writer.writerow(row)
+
 def dir_from_request_meta(meta):
 
     destination = None
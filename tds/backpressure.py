@@ -0,0 +1,205 @@
+"""
+Server-load-aware pacing of asynchronous request submission.
+
+Sending every request at once lengthens uFrame's processing backlog until its
+throughput collapses.  Our requests in flight are the requests sent to uFrame
+(with a requestUUID) whose product directory does not yet have a status.txt
+reading complete.  InFlightTracker finds them with one scan of
+ASYNC_UFRAME_NC_ROOT per poll and measures the completion latency of each
+request it saw submitted, from submission to the modification time of its
+status.txt.
+
+AIMDController adjusts the number of requests allowed in flight the way TCP
+adjusts its congestion window:
+
+    additive increase       - while completion latencies stay within slowdown
+                              times the baseline latency, the limit grows by
+                              increase for every limit requests completed
+    multiplicative decrease - when the median latency of the completed
+                              requests exceeds slowdown times the baseline, or
+                              nothing completed and most requests still in
+                              flight are older than that, the limit is
+                              multiplied by decrease, at most once per baseline
+                              latency
+
+The baseline is the lowest latency seen, allowed to drift up slowly so that it
+follows uFrame when its unloaded speed changes.  Requests range from days to
+years of data, so a single long request in flight is not taken as congestion:
+ages only count while completions have stalled, and then only their median.
+uFrame is thus kept busy with about as many requests as it completes without
+queueing.
+"""
+
+import os
+import sys
+import time
+from tds.scan import STATUS_FILE, scan_requests
+
+class AIMDController(object):
+    '''Additive increase, multiplicative decrease controller of the number of
+    requests allowed in flight, between minimum and maximum'''
+
+    def __init__(self, limit=4, minimum=1, maximum=50, increase=1.0, decrease=0.5, slowdown=2.0, drift=0.05):
+        self._window = float(min(max(limit, minimum), maximum))
+        self._minimum = minimum
+        self._maximum = maximum
+        self._increase = increase
+        self._decrease = decrease
+        self._slowdown = slowdown
+        self._drift = drift
+        self._baseline = None
+        self._last_decrease = None
+
+    @property
+    def limit(self):
+        '''The number of requests allowed in flight'''
+        return max(self._minimum, int(self._window))
+
+    @property
+    def baseline(self):
+        '''The baseline completion latency, in seconds, or None until a request
+        has completed'''
+        return self._baseline
+
+    def __repr__(self):
+        return '<AIMDController(limit={:d}, baseline={:s})>'.format(self.limit,
+            'None' if self._baseline is None else '{:0.1f}'.format(self._baseline))
+
+    def update(self, latencies, ages=None, now=None):
+        '''Adjust the limit from the completion latencies, in seconds, of the
+        requests completed since the last update and the ages of the requests
+        still in flight.  Returns the new limit'''
+
+        now = time.time() if now is None else now
+
+        if latencies:
+            latency = sorted(latencies)[len(latencies) // 2]
+            if self._baseline is None:
+                self._baseline = latency
+            else:
+                self._baseline = min(latency, self._baseline * (1 + self._drift))
+        if self._baseline is None:
+            return self.limit
+
+        threshold = self._slowdown * self._baseline
+        if latencies:
+            congested = latency > threshold
+        else:
+            # Nothing completed: uFrame has stalled if most of the requests in
+            # flight (the lower median age) are overdue
+            ages = sorted(ages or [])
+            congested = bool(ages) and ages[(len(ages) - 1) // 2] > threshold
+        if congested:
+            # Back off once per baseline latency, so that the requests sent
+            # before the last decrease have a chance to complete
+            if self._last_decrease is None or now - self._last_decrease >= self._baseline:
+                self._window = max(self._minimum, self._window * self._decrease)
+                self._last_decrease = now
+        elif latencies:
+            self._window = min(self._maximum, self._window + self._increase * len(latencies) / self._window)
+
+        return self.limit
+
+class InFlightTracker(object):
+    '''Requests in flight on uFrame, found by scanning their product directories
+    under uframe_nc_root, and the completion latencies of those submitted
+    through submitted()'''
+
+    def __init__(self, uframe_nc_root):
+        self._uframe_nc_root = uframe_nc_root
+        self._submitted = {}
+
+    def submitted(self, request_uuid, when=None):
+        '''Record that request_uuid was sent to uFrame at time when (now by
+        default)'''
+
+        self._submitted[request_uuid] = time.time() if when is None else when
+
+    def _latency(self, request_uuid, now):
+        '''Forget the submission of the completed request_uuid and return its
+        latency, up to the modification time of its status.txt or, if it cannot
+        be read, up to now (None if now is None)'''
+
+        submitted = self._submitted.pop(request_uuid)
+        try:
+            completed = os.stat(os.path.join(self._uframe_nc_root, request_uuid, STATUS_FILE)).st_mtime
+        except OSError:
+            if now is None:
+                return None
+            completed = now
+
+        return max(0.0, completed - submitted)
+
+    def poll(self, records, now=None):
+        '''Check the product directories of the queue records sent to uFrame and
+        not yet published.  Returns the records still in flight, the completion
+        latencies of the requests completed since the last poll and the ages of
+        the requests in flight whose submission time is known'''
+
+        now = time.time() if now is None else now
+        records = [r for r in records if r.get('requestUUID')]
+        indexes = scan_requests(self._uframe_nc_root, [r['requestUUID'] for r in records])
+
+        in_flight = []
+        latencies = []
+        ages = []
+        for record in records:
+            request_uuid = record['requestUUID']
+            index = indexes.get(request_uuid)
+            if not index or not index.is_complete():
+                in_flight.append(record)
+                if request_uuid in self._submitted:
+                    ages.append(now - self._submitted[request_uuid])
+                continue
+            if request_uuid in self._submitted:
+                latencies.append(self._latency(request_uuid, now))
+
+        # Requests published, or given up, between polls are complete too
+        seen = set([r['requestUUID'] for r in records])
+        for request_uuid in [u for u in self._submitted if u not in seen]:
+            latency = self._latency(request_uuid, None)
+            if latency is not None:
+                latencies.append(latency)
+
+        return (in_flight, latencies, ages)
+
+def submit_with_backpressure(records, send, sent, tracker, controller, stop=None, poll_interval=30.0):
+    '''Send the queue records, in order, with send(record), which returns the
+    requestUUID or None, keeping at most controller.limit requests in flight.
+    sent() returns the queue records currently sent to uFrame and not yet
+    published, which tracker checks for completion every poll_interval seconds.
+    Stops early if the threading.Event stop is set.  Returns the records
+    sent'''
+
+    records = list(records)
+    done = []
+    while records:
+
+        (in_flight, latencies, ages) = tracker.poll(sent())
+        limit = controller.update(latencies, ages)
+        available = limit - len(in_flight)
+        if latencies or available > 0:
+            sys.stdout.write('Requests in flight: {:d}/{:d} ({:d} completed, baseline latency {:s} s)\n'.format(len(in_flight),
+                limit,
+                len(latencies),
+                'unknown' if controller.baseline is None else '{:0.1f}'.format(controller.baseline)))
+
+        while available > 0 and records:
+            if stop is not None and stop.is_set():
+                return done
+            record = records.pop(0)
+            request_uuid = send(record)
+            if request_uuid:
+                tracker.submitted(request_uuid)
+                available -= 1
+            done.append(record)
+
+        if not records:
+            break
+        if stop is not None:
+            if stop.wait(poll_interval):
+                break
+        else:
+            time.sleep(poll_interval)
+
+    return done
@@ -0,0 +1,276 @@
+"""
+Incremental THREDDS catalogs for the stream directories under ASYNC_TDS_NC_ROOT.
+
+Stream directories are laid out by tds.dir_from_request_meta as
+
+    <Array>/<platform>/<instrument type>/<telemetry>/<dataset id>/
+
+each holding the timestamped NetCDF files of one stream and their NCML
+aggregation file, <dataset id>.ncml.  The catalog tree mirrors this layout
+under a catalog root: every stream directory gets a catalog.xml containing the
+NCML aggregation dataset (with its size, time coverage and modification time)
+and every directory above it a catalog.xml of catalogRefs to its children.
+
+The mtime of each stream directory changes whenever a file is added, removed
+or replaced in it (publishing renames files into place), so the mtimes are
+recorded in a state file and a refresh only lists, and rewrites the catalogs
+of, the stream directories whose mtime has changed.  Parent catalogs are only
+rewritten when their children are added or removed.  Given the stream
+directories just written by an export (its event log), update_catalogs checks
+only those, without walking the tree at all.  If ASYNC_TDS_NC_ROOT is a list of
+roots (see tds.volumes), the stream directories of all of them are cataloged
+in one tree.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+from tds.scan import scan_dir
+from tds.volumes import split_roots
+
+# Depth, below ASYNC_TDS_NC_ROOT, of the stream directories
+STREAM_DIR_DEPTH = 5
+
+CATALOG_FILE = 'catalog.xml'
+STATE_FILE = '.catalog-state.json'
+
+THREDDS_NS = 'http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+NCML_NS = 'http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2'
+
+# Time coverage in the timestamped file names (see tds.timestamp_nc_file)
+_COVERAGE_REGEXP = re.compile(r'-(\d{8}T\d{6})-(\d{8}T\d{6})\.nc$')
+
+def _escape(value):
+
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+def _iso(timestamp):
+    '''Convert a file name timestamp (YYYYMMDDTHHMMSS) to ISO-8601'''
+
+    return '{:s}-{:s}-{:s}T{:s}:{:s}:{:s}Z'.format(timestamp[0:4], timestamp[4:6], timestamp[6:8], timestamp[9:11], timestamp[11:13], timestamp[13:15])
+
+def _write_atomic(file_path, contents):
+    '''Write contents to file_path through a temporary file, so that THREDDS
+    never reads a partial catalog.  Returns True if the file was written'''
+
+    tmp_file = '{:s}.{:d}.tmp'.format(file_path, os.getpid())
+    try:
+        d = os.path.dirname(file_path)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        with open(tmp_file, 'w') as fid:
+            fid.write(contents)
+        os.rename(tmp_file, file_path)
+    except (IOError, OSError) as e:
+        sys.stderr.write('{:s}: {:s}\n'.format(file_path, e.strerror))
+        return False
+
+    return True
+
+def stream_dataset(stream_dir):
+    '''Return the description of the dataset in stream_dir: its id, NCML file,
+    number and total size of NetCDF files, time coverage and modification
+    time, or None if stream_dir has no NCML aggregation file'''
+
+    dataset_id = os.path.basename(stream_dir.rstrip('/'))
+    ncml_file = os.path.join(stream_dir, '{:s}.ncml'.format(dataset_id))
+
+    nfiles = 0
+    nbytes = 0
+    starts = []
+    ends = []
+    has_ncml = False
+    for entry in scan_dir(stream_dir):
+        if entry.name == os.path.basename(ncml_file):
+            has_ncml = True
+        elif entry.name.endswith('.nc') and not entry.name.startswith('.'):
+            nfiles += 1
+            nbytes += entry.stat().st_size if hasattr(entry, 'stat') else os.path.getsize(entry.path)
+            match = _COVERAGE_REGEXP.search(entry.name)
+            if match:
+                starts.append(match.group(1))
+                ends.append(match.group(2))
+
+    if not has_ncml:
+        return None
+
+    return {'id' : dataset_id,
+        'ncml' : ncml_file,
+        'files' : nfiles,
+        'bytes' : nbytes,
+        'start' : _iso(min(starts)) if starts else None,
+        'end' : _iso(max(ends)) if ends else None,
+        'modified' : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(os.stat(stream_dir).st_mtime))}
+
+def stream_catalog_xml(dataset, rel_path, url_prefix='uframe'):
+    '''Return the catalog XML for the stream dataset (see stream_dataset) at
+    rel_path under ASYNC_TDS_NC_ROOT'''
+
+    url_path = '/'.join([p for p in [url_prefix, rel_path, '{:s}.ncml'.format(dataset['id'])] if p])
+
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+        '<catalog xmlns="{:s}" name="{:s}" version="1.0.1">'.format(THREDDS_NS, _escape(dataset['id'])),
+        '  <service name="agg" serviceType="Compound" base="">',
+        '    <service name="odap" serviceType="OpenDAP" base="/thredds/dodsC/"/>',
+        '    <service name="ncss" serviceType="NetcdfSubset" base="/thredds/ncss/"/>',
+        '  </service>',
+        '  <dataset name="{0:s}" ID="{0:s}" urlPath="{1:s}">'.format(_escape(dataset['id']), _escape(url_path)),
+        '    <serviceName>agg</serviceName>',
+        '    <dataSize units="bytes">{:d}</dataSize>'.format(dataset['bytes']),
+        '    <date type="modified">{:s}</date>'.format(dataset['modified'])]
+    if dataset['start'] and dataset['end']:
+        lines.extend(['    <timeCoverage>',
+            '      <start>{:s}</start>'.format(dataset['start']),
+            '      <end>{:s}</end>'.format(dataset['end']),
+            '    </timeCoverage>'])
+    lines.extend(['    <netcdf xmlns="{:s}" location="{:s}"/>'.format(NCML_NS, _escape(dataset['ncml'])),
+        '  </dataset>',
+        '</catalog>',
+        ''])
+
+    return '\n'.join(lines)
+
+def parent_catalog_xml(name, children):
+    '''Return the catalog XML referencing the catalogs of the child
+    directories children'''
+
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+        '<catalog xmlns="{:s}" xmlns:xlink="{:s}" name="{:s}" version="1.0.1">'.format(THREDDS_NS, XLINK_NS, _escape(name))]
+    for child in sorted(children):
+        lines.append('  <catalogRef xlink:href="{0:s}/{1:s}" xlink:title="{0:s}" name=""/>'.format(_escape(child), CATALOG_FILE))
+    lines.extend(['</catalog>', ''])
+
+    return '\n'.join(lines)
+
+def find_stream_dirs(tds_nc_root):
+    '''Return a dict mapping the path, relative to the root tds_nc_root, of
+    every stream directory to its root and mtime.  Only the directories above
+    the stream directories are listed'''
+
+    level = ['']
+    for depth in range(STREAM_DIR_DEPTH):
+        children = []
+        for rel_path in level:
+            try:
+                entries = scan_dir(os.path.join(tds_nc_root, rel_path))
+            except OSError as e:
+                sys.stderr.write('{:s}: {:s}\n'.format(os.path.join(tds_nc_root, rel_path), e.strerror))
+                continue
+            for entry in entries:
+                if entry.is_dir() and not entry.name.startswith('.'):
+                    children.append((os.path.join(rel_path, entry.name), entry))
+        if depth < STREAM_DIR_DEPTH - 1:
+            level = [c[0] for c in children]
+
+    stream_dirs = {}
+    for (rel_path, entry) in children:
+        try:
+            stream_dirs[rel_path] = [tds_nc_root, os.stat(os.path.join(tds_nc_root, rel_path)).st_mtime]
+        except OSError:
+            continue
+
+    return stream_dirs
+
+def load_state(catalog_root):
+    '''Return the stream directory roots and mtimes recorded by the last update
+    of the catalogs under catalog_root'''
+
+    try:
+        with open(os.path.join(catalog_root, STATE_FILE), 'r') as fid:
+            return json.load(fid)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def _children(stream_paths):
+    '''Return a dict mapping every directory above the stream_paths, relative
+    to ASYNC_TDS_NC_ROOT ('' is the root), to the set of its children'''
+
+    tree = {}
+    for rel_path in stream_paths:
+        parts = rel_path.split(os.sep)
+        for i in range(len(parts)):
+            tree.setdefault(os.sep.join(parts[:i]), set()).add(parts[i])
+
+    return tree
+
+def update_catalogs(tds_nc_root, catalog_root, url_prefix='uframe', stream_dirs=None, force=False):
+    '''Bring the catalogs under catalog_root up to date with the stream
+    directories under tds_nc_root, a root or list of roots.  If stream_dirs, a list of stream directories
+    (e.g. the tds_destination of the requests just exported), is specified,
+    only those are checked.  Otherwise the tree is walked and the catalogs of
+    the stream directories whose mtime has changed are rewritten, and those of
+    removed stream directories deleted.  If force is True, every catalog is
+    rewritten.  Returns the number of stream catalogs written, removed and
+    unchanged and of parent catalogs written'''
+
+    roots = split_roots(tds_nc_root)
+    previous = load_state(catalog_root)
+
+    if stream_dirs is None:
+        current = {}
+        for root in roots:
+            current.update(find_stream_dirs(root))
+    else:
+        current = dict(previous)
+        for stream_dir in stream_dirs:
+            stream_dir = os.path.normpath(stream_dir)
+            root = [r for r in roots if stream_dir.startswith(r + os.sep)]
+            if not root:
+                sys.stderr.write('Not a stream directory under ASYNC_TDS_NC_ROOT: {:s}\n'.format(stream_dir))
+                continue
+            rel_path = os.path.relpath(stream_dir, root[0])
+            try:
+                current[rel_path] = [root[0], os.stat(stream_dir).st_mtime]
+            except OSError:
+                # The stream may have moved to another root
+                if current.get(rel_path, [None])[0] == root[0]:
+                    current.pop(rel_path)
+
+    counts = {'written' : 0, 'removed' : 0, 'unchanged' : 0, 'parents' : 0}
+
+    for rel_path in sorted(current.keys()):
+        if not force and previous.get(rel_path) == current[rel_path]:
+            counts['unchanged'] += 1
+            continue
+        dataset = stream_dataset(os.path.join(current[rel_path][0], rel_path))
+        if not dataset:
+            # No NCML aggregation (yet): check again on the next update
+            current.pop(rel_path)
+            continue
+        if _write_atomic(os.path.join(catalog_root, rel_path, CATALOG_FILE), stream_catalog_xml(dataset, rel_path, url_prefix=url_prefix)):
+            counts['written'] += 1
+        else:
+            current.pop(rel_path)
+
+    for rel_path in previous:
+        if rel_path in current:
+            continue
+        try:
+            os.remove(os.path.join(catalog_root, rel_path, CATALOG_FILE))
+            counts['removed'] += 1
+        except OSError:
+            pass
+
+    # Rewrite the parent catalogs whose children have changed
+    old_tree = _children(previous.keys())
+    new_tree = _children(current.keys())
+    for parent in sorted(set(old_tree.keys()) | set(new_tree.keys())):
+        if not force and old_tree.get(parent) == new_tree.get(parent):
+            continue
+        catalog_file = os.path.join(catalog_root, parent, CATALOG_FILE)
+        if parent not in new_tree:
+            try:
+                os.remove(catalog_file)
+            except OSError:
+                pass
+            continue
+        name = os.path.basename(parent) or 'UFrame THREDDS datasets'
+        if _write_atomic(catalog_file, parent_catalog_xml(name, new_tree[parent])):
+            counts['parents'] += 1
+
+    _write_atomic(os.path.join(catalog_root, STATE_FILE), json.dumps(current, sort_keys=True))
+
+    return counts
@@ -0,0 +1,294 @@
+"""
+Export of completed asynchronous UFrame requests to THREDDS.
+"""
+
+import os
+import sys
+import time
+from tds import find_request_nc_files, dir_from_request_meta, timestamp_nc_file, write_stream_ncml
+from tds.manifest import manifest_path, load_manifest, write_manifest, publish_files
+from tds.queue_store import QUEUED, is_complete
+from tds.scan import ProductIndex, scan_requests
+from tds.volumes import get_volumes
+from tds.timing import stage
+from uframe.ncverify import verify_and_quarantine
+
+def request_is_complete(product_dir):
+    '''Return True if the UFrame request product_dir contains a status.txt
+    file containing the string complete'''
+
+    complete_file = os.path.join(product_dir, 'status.txt')
+    if not os.path.exists(complete_file):
+        return False
+
+    try:
+        with open(complete_file, 'r') as fid:
+            return fid.readline().strip() == 'complete'
+    except IOError:
+        return False
+
+def export_stream_request(stream, uframe_nc_root, tds_nc_root, ncml_template, move=False, delete=False, processes=4, transcode=None, index=None, quarantine_dir=None):
+    '''Timestamp the NetCDF files created for the queued stream request and,
+    if move is True, copy them to the stream destination under tds_nc_root and
+    write the stream NCML aggregation file using ncml_template.  If tds_nc_root
+    is a list of roots (see tds.volumes), the stream destination is on the root
+    already holding the stream or, for a new stream, on the root chosen by
+    tds.volumes.VolumeSet.place.  The reason and
+    tds_destination of stream are updated.  If transcode is specified (see
+    tds.transcode.transcode_copy_function), it is used to rewrite each file as
+    it is published.  index, the tds.scan.ProductIndex of the request product
+    directory, is used instead of scanning the product directory if specified.
+    Files that are not complete NetCDF files (see uframe.ncverify) are not
+    published and, if move is True and quarantine_dir is specified, are moved
+    to quarantine_dir/<requestUUID>.  Returns True if the request is complete and False if it is still in process
+    or failed'''
+
+    if 'tds_destination' not in stream.keys():
+        stream['tds_destination'] = None
+
+    sys.stdout.write('\nProcessing Stream: {:s}-{:s}\n'.format(stream['instrument'], stream['stream']))
+
+    if stream['reason'].find('Complete') == 0:
+        sys.stdout.write('Request already complete and available on thredds: {:s}\n'.format(stream['tds_destination']))
+        return True
+    elif not stream['requestUUID']:
+        sys.stderr.write('Request failed (No requestUUID): {:s}\n'.format(stream['request_url']));
+        stream['reason'] = 'No requestUUID created'
+        return False
+
+    sys.stdout.write('Request: {:s}\n'.format(stream['requestUUID']))
+
+    # A UFrame request is complete when complete_file exists and contains the
+    # string 'complete'.
+    product_dir = os.path.join(uframe_nc_root, stream['requestUUID'])
+    if index is None:
+        with stage('scan'):
+            index = ProductIndex(product_dir)
+    if not index.has_status:
+        sys.stderr.write('Request not completed yet: {:s}\n'.format(stream['request_url']))
+        stream['reason'] = 'In process'
+        return False
+    
+    status = index.status()
+    if status is None:
+        return False
+    if status != 'complete':
+        sys.stderr.write('Request not completed yet: {:s}\n'.format(stream['request_url']))
+        stream['reason'] = 'In process'
+        return False
+    
+    sys.stdout.write('NetCDF Source Directory: {:s}\n'.format(product_dir))
+    nc_files = find_request_nc_files(product_dir, stream['stream'], index=index)
+            
+    if not nc_files:
+#        sys.stderr.write('No NetCDF product files found: {:s}\n'.format(product_dir))
+        sys.stderr.write('No NetCDF files found\n')
+        stream['reason'] = 'No NetCDF files found'
+        return False
+
+    # A truncated or corrupt file would break the aggregation of the whole
+    # stream
+    request_quarantine = os.path.join(quarantine_dir, stream['requestUUID']) if move and quarantine_dir else None
+    with stage('verify'):
+        nc_files = verify_and_quarantine(nc_files, quarantine_dir=request_quarantine, processes=processes)
+    if not nc_files:
+        sys.stderr.write('No valid NetCDF files found\n')
+        stream['reason'] = 'No valid NetCDF files found'
+        return False
+        
+    # Create the name of the stream destination directory
+    destination = dir_from_request_meta(stream)
+    if not destination:
+        sys.stderr.write('Cannot determine stream destination\n')
+        return False
+    
+    # See if the fully qualified NetCDF stream destination directory needs to be created    
+    stream_destination = os.path.join(get_volumes(tds_nc_root).place(destination, record=move), destination)
+    sys.stdout.write('NetCDF TDS Destination : {:s}\n'.format(stream_destination))
+   
+    # Add the tds_destination
+    stream['tds_destination'] = stream_destination
+
+    #NCML
+    ncml_destination = stream_destination
+    sys.stdout.write('NCML file destination  : {:s}\n'.format(ncml_destination))
+    if not os.path.exists(stream_destination):
+        
+        if  not move:
+            sys.stdout.write('DEBUG> Skipping creation of stream destination\n')
+        else:
+            sys.stdout.write('Creating stream destination: {:s}\n'.format(stream_destination))
+            try:
+                os.makedirs(stream_destination)
+            except OSError as e:
+                sys.stderr.write('{:s}\n'.format(e.strerror))
+                return False
+    
+    # See if the fully qualified NCML destination directory needs to be created    
+    if not os.path.exists(ncml_destination):
+        
+        if not move:
+            sys.stdout.write('DEBUG> Skipping creation of NCML destination\n')
+        else:
+            sys.stdout.write('Creating stream destination: {:s}\n'.format(ncml_destination))
+            try:
+                os.makedirs(ncml_destination)
+            except OSError as e:
+                sys.stderr.write('{:s}\n'.format(e.strerror))
+                return False
+                
+    # Write the NCML aggregation file using ncml_template        
+    dataset_id = '{:s}-{:s}-{:s}'.format(
+        stream['instrument'],
+        stream['stream'],
+        stream['telemetry'])
+    
+    ncml_file = os.path.join(ncml_destination, '{:s}.ncml'.format(dataset_id))
+    sys.stdout.write('NCML aggregation file: {:s}\n'.format(os.path.split(ncml_file)[1]))
+    # Write the NCML file, using ncml_template, if it doesn't already exist
+    if not os.path.exists(ncml_file):
+        
+        if not move:
+            sys.stdout.write('DEBUG> Skipping NCML aggregation file creation\n')
+        else:
+            sys.stdout.write('Writing NCML aggregation file: {:s}\n'.format(ncml_file))
+            with stage('write_ncml'):
+                if not write_stream_ncml(ncml_template, ncml_file, dataset_id, stream_destination):
+                    return False
+    
+    #sys.stdout.write('Stopping before we do any damage')
+    #continue
+        
+    # Rename the files and move them to tds_nc_root
+    ts_nc_files = []
+    publish_pairs = []
+    for nc_file in nc_files:
+
+        (nc_path, nc_filename) = os.path.split(nc_file)
+        sys.stdout.write('UFrame NetCDF : {:s}/{:s}\n'.format(os.path.split(nc_path)[-1], nc_filename))
+
+        # Timestamp the file but do not prepend a destination directory
+        with stage('timestamp'):
+            ts_nc_file = timestamp_nc_file(nc_file, dest_dir=None)
+        if not ts_nc_file:
+            sys.stderr.write('Failed to timestamp UFrame NetCDF file: {:s}\n'.format(nc_file))
+            continue
+        
+        sys.stdout.write('THREDDS NetCDF: {:s}\n'.format(ts_nc_file))
+        # Create the NetCDF destination file        
+        tds_nc_file = os.path.join(stream_destination, ts_nc_file)
+        ts_nc_files.append(tds_nc_file)
+
+        publish_pairs.append((nc_file, tds_nc_file))
+
+    # Skip moving the files if in debug mode, but tell me what the new
+    # filenames are
+    if move and publish_pairs:
+        # Copy the files, skipping any that were already published from
+        # byte-identical UFrame files, and update the stream manifest
+        stream_manifest_file = manifest_path(stream_destination)
+        stream_manifest = load_manifest(stream_manifest_file)
+        with stage('copy'):
+            if transcode:
+                published = publish_files(publish_pairs, stream_manifest, processes=processes, copy_function=transcode, verbatim=False)
+            else:
+                published = publish_files(publish_pairs, stream_manifest, processes=processes)
+        for (nc_file, tds_nc_file, action) in published:
+            if action == 'skipped':
+                sys.stdout.write('Unchanged NetCDF file    : {:s}\n'.format(tds_nc_file))
+            elif action == 'failed':
+                sys.stderr.write('Failed to copy UFrame NetCDF file: {:s}\n'.format(nc_file))
+            else:
+                sys.stdout.write('Moving UFrame NetCDF file: {:s}\n'.format(nc_file))
+                sys.stdout.write('Timestamp NetCDF file    : {:s} ({:s})\n'.format(os.path.basename(tds_nc_file), action))
+        with stage('write_manifest'):
+            write_manifest(stream_manifest, stream_manifest_file)
+ 
+    ts_nc_files.sort()
+    sys.stdout.write('Found {:d} files\n'.format(len(ts_nc_files)))
+    for ts_nc_file in ts_nc_files:
+        (ts_nc_dir, ts_nc_name) = os.path.split(ts_nc_file)
+        sys.stdout.write('Timestamp NetCDF File: {:s}\n'.format(ts_nc_name))
+
+    # Mark the request as complete if we've moved at least one NetCDF file
+    # to stream_destination
+    stream['reason'] = 'Complete'
+
+    if delete:
+        sys.stdout.write('Deleting UFrame product destination: {:s}\n'.format(product_dir))
+        try:
+            os.rmdir(product_dir)
+        except OSError as e:
+            sys.stderr.write('Failed to delete UFrame product destination: {:s} (Reason: {:s})\n'.format(product_dir, e.strerror))
+            sys.stderr.flush()
+            return True
+
+    return True
+
+def lease_key(stream):
+    '''Return the lease key of the queued stream request: its stream
+    destination, so that requests publishing to the same THREDDS dataset (and
+    manifest and NCML file) are exported one at a time, or its request_url if
+    the destination cannot be determined'''
+
+    return dir_from_request_meta(stream) or stream['request_url']
+
+def drain_requests(store, leases, uframe_nc_root, tds_nc_root, ncml_template, urls=None, delete=False, processes=4, transcode=None, poll_interval=5.0, quarantine_dir=None):
+    '''Export the pending requests in the queue store to THREDDS, claiming the
+    stream destination of each with a lease from leases (a tds.lease.LeaseDir)
+    so that any number of workers, on one host or several sharing the store and
+    lease directory, can drain the store at the same time.  Requests queued but
+    not yet sent to UFrame are skipped and, if urls is specified, only requests
+    whose request_url is in urls are exported.  Requests leased by other
+    workers are retried, every poll_interval seconds, until every request has
+    been tried once.  Invalid NetCDF files are moved to quarantine_dir, if
+    specified.  Returns the list of requests exported and marked
+    complete'''
+
+    tried = set()
+    exported = []
+    while True:
+
+        busy = 0
+        streams = [r for r in store.pending() if r['request_url'] not in tried and r['reason'] != QUEUED]
+        if urls is not None:
+            streams = [r for r in streams if r['request_url'] in urls]
+        # Scan the product directories of all the requests at once
+        with stage('scan'):
+            indexes = scan_requests(uframe_nc_root, [r['requestUUID'] for r in streams])
+
+        for stream in streams:
+
+            lease = leases.acquire(lease_key(stream))
+            if not lease:
+                busy += 1
+                continue
+
+            with lease:
+                tried.add(stream['request_url'])
+                # Another worker may have exported the request since the
+                # pending requests were read
+                stream = store.get(stream['request_url'])
+                if not stream or is_complete(stream):
+                    continue
+
+                complete = export_stream_request(stream,
+                    uframe_nc_root,
+                    tds_nc_root,
+                    ncml_template,
+                    move=True,
+                    delete=delete,
+                    processes=processes,
+                    transcode=transcode,
+                    index=indexes.get(stream['requestUUID']),
+                    quarantine_dir=quarantine_dir)
+                with stage('write_queue'):
+                    store.update(stream)
+                if complete:
+                    exported.append(stream)
+
+        if not busy:
+            break
+        time.sleep(poll_interval)
+
+    return exported
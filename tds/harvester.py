@@ -0,0 +1,298 @@
+"""
+Pipeline stages of the long-running UFrame to THREDDS harvester.
+
+The prepare stage periodically compares the master stream files to the known
+streams and queues asynchronous requests for new (and, optionally, updated)
+streams, the submit stage sends the queued requests to UFrame, without
+exceeding the maximum number of requests in flight, and the export stage
+publishes each request to THREDDS as soon as UFrame marks it complete.  The
+stages run in separate threads linked by a bounded work queue and share one
+HarvesterState, whose requests are kept in a journaled QueueStore so that the
+harvester resumes where it left off after a restart.
+
+Errors a stage can recover from (I/O errors, a locked queue store, failed
+UFrame requests) are reported and the stage carries on with its next
+iteration.  Any other error stops the harvester (see run_stage) rather than
+leaving it running without the stage.
+"""
+
+import os
+import sys
+import sqlite3
+import threading
+import traceback
+import requests
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from uframe import send_async_request
+from tds import csv2json, find_new_streams, find_updated_streams, merge_streams, write_streams_to_csv, build_async_query_from_stream_meta
+from tds.scheduler import parse_async_url
+from tds.export import export_stream_request, lease_key
+from tds.scan import scan_requests
+from tds.queue_store import QUEUED, is_complete
+
+# Queue csv reason of requests sent to UFrame
+IN_PROCESS = 'In process'
+
+# Errors after which a stage carries on with its next iteration
+STAGE_ERRORS = (IOError, OSError, sqlite3.Error, requests.RequestException)
+
+def known_streams_file(known_streams_root, master_streams_file):
+    '''Return the name of the known streams file for master_streams_file, as
+    created by prepare_uframe_tds_requests.py'''
+
+    fn = os.path.basename(master_streams_file)
+    return os.path.join(known_streams_root, '{:s}-known-meta.csv'.format(fn.split('-')[0]))
+
+def queue_record(url):
+    '''Create a queue csv record for the asynchronous request url'''
+
+    r = parse_async_url(url)
+    if not r:
+        return None
+
+    return {'instrument' : r['instrument'],
+        'stream' : r['stream'],
+        'telemetry' : r['method'],
+        'reason' : QUEUED,
+        'requestUUID' : '',
+        'request_url' : r['request_url'],
+        'tds_destination' : ''}
+
+class HarvesterState(object):
+    '''Known streams, by master stream file, and queued requests shared by the
+    harvester stages.  Requests are kept in a QueueStore, which records each
+    status change as it happens, and the known streams are saved to their known
+    streams files each time they change'''
+
+    def __init__(self, store, known_streams_root):
+        self._store = store
+        self._known_streams_root = known_streams_root
+        self._known = {}
+        self._lock = threading.RLock()
+
+    @property
+    def store(self):
+        return self._store
+
+    def known_streams(self, master_streams_file):
+        '''Return the known streams for master_streams_file, loading them from
+        the known streams file the first time'''
+
+        with self._lock:
+            if master_streams_file not in self._known:
+                known_file = known_streams_file(self._known_streams_root, master_streams_file)
+                self._known[master_streams_file] = csv2json(known_file) if os.path.exists(known_file) else []
+            return self._known[master_streams_file]
+
+    def save_known_streams(self, master_streams_file):
+
+        with self._lock:
+            streams = self._known.get(master_streams_file)
+            if not streams:
+                return
+            known_file = known_streams_file(self._known_streams_root, master_streams_file)
+            tmp_file = '{:s}.tmp'.format(known_file)
+            write_streams_to_csv(streams, tmp_file)
+            os.rename(tmp_file, known_file)
+
+    def add_requests(self, records):
+        '''Add the queue records that are not already in the store and return
+        them.  Requests already queued, sent or published are left as they
+        are, so that they are never sent twice'''
+
+        with self._lock:
+            records = [r for r in records if not self._store.get(r['request_url'])]
+            self._store.add(records)
+
+        return records
+
+    def requests(self, reason=None):
+        '''Return the pending requests, or those whose reason is reason'''
+
+        return self._store.pending(reason)
+
+    def in_flight(self):
+        '''Return the requests that have been sent to UFrame but have not been
+        published to THREDDS.  Requests that completed without any NetCDF files
+        are not counted'''
+
+        return [r for r in self._store.pending(IN_PROCESS) if r['requestUUID']]
+
+    def update_request(self, record, **kwargs):
+
+        record.update(kwargs)
+        self._store.update(record)
+
+def prepare_requests(state, master_streams_file, uframe_base, user=None, update=False):
+    '''Queue asynchronous requests for the new (and, if update is True,
+    updated) streams in master_streams_file and return their queue records'''
+
+    master_streams = csv2json(master_streams_file)
+    if not master_streams:
+        sys.stderr.write('No streams found: {:s}\n'.format(master_streams_file))
+        return []
+
+    known_streams = state.known_streams(master_streams_file)
+    new_streams = find_new_streams(master_streams, known_streams)
+    if update and known_streams:
+        new_streams.extend(find_updated_streams(known_streams, uframe_base))
+    if not new_streams:
+        return []
+
+    sys.stdout.write('{:s}: {:d} new or updated streams\n'.format(master_streams_file, len(new_streams)))
+    records = [queue_record(url) for url in build_async_query_from_stream_meta(uframe_base, new_streams, user=user)]
+    records = [r for r in records if r]
+
+    # Save the requests before the known streams so that no request is lost if
+    # the harvester is stopped in between
+    records = state.add_requests(records)
+    merge_streams(known_streams, new_streams)
+    state.save_known_streams(master_streams_file)
+
+    return records
+
+def prepare_stage(state, master_streams_files, uframe_base, work_queue, stop, user=None, update=False, interval=3600.0):
+    '''Queue asynchronous requests for new streams in master_streams_files every
+    interval seconds.  Requests waiting to be sent when the harvester was
+    stopped are queued first'''
+
+    pending = state.requests(QUEUED)
+    while not stop.is_set():
+
+        # Check for new and updated streams against the current inventory
+        uframe_base.cache.invalidate()
+
+        for master_streams_file in master_streams_files:
+
+            if stop.is_set():
+                break
+
+            try:
+                pending.extend(prepare_requests(state, master_streams_file, uframe_base, user=user, update=update))
+            except STAGE_ERRORS as e:
+                sys.stderr.write('Prepare stage error ({:s}): {:s}\n'.format(master_streams_file, str(e)))
+
+        # Blocks while the submit stage is behind
+        while pending and not stop.is_set():
+            try:
+                work_queue.put(pending[0], timeout=1.0)
+                pending.pop(0)
+            except queue.Full:
+                continue
+
+        stop.wait(interval)
+
+def submit_stage(state, uframe_base, work_queue, stop, max_in_flight=20, poll_interval=60.0, controller=None, tracker=None):
+    '''Send queued requests to UFrame, waiting while max_in_flight requests are
+    in flight.  If controller (a tds.backpressure.AIMDController) and tracker
+    (a tds.backpressure.InFlightTracker) are specified, requests are in flight
+    until UFrame marks them complete and the limit is set by controller from
+    the completion latencies'''
+
+    record = None
+    while not stop.is_set():
+
+        if record is None:
+            try:
+                record = work_queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+        try:
+            if controller is not None:
+                while not stop.is_set():
+                    (in_flight, latencies, ages) = tracker.poll(state.in_flight())
+                    if len(in_flight) < controller.update(latencies, ages):
+                        break
+                    stop.wait(poll_interval)
+            else:
+                while len(state.in_flight()) >= max_in_flight and not stop.is_set():
+                    stop.wait(poll_interval)
+        except STAGE_ERRORS as e:
+            # Keep the record and check the requests in flight again
+            sys.stderr.write('Submit stage error: {:s}\n'.format(str(e)))
+            stop.wait(poll_interval)
+            continue
+        if stop.is_set():
+            break
+
+        sys.stdout.write('Sending request: {:s}\n'.format(record['request_url']))
+        request_uuid = send_async_request(record['request_url'], uframe_base)
+        try:
+            if request_uuid:
+                state.update_request(record, requestUUID=request_uuid, reason=IN_PROCESS)
+                if tracker is not None:
+                    tracker.submitted(request_uuid)
+            else:
+                state.update_request(record, reason='No requestUUID created')
+        except STAGE_ERRORS as e:
+            # The request was sent: it must not be sent again
+            sys.stderr.write('Failed to record request {:s} ({:s}): {:s}\n'.format(str(request_uuid), str(e), record['request_url']))
+        record = None
+
+def export_stage(state, uframe_nc_root, tds_nc_root, ncml_template, leases, stop, move=True, delete=False, processes=4, poll_interval=60.0, quarantine_dir=None):
+    '''Publish in flight requests to THREDDS as soon as they are complete.  The
+    stream destination of each is claimed with a lease from leases (a
+    tds.lease.LeaseDir), as by tds.export.drain_requests, so that the harvester
+    and export workers sharing the queue store never publish to the same stream
+    at once.  Invalid NetCDF files are moved to quarantine_dir, if specified'''
+
+    while not stop.is_set():
+
+        try:
+            records = state.in_flight()
+            # One scan of the product directories of all the in flight requests
+            indexes = scan_requests(uframe_nc_root, [r['requestUUID'] for r in records])
+        except STAGE_ERRORS as e:
+            sys.stderr.write('Export stage error: {:s}\n'.format(str(e)))
+            stop.wait(poll_interval)
+            continue
+
+        for record in records:
+            if stop.is_set():
+                break
+            index = indexes[record['requestUUID']]
+            if not index.is_complete():
+                continue
+            try:
+                # Streams leased by an export worker are retried on the next
+                # poll
+                lease = leases.acquire(lease_key(record))
+                if not lease:
+                    continue
+                with lease:
+                    # The request may have been exported since it was read
+                    record = state.store.get(record['request_url'])
+                    if not record or is_complete(record):
+                        continue
+                    export_stream_request(record,
+                        uframe_nc_root,
+                        tds_nc_root,
+                        ncml_template,
+                        move=move,
+                        delete=delete,
+                        processes=processes,
+                        index=index,
+                        quarantine_dir=quarantine_dir)
+                    state.update_request(record)
+            except STAGE_ERRORS as e:
+                # Retried on the next poll
+                sys.stderr.write('Failed to export {:s}: {:s}\n'.format(record['request_url'], str(e)))
+
+        stop.wait(poll_interval)
+
+def run_stage(stage, stop, failed, *args, **kwargs):
+    '''Run the harvester stage with args and kwargs.  If it raises an error,
+    the traceback is reported and the threading.Events failed and stop are set,
+    so that the harvester exits instead of running without the stage'''
+
+    try:
+        stage(*args, **kwargs)
+    except Exception:
+        sys.stderr.write('Harvester stage {:s} failed:\n{:s}'.format(stage.__name__, traceback.format_exc()))
+        sys.stderr.flush()
+        failed.set()
+        stop.set()
@@ -0,0 +1,186 @@
+"""
+Leases claiming queued requests for one export worker at a time.
+
+A lease is a file in a shared lease directory created with O_CREAT | O_EXCL,
+which is atomic on local filesystems and NFS (v3 and later) alike, so that
+workers on one host or on several hosts sharing the directory never hold the
+same lease.  The file records the host and pid of its holder and its mtime is
+renewed by a heartbeat while the lease is held.  A lease whose holder has
+exited (on the same host) or whose mtime is older than ttl seconds (holder on
+another host stopped renewing it) is stale and is broken by renaming it
+aside, which only one of several competing workers can do.
+"""
+
+import os
+import sys
+import time
+import errno
+import socket
+import hashlib
+import threading
+
+class Lease(object):
+    '''A held lease.  Released by release() or on leaving a with block'''
+
+    def __init__(self, lease_file, key, heartbeat=None):
+        self._lease_file = lease_file
+        self._key = key
+        self._released = threading.Event()
+        self._thread = None
+        if heartbeat:
+            self._thread = threading.Thread(target=self._renew_every, args=(heartbeat,))
+            self._thread.daemon = True
+            self._thread.start()
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def lease_file(self):
+        return self._lease_file
+
+    def renew(self):
+        '''Reset the age of the lease'''
+
+        try:
+            os.utime(self._lease_file, None)
+        except OSError as e:
+            sys.stderr.write('Failed to renew lease {:s}: {:s}\n'.format(self._key, e.strerror))
+
+    def _renew_every(self, interval):
+        while not self._released.wait(interval):
+            self.renew()
+
+    def release(self):
+
+        if self._released.is_set():
+            return
+        self._released.set()
+        try:
+            os.remove(self._lease_file)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                sys.stderr.write('Failed to release lease {:s}: {:s}\n'.format(self._key, e.strerror))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+class LeaseDir(object):
+    '''Directory of lease files.  Leases not renewed for ttl seconds are stale'''
+
+    def __init__(self, lease_root, ttl=3600.0):
+        self._lease_root = lease_root
+        self._ttl = ttl
+        self._host = socket.gethostname()
+        if not os.path.isdir(lease_root):
+            try:
+                os.makedirs(lease_root)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    @property
+    def lease_root(self):
+        return self._lease_root
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    def lease_file(self, key):
+        '''Return the lease file for key'''
+
+        return os.path.join(self._lease_root, '{:s}.lease'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+    def acquire(self, key):
+        '''Return a Lease on key, renewed every ttl / 4 seconds until released,
+        or None if key is leased by another worker'''
+
+        lease_file = self.lease_file(key)
+        for attempt in range(2):
+            try:
+                fd = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                if attempt or not self._break_stale(lease_file):
+                    return None
+                continue
+            try:
+                os.write(fd, '{:s} {:d} {:s}\n'.format(self._host, os.getpid(), key).encode('utf-8'))
+            finally:
+                os.close(fd)
+            return Lease(lease_file, key, heartbeat=self._ttl / 4.0)
+
+        return None
+
+    def holder(self, lease_file):
+        '''Return the (host, pid) of the holder of lease_file, or None if it
+        cannot be read'''
+
+        try:
+            with open(lease_file, 'r') as fid:
+                tokens = fid.readline().split()
+            return (tokens[0], int(tokens[1]))
+        except (IOError, OSError, IndexError, ValueError):
+            return None
+
+    def is_stale(self, lease_file):
+        '''Return True if the holder of lease_file has exited or stopped renewing
+        it'''
+
+        return self._stale_inode(lease_file) is not None
+
+    def _stale_inode(self, lease_file):
+        '''Return the inode of lease_file if it is stale, None otherwise'''
+
+        try:
+            st = os.stat(lease_file)
+        except OSError:
+            return None
+        if time.time() - st.st_mtime > self._ttl:
+            return st.st_ino
+
+        holder = self.holder(lease_file)
+        if not holder or holder[0] != self._host:
+            return None
+        try:
+            os.kill(holder[1], 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return st.st_ino
+
+        return None
+
+    def _break_stale(self, lease_file):
+        '''Remove lease_file if it is stale.  Returns True if it was removed'''
+
+        inode = self._stale_inode(lease_file)
+        if inode is None:
+            return False
+
+        stale_file = '{:s}.{:s}.{:d}.stale'.format(lease_file, self._host, os.getpid())
+        try:
+            os.rename(lease_file, stale_file)
+        except OSError:
+            # Broken, or released, by another worker
+            return not os.path.exists(lease_file)
+
+        if os.stat(stale_file).st_ino != inode:
+            # Another worker broke the stale lease and acquired a new one
+            # between the check and the rename: put it back
+            try:
+                os.link(stale_file, lease_file)
+            except OSError:
+                pass
+            os.remove(stale_file)
+            return False
+
+        sys.stderr.write('Broke stale lease: {:s}\n'.format(lease_file))
+        os.remove(stale_file)
+
+        return True
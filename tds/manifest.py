@@ -0,0 +1,298 @@
+"""
+Content-hash manifests for THREDDS stream directories.
+
+Each stream destination directory (see tds.dir_from_request_meta) may contain a
+<dataset_id>.manifest.csv file, written next to the stream NCML aggregation
+file, recording the size, modification time and SHA-1 hash of every file in the
+directory along with the hash of the source file it was published from.  The
+manifest is used to skip publishing byte-identical files, to replace files
+whose contents have changed and to verify the integrity of the archive.
+"""
+
+import os
+import sys
+import csv
+import shutil
+import hashlib
+import tempfile
+
+MANIFEST_SUFFIX = '.manifest.csv'
+MANIFEST_COLUMNS = ['filename',
+    'size',
+    'mtime',
+    'sha1',
+    'source_sha1']
+
+# Files are hashed in 1 MB chunks so that memory use is independent of the size
+# of the file
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+def manifest_path(stream_dir):
+    '''Return the fully qualified path to the manifest file for the specified
+    stream destination directory'''
+
+    stream_dir = stream_dir.rstrip('/')
+
+    return os.path.join(stream_dir, '{:s}{:s}'.format(os.path.basename(stream_dir), MANIFEST_SUFFIX))
+
+def hash_file(file_path):
+    '''Return the SHA-1 hex digest of file_path, reading the file in fixed size
+    chunks.  Returns None if the file cannot be read'''
+
+    sha1 = hashlib.sha1()
+    try:
+        with open(file_path, 'rb') as fid:
+            while True:
+                chunk = fid.read(_HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha1.update(chunk)
+    except IOError as e:
+        sys.stderr.write('{:s}: {:s}\n'.format(e.strerror, file_path))
+        return None
+
+    return sha1.hexdigest()
+
+def hash_files(file_paths, processes=4):
+    '''Hash each file in file_paths in parallel.  Returns a dict mapping each
+    file to its SHA-1 hex digest (None if the file could not be read)'''
+
+    if not file_paths:
+        return {}
+
+    if processes < 2 or len(file_paths) == 1:
+        return {f:hash_file(f) for f in file_paths}
+
+    # hashlib releases the GIL while digesting large buffers, so threads are
+    # sufficient to keep multiple disks/cores busy
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(processes, len(file_paths)))
+    try:
+        digests = pool.map(hash_file, file_paths)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(zip(file_paths, digests))
+
+def load_manifest(manifest_file):
+    '''Load manifest_file and return a dict, keyed by filename, of manifest
+    entries.  An empty dict is returned if the manifest does not exist'''
+
+    manifest = {}
+
+    if not os.path.exists(manifest_file):
+        return manifest
+
+    try:
+        fid = open(manifest_file, 'r')
+    except IOError as e:
+        sys.stderr.write('{:s}: {:s}\n'.format(manifest_file, e.strerror))
+        return manifest
+
+    for entry in csv.DictReader(fid):
+        try:
+            entry['size'] = int(entry['size'])
+            entry['mtime'] = float(entry['mtime'])
+        except (KeyError, TypeError, ValueError):
+            sys.stderr.write('{:s}: Invalid manifest entry: {:s}\n'.format(manifest_file, str(entry)))
+            continue
+        manifest[entry['filename']] = entry
+
+    fid.close()
+
+    return manifest
+
+def write_manifest(manifest, manifest_file):
+    '''Write the manifest entries to manifest_file.  The manifest is written to a
+    temporary file which is then renamed so that an interrupted write never
+    leaves a truncated manifest behind.  Returns True on success'''
+
+    (manifest_dir, manifest_name) = os.path.split(manifest_file)
+    try:
+        (fd, tmp_file) = tempfile.mkstemp(prefix='.{:s}.'.format(manifest_name), dir=manifest_dir)
+    except OSError as e:
+        sys.stderr.write('{:s}: {:s}\n'.format(e.strerror, manifest_file))
+        return False
+
+    with os.fdopen(fd, 'w') as fid:
+        csv_writer = csv.writer(fid)
+        csv_writer.writerow(MANIFEST_COLUMNS)
+        for filename in sorted(manifest.keys()):
+            entry = manifest[filename]
+            csv_writer.writerow([filename,
+                entry['size'],
+                '{:.3f}'.format(entry['mtime']),
+                entry['sha1'],
+                entry['source_sha1']])
+
+    try:
+        os.rename(tmp_file, manifest_file)
+    except OSError as e:
+        sys.stderr.write('{:s}: {:s}\n'.format(e.strerror, manifest_file))
+        os.remove(tmp_file)
+        return False
+
+    return True
+
+def entry_is_current(entry, file_path):
+    '''Return True if the size and modification time of file_path match the
+    manifest entry, meaning the recorded hash can be trusted without re-reading
+    the file'''
+
+    if not entry:
+        return False
+
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return False
+
+    return stat.st_size == entry['size'] and abs(stat.st_mtime - entry['mtime']) < 0.001
+
+def stream_files(stream_dir):
+    '''Return the sorted list of files, excluding the manifest itself, contained
+    in stream_dir'''
+
+    manifest_name = os.path.basename(manifest_path(stream_dir))
+
+    return sorted([f for f in os.listdir(stream_dir)
+        if f != manifest_name and not f.startswith('.') and os.path.isfile(os.path.join(stream_dir, f))])
+
+def update_manifest(stream_dir, processes=4):
+    '''Bring the manifest for stream_dir up to date with the files on disk.
+    Only new files and files whose size or modification time has changed are
+    re-hashed.  The updated manifest is written and returned'''
+
+    manifest_file = manifest_path(stream_dir)
+    manifest = load_manifest(manifest_file)
+
+    files = stream_files(stream_dir)
+    stale = [os.path.join(stream_dir, f) for f in files
+        if not entry_is_current(manifest.get(f), os.path.join(stream_dir, f))]
+
+    digests = hash_files(stale, processes=processes)
+    for (file_path, digest) in digests.items():
+        if not digest:
+            continue
+        stat = os.stat(file_path)
+        filename = os.path.basename(file_path)
+        # Files not published through the manifest are their own source
+        source_sha1 = digest
+        if filename in manifest and manifest[filename]['sha1'] == digest:
+            source_sha1 = manifest[filename]['source_sha1']
+        manifest[filename] = {'filename' : filename,
+            'size' : stat.st_size,
+            'mtime' : stat.st_mtime,
+            'sha1' : digest,
+            'source_sha1' : source_sha1}
+
+    # Drop entries for files that no longer exist
+    for filename in list(manifest.keys()):
+        if filename not in files:
+            del manifest[filename]
+
+    write_manifest(manifest, manifest_file)
+
+    return manifest
+
+def verify_manifest(stream_dir, full=False, processes=4):
+    '''Compare the files in stream_dir to the stream manifest.  Files whose size
+    and modification time match the manifest are trusted unless full is True, in
+    which case every file is re-hashed.  Returns a list of (filename, problem)
+    tuples, where problem is one of missing, modified, changed or untracked'''
+
+    problems = []
+
+    manifest_file = manifest_path(stream_dir)
+    if not os.path.exists(manifest_file):
+        return [(os.path.basename(manifest_file), 'missing')]
+
+    manifest = load_manifest(manifest_file)
+    files = stream_files(stream_dir)
+
+    for filename in sorted(manifest.keys()):
+        if filename not in files:
+            problems.append((filename, 'missing'))
+
+    to_hash = []
+    for filename in files:
+        file_path = os.path.join(stream_dir, filename)
+        if filename not in manifest:
+            problems.append((filename, 'untracked'))
+        elif full or not entry_is_current(manifest[filename], file_path):
+            to_hash.append(file_path)
+
+    digests = hash_files(to_hash, processes=processes)
+    for file_path in to_hash:
+        filename = os.path.basename(file_path)
+        if digests[file_path] != manifest[filename]['sha1']:
+            problems.append((filename, 'modified'))
+        elif not entry_is_current(manifest[filename], file_path):
+            # Same contents, but touched since the manifest was written
+            problems.append((filename, 'changed'))
+
+    return problems
+
+def publish_files(file_pairs, manifest, source_manifest=None, processes=4, copy_function=shutil.copyfile, verbatim=True):
+    '''Publish each (source, destination) file pair, using manifest, the dict of
+    entries for the destination stream directory, to skip destination files that
+    were published from byte-identical sources.  Changed files are replaced and
+    new files are copied.  If source_manifest is specified, source hashes are
+    taken from it whenever the source size and modification time are unchanged.
+    Files are written to a temporary name and renamed into place so that THREDDS
+    never sees a partially written file.  If verbatim is False, copy_function
+    transforms the source and the published file is hashed separately.
+
+    manifest is updated in place.  Returns a list of (source, destination,
+    action) tuples, where action is one of skipped, replaced, copied or failed'''
+
+    results = []
+
+    # Hash the sources, re-using source manifest hashes where possible
+    source_hashes = {}
+    to_hash = []
+    for (src, dest) in file_pairs:
+        src_name = os.path.basename(src)
+        if source_manifest and entry_is_current(source_manifest.get(src_name), src):
+            source_hashes[src] = source_manifest[src_name]['sha1']
+        else:
+            to_hash.append(src)
+    source_hashes.update(hash_files(to_hash, processes=processes))
+
+    for (src, dest) in file_pairs:
+
+        filename = os.path.basename(dest)
+        source_sha1 = source_hashes.get(src)
+        if not source_sha1:
+            results.append((src, dest, 'failed'))
+            continue
+
+        entry = manifest.get(filename)
+        if entry and entry['source_sha1'] == source_sha1 and entry_is_current(entry, dest):
+            results.append((src, dest, 'skipped'))
+            continue
+
+        action = 'replaced' if os.path.exists(dest) else 'copied'
+
+        (dest_dir, dest_name) = os.path.split(dest)
+        tmp_file = os.path.join(dest_dir, '.{:s}.tmp'.format(dest_name))
+        try:
+            copy_function(src, tmp_file)
+            os.rename(tmp_file, dest)
+        except (IOError, OSError) as e:
+            sys.stderr.write('{:s}: {:s}\n'.format(e.strerror, dest))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            results.append((src, dest, 'failed'))
+            continue
+
+        stat = os.stat(dest)
+        manifest[filename] = {'filename' : filename,
+            'size' : stat.st_size,
+            'mtime' : stat.st_mtime,
+            'sha1' : source_sha1 if verbatim else hash_file(dest),
+            'source_sha1' : source_sha1}
+        results.append((src, dest, action))
+
+    return results
@@ -0,0 +1,165 @@
+"""
+Journaled store of asynchronous UFrame request status.
+
+Queue records (instrument, stream, telemetry, reason, requestUUID, request_url
+and tds_destination, as written to the queue csv files) are kept in a sqlite
+database in write-ahead log mode, keyed on request_url.  Each status change is
+written as a single committed transaction, so updates cost the same no matter
+how many requests have been made, a crash never loses the queue, and the
+requests that are not yet complete are found with an index instead of reading
+the whole request history.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import threading
+
+QUEUE_COLUMNS = ['instrument',
+    'stream',
+    'telemetry',
+    'reason',
+    'requestUUID',
+    'request_url',
+    'tds_destination']
+
+# Reason of requests waiting to be sent to UFrame
+QUEUED = 'Queued'
+
+# Default store, relative to ASYNC_DATA_HOME
+DEFAULT_STORE = os.path.join('stream-queue', 'queue.db')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS requests (
+    request_url TEXT PRIMARY KEY,
+    instrument TEXT,
+    stream TEXT,
+    telemetry TEXT,
+    reason TEXT,
+    requestUUID TEXT,
+    tds_destination TEXT,
+    complete INTEGER NOT NULL DEFAULT 0,
+    created REAL,
+    updated REAL);
+CREATE INDEX IF NOT EXISTS requests_complete ON requests (complete, created);
+'''
+
+def is_complete(record):
+    '''Return True if the queue record has been published to THREDDS'''
+
+    return (record.get('reason') or '').startswith('Complete')
+
+class QueueStore(object):
+    '''sqlite-backed store of queue records.  A single connection is shared,
+    under a lock, by all threads'''
+
+    def __init__(self, db_file):
+        self._db_file = db_file
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, timeout=30.0, check_same_thread=False)
+        self._conn.text_factory = str
+        self._conn.row_factory = sqlite3.Row
+        # Write-ahead logging: each commit appends to the log and readers are
+        # not blocked by writers.  synchronous=NORMAL keeps the database
+        # consistent after a crash, at the cost of possibly losing the last
+        # transactions on power loss
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    @property
+    def db_file(self):
+        return self._db_file
+
+    def _record(self, row):
+        return dict([(c, row[c] if row[c] is not None else '') for c in QUEUE_COLUMNS])
+
+    def _values(self, record):
+        return [record.get(c) or '' for c in QUEUE_COLUMNS]
+
+    def add(self, records, replace=False):
+        '''Add queue records to the store.  Records whose request_url is already
+        in the store are ignored unless replace is True.  Returns the number of
+        records added'''
+
+        now = time.time()
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        sql = '{:s} INTO requests ({:s}, complete, created, updated) VALUES ({:s}, ?, ?, ?)'.format(
+            verb,
+            ', '.join(QUEUE_COLUMNS),
+            ', '.join(['?'] * len(QUEUE_COLUMNS)))
+
+        with self._lock:
+            n = self._conn.total_changes
+            with self._conn:
+                self._conn.executemany(sql,
+                    [self._values(r) + [int(is_complete(r)), now, now] for r in records if r.get('request_url')])
+            return self._conn.total_changes - n
+
+    def update(self, record):
+        '''Write the current status of the queue record'''
+
+        sql = 'UPDATE requests SET {:s}, complete = ?, updated = ? WHERE request_url = ?'.format(
+            ', '.join(['{:s} = ?'.format(c) for c in QUEUE_COLUMNS if c != 'request_url']))
+        values = [record.get(c) or '' for c in QUEUE_COLUMNS if c != 'request_url']
+
+        with self._lock:
+            with self._conn:
+                self._conn.execute(sql, values + [int(is_complete(record)), time.time(), record['request_url']])
+
+    def get(self, request_url):
+        '''Return the queue record for request_url, or None if it is not in the
+        store'''
+
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM requests WHERE request_url = ?', (request_url,)).fetchone()
+
+        return self._record(row) if row else None
+
+    def pending(self, reason=None):
+        '''Return the records, in the order they were added, that have not been
+        published to THREDDS, optionally only those whose reason is reason'''
+
+        sql = 'SELECT * FROM requests WHERE complete = 0'
+        params = []
+        if reason is not None:
+            sql += ' AND reason = ?'
+            params.append(reason)
+        sql += ' ORDER BY created, rowid'
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        return [self._record(row) for row in rows]
+
+    def records(self):
+        '''Return all records in the order they were added'''
+
+        with self._lock:
+            rows = self._conn.execute('SELECT * FROM requests ORDER BY created, rowid').fetchall()
+
+        return [self._record(row) for row in rows]
+
+    def checkpoint(self):
+        '''Copy the write-ahead log into the database and truncate it'''
+
+        with self._lock:
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+
+        with self._lock:
+            self._conn.close()
+
+def open_store(db_file):
+    '''Open, creating if necessary, the queue store db_file.  Returns None if the
+    store cannot be opened'''
+
+    try:
+        return QueueStore(db_file)
+    except sqlite3.Error as e:
+        sys.stderr.write('{:s}: {:s}\n'.format(db_file, str(e)))
+        sys.stderr.flush()
+        return None
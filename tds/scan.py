@@ -0,0 +1,179 @@
+"""
+Single-pass scans of UFrame asynchronous request product directories.
+
+Finding the NetCDF files of a request used to take a listdir of the product
+directory, an isdir per entry and a glob per bin directory, repeated for every
+lookup.  On an NFS mounted ASYNC_UFRAME_NC_ROOT each of these is a round trip
+to the server.  A ProductIndex walks a product directory once with scandir,
+whose entries carry their type without a stat, records whether status.txt
+exists and indexes the NetCDF files in the bin directories by stream name, so
+that every later lookup is served from memory.  scan_requests indexes all the
+requests of a queue at once, listing ASYNC_UFRAME_NC_ROOT once and scanning the
+product directories in parallel.
+"""
+
+import os
+import sys
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+STATUS_FILE = 'status.txt'
+
+class _Entry(object):
+    '''Minimal scandir entry, for Python versions without scandir'''
+
+    def __init__(self, path, name):
+        self.path = os.path.join(path, name)
+        self.name = name
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+def scan_dir(path):
+    '''Return the entries of the directory path, using scandir if available'''
+
+    if scandir:
+        it = scandir(path)
+        try:
+            return list(it)
+        finally:
+            # scandir iterators hold the directory open until closed (3.6+)
+            if hasattr(it, 'close'):
+                it.close()
+
+    return [_Entry(path, name) for name in os.listdir(path)]
+
+def nc_stream_name(nc_file):
+    '''Return the stream name of the UFrame NetCDF file name nc_file
+    (deploymentNNNN_<reference designator>-<method>-<stream>.nc)'''
+
+    return os.path.basename(nc_file)[:-3].split('-')[-1]
+
+class ProductIndex(object):
+    '''Index of the NetCDF files, by stream, of one UFrame request product
+    directory, built by a single scan.  If scan is False, the product directory
+    is known not to exist and the index is empty'''
+
+    def __init__(self, product_dir, scan=True):
+        self._product_dir = product_dir
+        self._exists = False
+        self._has_status = False
+        self._status = None
+        self._streams = {}
+        if scan:
+            self._scan()
+
+    def _scan(self):
+
+        try:
+            entries = scan_dir(self._product_dir)
+        except OSError:
+            return
+        self._exists = True
+
+        for entry in entries:
+            if entry.name == STATUS_FILE:
+                self._has_status = True
+                continue
+            if not entry.is_dir():
+                continue
+            try:
+                bin_entries = scan_dir(entry.path)
+            except OSError as e:
+                sys.stderr.write('{:s}: {:s}\n'.format(entry.path, e.strerror))
+                continue
+            for nc_entry in bin_entries:
+                if nc_entry.name.endswith('.nc') and not nc_entry.name.startswith('.'):
+                    self._streams.setdefault(nc_stream_name(nc_entry.name), []).append(nc_entry.path)
+
+    @property
+    def product_dir(self):
+        return self._product_dir
+
+    @property
+    def exists(self):
+        return self._exists
+
+    @property
+    def has_status(self):
+        return self._has_status
+
+    def status(self):
+        '''Return the first line of status.txt, stripped, or None if there is no
+        status.txt'''
+
+        if self._status is None and self._has_status:
+            try:
+                with open(os.path.join(self._product_dir, STATUS_FILE), 'r') as fid:
+                    self._status = fid.readline().strip()
+            except IOError as e:
+                sys.stderr.write('{:s}: {:s}\n'.format(os.path.join(self._product_dir, STATUS_FILE), e.strerror))
+                return None
+
+        return self._status
+
+    def is_complete(self):
+        return self.status() == 'complete'
+
+    def nc_files(self, stream):
+        '''Return the NetCDF files whose names end with stream.nc, as matched by
+        the glob *<stream>.nc'''
+
+        if '-' not in stream:
+            nc_files = list(self._streams.get(stream, []))
+            # Stream names ending with stream (e.g. *velocity.nc)
+            for (name, files) in self._streams.items():
+                if name != stream and name.endswith(stream):
+                    nc_files.extend(files)
+            return nc_files
+
+        suffix = '{:s}.nc'.format(stream)
+        return [f for files in self._streams.values() for f in files if f.endswith(suffix)]
+
+    def streams(self):
+        return sorted(self._streams.keys())
+
+    def __repr__(self):
+        return '<ProductIndex(product_dir={:s}, streams={:d})>'.format(self._product_dir, len(self._streams))
+
+def scan_requests(uframe_nc_root, request_uuids, threads=8):
+    '''Return a dict mapping each of request_uuids to the ProductIndex of its
+    product directory under uframe_nc_root.  uframe_nc_root is listed once, so
+    that requests whose product directory does not exist yet cost nothing more,
+    and the product directories are scanned by threads threads'''
+
+    request_uuids = [u for u in set(request_uuids) if u]
+    try:
+        existing = set([e.name for e in scan_dir(uframe_nc_root)])
+    except OSError as e:
+        sys.stderr.write('{:s}: {:s}\n'.format(uframe_nc_root, e.strerror))
+        existing = set()
+
+    to_scan = [u for u in request_uuids if u in existing]
+    if threads > 1 and len(to_scan) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(threads, len(to_scan)))
+        try:
+            scanned = pool.map(ProductIndex, [os.path.join(uframe_nc_root, u) for u in to_scan])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        scanned = [ProductIndex(os.path.join(uframe_nc_root, u)) for u in to_scan]
+    indexes = dict(zip(to_scan, scanned))
+
+    # Requests without a product directory get an empty index, without a scan
+    for u in request_uuids:
+        if u not in indexes:
+            indexes[u] = ProductIndex(os.path.join(uframe_nc_root, u), scan=False)
+
+    return indexes
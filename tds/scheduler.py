@@ -0,0 +1,276 @@
+"""
+Priority and size aware scheduling of asynchronous uFrame stream requests.
+
+Each candidate request url is assigned an estimated cost (the number of days
+requested multiplied by the historical number of bytes per day published to
+THREDDS for the stream), a priority (from the order of instrument-types.txt) and
+a staleness (how long the url has been waiting to be sent).  Requests are sent
+in order of priority and then of cost discounted by staleness, so that small,
+time-critical requests are not starved by large multi-year requests, while
+capping the number of requests in flight per instrument type and per array.
+"""
+
+import os
+import re
+import sys
+import csv
+import glob
+import time
+from tds import dir_from_request_meta
+from tds.volumes import VolumeSet
+from uframe.timestamps import to_datetime64
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from urllib.parse import urlparse, parse_qs
+
+# Bytes per day assumed for streams that have never been published
+DEFAULT_BYTES_PER_DAY = 10 * 1024 * 1024
+
+_SECONDS_PER_DAY = 86400.0
+
+# Timestamped THREDDS NetCDF file names end with -<ts0>-<ts1>.nc
+_TS_NC_REGEXP = re.compile(r'-(\d{8}T\d{6})-(\d{8}T\d{6})\.nc$')
+
+def parse_async_url(url):
+    '''Parse an asynchronous request url, as created by
+    build_async_query_from_stream_meta, into a dict containing the instrument
+    (reference designator), method, stream, beginDT, endDT, instrument type and
+    array.  Returns None if the url cannot be parsed'''
+
+    u = urlparse(url.strip())
+    tokens = [t for t in u.path.split('/') if t]
+    if 'inv' not in tokens or len(tokens) - tokens.index('inv') != 6:
+        sys.stderr.write('Invalid async request url: {:s}\n'.format(url))
+        return None
+
+    (subsite, node, sensor, method, stream) = tokens[tokens.index('inv') + 1:]
+    query = parse_qs(u.query)
+    if 'beginDT' not in query or 'endDT' not in query:
+        sys.stderr.write('Async request url has no time bounds: {:s}\n'.format(url))
+        return None
+
+    sensor_tokens = sensor.split('-')
+
+    return {'request_url' : url.strip(),
+        'instrument' : '{:s}-{:s}-{:s}'.format(subsite, node, sensor),
+        'method' : method,
+        'stream' : stream,
+        'beginDT' : query['beginDT'][0],
+        'endDT' : query['endDT'][0],
+        'instrument_type' : sensor_tokens[-1][:5],
+        'array' : subsite[:2]}
+
+def load_instrument_priorities(types_file):
+    '''Return a dict mapping each instrument type listed in types_file (one per
+    line, as used by send_single_instrument_type_requests.sh) to its priority.
+    Types listed first have the highest priority (lowest value)'''
+
+    priorities = {}
+
+    if not types_file or not os.path.exists(types_file):
+        return priorities
+
+    with open(types_file, 'r') as fid:
+        for line in fid:
+            t = line.strip()
+            if t and not t.startswith('#') and t not in priorities:
+                priorities[t] = len(priorities)
+
+    return priorities
+
+def stream_bytes_per_day(stream_dir):
+    '''Return the number of bytes per day of data published in the THREDDS stream
+    directory, calculated from the sizes and time coverage of its timestamped
+    NetCDF files, or None if no files have been published'''
+
+    if not os.path.isdir(stream_dir):
+        return None
+
+    nbytes = 0
+    seconds = 0.0
+    for nc_file in os.listdir(stream_dir):
+        match = _TS_NC_REGEXP.search(nc_file)
+        if not match:
+            continue
+        ts0 = time.mktime(time.strptime(match.group(1), '%Y%m%dT%H%M%S'))
+        ts1 = time.mktime(time.strptime(match.group(2), '%Y%m%dT%H%M%S'))
+        nbytes += os.path.getsize(os.path.join(stream_dir, nc_file))
+        seconds += max(ts1 - ts0, 1)
+
+    if not seconds:
+        return None
+
+    return nbytes / (seconds / _SECONDS_PER_DAY)
+
+def estimate_costs(requests, tds_nc_root, default_bytes_per_day=DEFAULT_BYTES_PER_DAY):
+    '''Add the number of days requested, the historical bytes per day of the
+    stream and the estimated cost, in bytes, to each parsed request.  The
+    stream history is looked up on the roots in tds_nc_root (see
+    tds.volumes), if specified.  Streams with no history use the mean bytes
+    per day of their instrument type, or default_bytes_per_day'''
+
+    volumes = VolumeSet(tds_nc_root) if tds_nc_root else None
+    stream_rates = {}
+    for r in requests:
+        rel_path = dir_from_request_meta({'instrument' : r['instrument'],
+            'stream' : r['stream'],
+            'telemetry' : r['method']})
+        if not volumes or not rel_path:
+            r['bytes_per_day'] = None
+            continue
+        if rel_path not in stream_rates:
+            stream_dir = volumes.stream_dir(rel_path)
+            stream_rates[rel_path] = stream_bytes_per_day(stream_dir) if stream_dir else None
+        r['bytes_per_day'] = stream_rates[rel_path]
+    if volumes:
+        volumes.close()
+
+    type_rates = {}
+    for r in requests:
+        if r['bytes_per_day']:
+            type_rates.setdefault(r['instrument_type'], []).append(r['bytes_per_day'])
+
+    # Days requested, converting the time bounds of all requests at once
+    import numpy as np
+    delta = to_datetime64([r['endDT'] for r in requests]) - to_datetime64([r['beginDT'] for r in requests])
+    invalid = np.isnat(delta)
+    days = np.maximum(delta.astype('int64') / (1000.0 * _SECONDS_PER_DAY), 0)
+
+    for (i, r) in enumerate(requests):
+        if not r['bytes_per_day']:
+            rates = type_rates.get(r['instrument_type'])
+            r['bytes_per_day'] = sum(rates) / len(rates) if rates else default_bytes_per_day
+        if invalid[i]:
+            sys.stderr.write('Invalid request time bounds: {:s}\n'.format(r['request_url']))
+            r['days'] = 0
+        else:
+            r['days'] = float(days[i])
+        r['cost'] = r['days'] * r['bytes_per_day']
+
+    return requests
+
+def load_url_files(url_files, exclude_urls=None):
+    '''Parse the request urls contained in url_files (one url per line) and
+    return the list of parsed requests.  Each request records the staleness, in
+    days, of the file it was read from.  Urls in exclude_urls are skipped'''
+
+    requests = []
+    seen = set(exclude_urls or [])
+    now = time.time()
+
+    for url_file in url_files:
+        try:
+            fid = open(url_file, 'r')
+        except IOError as e:
+            sys.stderr.write('{:s}: {:s}\n'.format(e.strerror, url_file))
+            continue
+        staleness = max(now - os.path.getmtime(url_file), 0) / _SECONDS_PER_DAY
+        for line in fid:
+            url = line.strip()
+            if not url or url.startswith('#') or url in seen:
+                continue
+            seen.add(url)
+            r = parse_async_url(url)
+            if not r:
+                continue
+            r['staleness'] = staleness
+            r['url_file'] = url_file
+            requests.append(r)
+        fid.close()
+
+    return requests
+
+def submitted_urls(queue_root, processed_root=None):
+    '''Return the set of request urls that have already been sent, taken from the
+    request_url column of the queue csv files in queue_root and from the url
+    files in processed_root'''
+
+    urls = set()
+
+    for queue_csv in glob.glob(os.path.join(queue_root, '*.csv')):
+        with open(queue_csv, 'r') as fid:
+            for row in csv.DictReader(fid):
+                if row.get('request_url'):
+                    urls.add(row['request_url'].strip())
+
+    if processed_root:
+        for url_file in glob.glob(os.path.join(processed_root, '*')):
+            if not os.path.isfile(url_file):
+                continue
+            with open(url_file, 'r') as fid:
+                urls.update([line.strip() for line in fid if line.strip()])
+
+    return urls
+
+def requests_in_flight(queue_root, uframe_nc_root, store=None):
+    '''Return the list of parsed requests in the queue csv files in queue_root,
+    and the pending requests in the QueueStore store, that have a requestUUID
+    but whose uFrame product directory does not yet contain a complete
+    status.txt.  The status in store takes precedence over the queue csv files'''
+
+    in_flight = []
+
+    rows = []
+    for queue_csv in glob.glob(os.path.join(queue_root, '*.csv')):
+        with open(queue_csv, 'r') as fid:
+            rows.extend(csv.DictReader(fid))
+
+    if store:
+        seen = set([row.get('request_url', '') for row in rows])
+        rows = [store.get(row.get('request_url', '')) or row for row in rows]
+        rows.extend([r for r in store.pending() if r['request_url'] not in seen])
+
+    for row in rows:
+        if not row.get('requestUUID') or row.get('reason', '').startswith('Complete'):
+            continue
+        status_file = os.path.join(uframe_nc_root, row['requestUUID'], 'status.txt')
+        if os.path.exists(status_file):
+            with open(status_file, 'r') as status_fid:
+                if status_fid.readline().strip() == 'complete':
+                    continue
+        r = parse_async_url(row.get('request_url', ''))
+        if r:
+            r['requestUUID'] = row['requestUUID']
+            in_flight.append(r)
+
+    return in_flight
+
+def schedule_requests(requests, in_flight=None, priorities=None, max_per_type=None, max_per_array=None, max_total=None):
+    '''Order requests by instrument type priority and then by estimated cost
+    discounted by staleness, and select those that can be sent without
+    exceeding max_per_type requests in flight per instrument type, max_per_array
+    per array or max_total overall.  Requests that are already in flight count
+    toward the caps.  Returns the selected requests in the order they should be
+    sent'''
+
+    priorities = priorities or {}
+    lowest_priority = len(priorities)
+
+    type_counts = {}
+    array_counts = {}
+    for r in in_flight or []:
+        type_counts[r['instrument_type']] = type_counts.get(r['instrument_type'], 0) + 1
+        array_counts[r['array']] = array_counts.get(r['array'], 0) + 1
+    total = len(in_flight or [])
+
+    for r in requests:
+        r['priority'] = priorities.get(r['instrument_type'], lowest_priority)
+        # Requests that have waited longer are treated as cheaper so that large
+        # requests are eventually sent
+        r['score'] = r['cost'] / (1.0 + r['staleness'])
+
+    scheduled = []
+    for r in sorted(requests, key=lambda r: (r['priority'], r['score'])):
+        if max_total is not None and total >= max_total:
+            break
+        if max_per_type is not None and type_counts.get(r['instrument_type'], 0) >= max_per_type:
+            continue
+        if max_per_array is not None and array_counts.get(r['array'], 0) >= max_per_array:
+            continue
+        scheduled.append(r)
+        type_counts[r['instrument_type']] = type_counts.get(r['instrument_type'], 0) + 1
+        array_counts[r['array']] = array_counts.get(r['array'], 0) + 1
+        total += 1
+
+    return scheduled
@@ -0,0 +1,217 @@
+"""
+Per-stage timing of the command line scripts.
+
+Scripts run with --profile record the wall clock and CPU time spent in each
+named stage (loading csv files, metadata requests, scanning product
+directories, timestamping, copying, writing the queue, ...).  Stages are
+marked in the code with
+
+    with stage('copy'):
+        ...
+
+which costs nothing unless profiling is enabled by run_profiled.  At exit the
+stage times are written to STDERR and appended, as one JSON object per run, to
+the profile log, so that runs can be compared over time.  With --cprofile, the
+cProfile statistics of the whole run are also written, for use with pstats or
+snakeviz.  CPU time includes the threads of the process and its worker
+processes once they have exited.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import datetime
+
+# Default profile log, relative to ASYNC_DATA_HOME
+DEFAULT_PROFILE_LOG = 'profile.jsonl'
+
+def cpu_time():
+    '''Return the user and system CPU time of the process and its terminated
+    children'''
+
+    t = os.times()
+
+    return t[0] + t[1] + t[2] + t[3]
+
+class _NullStage(object):
+    '''Stage context used when profiling is not enabled'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage(object):
+
+    def __init__(self, timer, name):
+        self._timer = timer
+        self._name = name
+
+    def __enter__(self):
+        self._wall = time.time()
+        self._cpu = cpu_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._timer.add(self._name, time.time() - self._wall, cpu_time() - self._cpu)
+        return False
+
+class StageTimer(object):
+    '''Number of calls, wall clock and CPU time, in seconds, of each named
+    stage'''
+
+    def __init__(self):
+        self._stages = {}
+        self._order = []
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        '''Return a context manager timing the stage name'''
+        return _Stage(self, name)
+
+    def add(self, name, wall, cpu, calls=1):
+
+        with self._lock:
+            if name not in self._stages:
+                self._stages[name] = {'calls' : 0, 'wall' : 0.0, 'cpu' : 0.0}
+                self._order.append(name)
+            self._stages[name]['calls'] += calls
+            self._stages[name]['wall'] += wall
+            self._stages[name]['cpu'] += cpu
+
+    def merge(self, stages):
+        '''Add the stage times stages, as returned by stages() (e.g. by a worker
+        process)'''
+
+        for (name, times) in stages.items():
+            self.add(name, times['wall'], times['cpu'], calls=times['calls'])
+
+    def stages(self):
+        '''Return a dict mapping each stage name to its calls, wall and cpu'''
+
+        with self._lock:
+            return dict([(name, dict(times)) for (name, times) in self._stages.items()])
+
+    def names(self):
+        '''Return the stage names in the order they were first timed'''
+        return list(self._order)
+
+_timer = None
+
+def stage(name):
+    '''Return a context manager timing the stage name if profiling is
+    enabled'''
+
+    if _timer is None:
+        return _NULL_STAGE
+
+    return _timer.stage(name)
+
+def enable_timing():
+    '''Start recording stages in a new StageTimer, e.g. in a worker process, and
+    return it'''
+
+    global _timer
+    _timer = StageTimer()
+
+    return _timer
+
+def disable_timing():
+
+    global _timer
+    _timer = None
+
+def merge_stages(stages):
+    '''Add the stage times of a worker process to the current timer'''
+
+    if _timer is not None:
+        _timer.merge(stages)
+
+def add_profile_arguments(arg_parser):
+    '''Add the --profile, --profile-log and --cprofile options to arg_parser'''
+
+    arg_parser.add_argument('--profile',
+        action='store_true',
+        help='Report the wall clock and CPU time of each stage on STDERR and append them to the profile log')
+    arg_parser.add_argument('--profile-log',
+        dest='profile_log',
+        help='JSON lines file to which --profile appends the stage times (ASYNC_DATA_HOME/profile.jsonl is <default>)')
+    arg_parser.add_argument('--cprofile',
+        help='Write the cProfile statistics of the run to this file with --profile')
+
+def write_stage_report(summary, fid):
+    '''Write the stage times of the run summary as a table to the open file
+    fid'''
+
+    fid.write('{:<16s} {:>6s} {:>10s} {:>10s} {:>6s}\n'.format('stage', 'calls', 'wall (s)', 'cpu (s)', 'wall%'))
+    total = max(summary['wall'], 1e-9)
+    for name in summary['order']:
+        times = summary['stages'][name]
+        fid.write('{:<16s} {:>6d} {:>10.3f} {:>10.3f} {:>5.1f}%\n'.format(name, times['calls'], times['wall'], times['cpu'], 100.0 * times['wall'] / total))
+    fid.write('{:<16s} {:>6s} {:>10.3f} {:>10.3f}\n'.format('total', '', summary['wall'], summary['cpu']))
+
+def run_profiled(main, args, script):
+    '''Return main(args).  If args.profile is set, the stages of the run are
+    timed and reported on STDERR, the run summary is appended to the profile
+    log and, if args.cprofile is set, the cProfile statistics are written to
+    it'''
+
+    if not getattr(args, 'profile', False):
+        return main(args)
+
+    profile_log = getattr(args, 'profile_log', None)
+    if not profile_log and os.getenv('ASYNC_DATA_HOME'):
+        profile_log = os.path.join(os.getenv('ASYNC_DATA_HOME'), DEFAULT_PROFILE_LOG)
+
+    timer = enable_timing()
+    profiler = None
+    if getattr(args, 'cprofile', None):
+        import cProfile
+        profiler = cProfile.Profile()
+
+    started = datetime.datetime.utcnow()
+    wall = time.time()
+    cpu = cpu_time()
+    status = None
+    try:
+        if profiler:
+            profiler.enable()
+        status = main(args)
+    finally:
+        if profiler:
+            profiler.disable()
+        wall = time.time() - wall
+        cpu = cpu_time() - cpu
+        disable_timing()
+
+        summary = {'script' : script,
+            'argv' : sys.argv[1:],
+            'host' : socket.gethostname(),
+            'started' : started.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'status' : status,
+            'wall' : round(wall, 6),
+            'cpu' : round(cpu, 6),
+            'order' : timer.names(),
+            'stages' : dict([(name, {'calls' : t['calls'], 'wall' : round(t['wall'], 6), 'cpu' : round(t['cpu'], 6)}) for (name, t) in timer.stages().items()])}
+
+        write_stage_report(summary, sys.stderr)
+        if profiler:
+            try:
+                profiler.dump_stats(args.cprofile)
+                sys.stderr.write('cProfile statistics: {:s}\n'.format(args.cprofile))
+            except (IOError, OSError) as e:
+                sys.stderr.write('{:s}: {:s}\n'.format(args.cprofile, e.strerror))
+        if profile_log:
+            try:
+                with open(profile_log, 'a') as fid:
+                    fid.write('{:s}\n'.format(json.dumps(summary, sort_keys=True)))
+            except (IOError, OSError) as e:
+                sys.stderr.write('{:s}: {:s}\n'.format(profile_log, e.strerror))
+
+    return status
@@ -0,0 +1,155 @@
+"""
+Rewrite of UFrame NetCDF files as compressed NetCDF4 files chunked for time
+series access.
+
+uFrame writes uncompressed files whose variables are stored contiguously or in
+small chunks, so that reading a long time series of one variable through
+OPeNDAP touches most of the file.  The rewritten files are zlib compressed,
+with the shuffle filter, and each variable is chunked along the time (obs)
+dimension in chunks of about chunk_bytes, with any other dimensions kept
+whole.  Dimensions, variables, fill values and all global and variable
+attributes are copied unchanged.
+"""
+
+import os
+import sys
+import time
+import shutil
+from uframe.lazy import lazy_module
+
+# Imported on first use (see uframe.lazy)
+netCDF4 = lazy_module('netCDF4')
+
+# Target uncompressed size, in bytes, of each chunk
+DEFAULT_CHUNK_BYTES = 1024 * 1024
+
+# Maximum number of records copied at a time
+_COPY_RECORDS = 100000
+
+def time_dimension(nci):
+    '''Return the name of the time dimension of the open Dataset nci: the first
+    dimension of the time variable, the unlimited dimension or, failing both,
+    the first dimension'''
+
+    if 'time' in nci.variables and nci.variables['time'].dimensions:
+        return nci.variables['time'].dimensions[0]
+
+    for (name, dim) in nci.dimensions.items():
+        if dim.isunlimited():
+            return name
+
+    dims = list(nci.dimensions.keys())
+    return dims[0] if dims else None
+
+def chunk_shape(var, time_dim, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    '''Return the chunk shape of var: other dimensions whole and as many records
+    along time_dim as fit in chunk_bytes'''
+
+    shape = [max(len(d), 1) for d in [var.group().dimensions[n] for n in var.dimensions]]
+    if time_dim not in var.dimensions:
+        return shape
+
+    i = var.dimensions.index(time_dim)
+    record_bytes = var.dtype.itemsize if hasattr(var.dtype, 'itemsize') else 8
+    for (j, n) in enumerate(shape):
+        if j != i:
+            record_bytes *= n
+    shape[i] = max(1, min(shape[i], chunk_bytes // max(record_bytes, 1)))
+
+    return shape
+
+def transcode_nc_file(src, dest, complevel=4, shuffle=True, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    '''Rewrite the NetCDF file src as the compressed and time-chunked NetCDF4 file
+    dest'''
+
+    nci = netCDF4.Dataset(src, 'r')
+    nci.set_auto_maskandscale(False)
+    nco = netCDF4.Dataset(dest, 'w', format='NETCDF4')
+    try:
+        nco.setncatts(dict([(a, nci.getncattr(a)) for a in nci.ncattrs()]))
+
+        for (name, dim) in nci.dimensions.items():
+            nco.createDimension(name, None if dim.isunlimited() else len(dim))
+
+        time_dim = time_dimension(nci)
+        for (name, var) in nci.variables.items():
+            attrs = dict([(a, var.getncattr(a)) for a in var.ncattrs()])
+            fill_value = attrs.pop('_FillValue', None)
+            # Variable length strings cannot be compressed
+            compress = var.dtype != str and var.dimensions
+            out = nco.createVariable(name,
+                var.dtype,
+                var.dimensions,
+                zlib=bool(compress),
+                complevel=complevel,
+                shuffle=bool(compress) and shuffle,
+                chunksizes=chunk_shape(var, time_dim, chunk_bytes) if compress else None,
+                fill_value=fill_value)
+            out.set_auto_maskandscale(False)
+            out.setncatts(attrs)
+
+            # Copy the data in blocks of records to bound memory use
+            if time_dim in var.dimensions and var.shape[var.dimensions.index(time_dim)] > _COPY_RECORDS:
+                i = var.dimensions.index(time_dim)
+                for r0 in range(0, var.shape[i], _COPY_RECORDS):
+                    index = [slice(None)] * len(var.dimensions)
+                    # The output's unlimited dimension is still empty: the
+                    # last block must not ask for more records than there are
+                    index[i] = slice(r0, min(r0 + _COPY_RECORDS, var.shape[i]))
+                    out[tuple(index)] = var[tuple(index)]
+            elif var.dimensions:
+                out[:] = var[:]
+            else:
+                out.assignValue(var.getValue())
+    finally:
+        nco.close()
+        nci.close()
+
+def read_time(nc_file):
+    '''Return the number of seconds taken to open nc_file and read every
+    variable in full, as a time series request does'''
+
+    t0 = time.time()
+    nci = netCDF4.Dataset(nc_file, 'r')
+    try:
+        for var in nci.variables.values():
+            if var.dimensions:
+                var[:]
+            else:
+                var.getValue()
+    finally:
+        nci.close()
+
+    return time.time() - t0
+
+def transcode_copy_function(complevel=4, shuffle=True, chunk_bytes=DEFAULT_CHUNK_BYTES, reports=None):
+    '''Return a copy function, for tds.manifest.publish_files, that transcodes
+    each source file and writes a line reporting the size and read time of the
+    file before and after.  Report dicts are appended to reports, if specified.
+    Files that cannot be transcoded are copied unchanged'''
+
+    def copy_function(src, dest):
+
+        try:
+            transcode_nc_file(src, dest, complevel=complevel, shuffle=shuffle, chunk_bytes=chunk_bytes)
+        except (RuntimeError, ValueError, TypeError, IndexError) as e:
+            sys.stderr.write('Failed to transcode {:s} ({:s}): copying unchanged\n'.format(src, str(e)))
+            shutil.copyfile(src, dest)
+            return
+
+        report = {'file' : src,
+            'size_before' : os.path.getsize(src),
+            'size_after' : os.path.getsize(dest),
+            'read_before' : round(read_time(src), 6),
+            'read_after' : round(read_time(dest), 6)}
+        sys.stdout.write('Transcoded NetCDF file   : {:s} {:d} -> {:d} bytes ({:0.1f}%), read {:0.4f} -> {:0.4f} s\n'.format(
+            os.path.basename(src),
+            report['size_before'],
+            report['size_after'],
+            100.0 * report['size_after'] / max(report['size_before'], 1),
+            report['read_before'],
+            report['read_after']))
+        if reports is not None:
+            reports.append(report)
+
+    return copy_function
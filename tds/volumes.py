@@ -0,0 +1,320 @@
+"""
+Placement of THREDDS stream directories across several storage volumes.
+
+ASYNC_TDS_NC_ROOT may be a list of directories separated by os.pathsep (: on
+POSIX), each on its own volume, so that capacity and I/O throughput grow by
+adding disks.  Every root has the stream layout given by
+tds.dir_from_request_meta and each stream directory, with its NetCDF files,
+manifest and NCML aggregation, lives on exactly one root.  A VolumeSet keeps
+an index, a sqlite database in the first root, mapping each stream directory
+to its root:
+
+    locate      - the root holding a stream, from the index, or found by
+                  checking each root if the index does not have it
+    place       - the root of an existing stream (streams never move on their
+                  own), otherwise the root with the most free space relative to
+                  its current I/O load, skipping roots with less than min_free
+                  bytes free
+    move_stream - moves a stream to another root and rewrites its NCML file so
+                  that the aggregation scans the new location
+
+Free space is read with statvfs and I/O load is the number of requests in
+flight on the device of the root in /proc/diskstats (0 where it is not
+available).  With a single root no index is kept and every stream is on it.
+Placing or moving the same stream from several processes is safe as long as
+the stream is claimed first with the lease of tds.export.lease_key, as the
+export workers and edit_tds_datasets.py --volume do.
+"""
+
+import os
+import sys
+import time
+import errno
+import shutil
+import sqlite3
+import threading
+
+# Index of the stream directories, in the first root
+INDEX_FILE = '.stream-volumes.db'
+
+# Roots with less free space are not used for new streams
+DEFAULT_MIN_FREE = 10 * 1024 ** 3
+
+DISKSTATS = '/proc/diskstats'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS streams (
+    rel_path TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    placed REAL);
+'''
+
+def split_roots(tds_nc_root):
+    '''Return the list of directories in tds_nc_root, one directory or a list
+    of directories separated by os.pathsep'''
+
+    return [os.path.normpath(r) for r in tds_nc_root.split(os.pathsep) if r]
+
+def invalid_roots(tds_nc_root):
+    '''Return the directories in tds_nc_root that do not exist'''
+
+    return [r for r in split_roots(tds_nc_root) if not os.path.isdir(r)]
+
+def free_bytes(root):
+    '''Return the number of bytes available to unprivileged users on the volume
+    of root, or None if it cannot be determined'''
+
+    try:
+        st = os.statvfs(root)
+    except (OSError, AttributeError):
+        return None
+
+    return st.f_bavail * st.f_frsize
+
+def read_diskstats(diskstats=DISKSTATS):
+    '''Return a dict mapping the (major, minor) number of each block device in
+    diskstats to its number of I/O requests in flight'''
+
+    in_flight = {}
+    try:
+        with open(diskstats, 'r') as fid:
+            for line in fid:
+                fields = line.split()
+                if len(fields) < 12:
+                    continue
+                in_flight[(int(fields[0]), int(fields[1]))] = int(fields[11])
+    except (IOError, OSError, ValueError):
+        return {}
+
+    return in_flight
+
+def io_load(root, diskstats=None):
+    '''Return the number of I/O requests in flight on the device of root, from
+    diskstats (see read_diskstats), or 0 if it is not a local block device'''
+
+    if diskstats is None:
+        diskstats = read_diskstats()
+
+    try:
+        dev = os.stat(root).st_dev
+    except OSError:
+        return 0
+
+    return diskstats.get((os.major(dev), os.minor(dev)), 0)
+
+def rewrite_ncml(ncml_file, old_dir, new_dir):
+    '''Replace the stream directory old_dir with new_dir in the NCML
+    aggregation file ncml_file.  Returns True if the file was rewritten, False
+    if it could not be or does not scan old_dir'''
+
+    try:
+        with open(ncml_file, 'r') as fid:
+            ncml = fid.read()
+        if old_dir not in ncml:
+            sys.stderr.write('{:s}: does not scan {:s}\n'.format(ncml_file, old_dir))
+            return False
+        tmp_file = '{:s}.tmp'.format(ncml_file)
+        with open(tmp_file, 'w') as fid:
+            fid.write(ncml.replace(old_dir, new_dir))
+        os.rename(tmp_file, ncml_file)
+    except (IOError, OSError) as e:
+        sys.stderr.write('{:s}: {:s}\n'.format(ncml_file, e.strerror))
+        return False
+
+    return True
+
+class VolumeSet(object):
+    '''The THREDDS roots in tds_nc_root and the index of the stream
+    directories on them'''
+
+    def __init__(self, tds_nc_root, index_file=None, min_free=DEFAULT_MIN_FREE):
+        self._roots = split_roots(tds_nc_root)
+        self._min_free = min_free
+        self._lock = threading.Lock()
+        self._conn = None
+        if len(self._roots) > 1:
+            self._index_file = index_file or os.path.join(self._roots[0], INDEX_FILE)
+            self._conn = sqlite3.connect(self._index_file, timeout=30.0, check_same_thread=False)
+            self._conn.text_factory = str
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(_SCHEMA)
+            self._conn.commit()
+
+    @property
+    def roots(self):
+        return list(self._roots)
+
+    def __repr__(self):
+        return '<VolumeSet({:s})>'.format(os.pathsep.join(self._roots))
+
+    def _indexed(self, rel_path):
+
+        with self._lock:
+            row = self._conn.execute('SELECT root FROM streams WHERE rel_path = ?', (rel_path,)).fetchone()
+
+        return row[0] if row else None
+
+    def _record(self, rel_path, root):
+
+        with self._lock:
+            with self._conn:
+                self._conn.execute('INSERT OR REPLACE INTO streams (rel_path, root, placed) VALUES (?, ?, ?)', (rel_path, root, time.time()))
+
+    def _forget(self, rel_path):
+
+        with self._lock:
+            with self._conn:
+                self._conn.execute('DELETE FROM streams WHERE rel_path = ?', (rel_path,))
+
+    def locate(self, rel_path):
+        '''Return the root holding the stream directory rel_path (see
+        tds.dir_from_request_meta), or None if it is on none of them'''
+
+        if not self._conn:
+            return self._roots[0] if os.path.isdir(os.path.join(self._roots[0], rel_path)) else None
+
+        root = self._indexed(rel_path)
+        if root and os.path.isdir(os.path.join(root, rel_path)):
+            return root
+
+        # Not indexed, or moved by hand: check every root
+        for root in self._roots:
+            if os.path.isdir(os.path.join(root, rel_path)):
+                self._record(rel_path, root)
+                return root
+
+        return None
+
+    def stream_dir(self, rel_path):
+        '''Return the full path of the stream directory rel_path, or None if it
+        is on none of the roots'''
+
+        root = self.locate(rel_path)
+
+        return os.path.join(root, rel_path) if root else None
+
+    def usage(self):
+        '''Return the free space, I/O load and number of indexed streams of
+        each root'''
+
+        diskstats = read_diskstats()
+        counts = {}
+        if self._conn:
+            with self._lock:
+                counts = dict(self._conn.execute('SELECT root, COUNT(*) FROM streams GROUP BY root').fetchall())
+
+        return [{'root' : root,
+            'free' : free_bytes(root),
+            'load' : io_load(root, diskstats),
+            'streams' : counts.get(root, 0)} for root in self._roots]
+
+    def choose_root(self, exclude=None):
+        '''Return the root on which to place a new stream: the root, with at
+        least min_free bytes free, with the most free space per I/O request in
+        flight, or the root with the most free space if none has min_free'''
+
+        candidates = [u for u in self.usage() if u['root'] != exclude]
+        if not candidates:
+            return None
+
+        roomy = [u for u in candidates if u['free'] is None or u['free'] >= self._min_free]
+        if not roomy:
+            return max(candidates, key=lambda u: u['free'] or 0)['root']
+
+        return max(roomy, key=lambda u: float(u['free'] or 0) / (1 + u['load']))['root']
+
+    def place(self, rel_path, record=True):
+        '''Return the root of the stream directory rel_path: the root already
+        holding it, or a newly chosen one (see choose_root), which is added to
+        the index if record is True'''
+
+        if not self._conn:
+            return self._roots[0]
+
+        root = self.locate(rel_path)
+        if root:
+            return root
+
+        root = self.choose_root()
+        if record:
+            self._record(rel_path, root)
+
+        return root
+
+    def move_stream(self, rel_path, dest_root):
+        '''Move the stream directory rel_path to dest_root, one of the roots,
+        rewrite its NCML aggregation files to scan the new location and update
+        the index.  Empty parent directories left on the source root are
+        removed.  Returns the new stream directory, or None if it could not be
+        moved'''
+
+        dest_root = os.path.normpath(dest_root)
+        if dest_root not in self._roots:
+            sys.stderr.write('Not a THREDDS root: {:s}\n'.format(dest_root))
+            return None
+
+        source_root = self.locate(rel_path)
+        if not source_root:
+            sys.stderr.write('Stream not found: {:s}\n'.format(rel_path))
+            return None
+
+        source_dir = os.path.join(source_root, rel_path)
+        dest_dir = os.path.join(dest_root, rel_path)
+        if source_root == dest_root:
+            return dest_dir
+        if os.path.exists(dest_dir):
+            sys.stderr.write('Destination stream already exists: {:s}\n'.format(dest_dir))
+            return None
+
+        try:
+            os.makedirs(os.path.dirname(dest_dir))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                sys.stderr.write('{:s}: {:s}\n'.format(e.strerror, os.path.dirname(dest_dir)))
+                return None
+
+        # Copy to a temporary directory, on the destination volume, first so
+        # that THREDDS never sees a partial stream
+        tmp_dir = '{:s}.{:d}.tmp'.format(dest_dir, os.getpid())
+        try:
+            shutil.copytree(source_dir, tmp_dir)
+            for ncml_file in [os.path.join(tmp_dir, f) for f in os.listdir(tmp_dir) if f.endswith('.ncml')]:
+                if not rewrite_ncml(ncml_file, source_dir, dest_dir):
+                    raise OSError(errno.EIO, 'Failed to rewrite NCML file', ncml_file)
+            os.rename(tmp_dir, dest_dir)
+        except (IOError, OSError, shutil.Error) as e:
+            sys.stderr.write('Failed to move {:s}: {:s}\n'.format(source_dir, str(e)))
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return None
+
+        if self._conn:
+            self._record(rel_path, dest_root)
+
+        shutil.rmtree(source_dir, ignore_errors=True)
+        parent = os.path.dirname(source_dir)
+        while parent != source_root and parent.startswith(source_root):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+        return dest_dir
+
+    def close(self):
+
+        if self._conn:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+_volume_sets = {}
+
+def get_volumes(tds_nc_root):
+    '''Return the VolumeSet of tds_nc_root, opened once per process'''
+
+    key = (os.getpid(), tds_nc_root)
+    if key not in _volume_sets:
+        _volume_sets[key] = VolumeSet(tds_nc_root)
+
+    return _volume_sets[key]
@@ -2,12 +2,25 @@
 Module for querying uFrame instances and downloading responses, primarily as NetCDF.
 """
 
-import requests
 import sys
 import os
 import datetime
-from dateutil import parser
-from dateutil.relativedelta import relativedelta as tdelta
+import time
+import threading
+from uframe import telemetry, retry, pool
+from uframe.cache import InventoryCache
+from uframe import unzip as unzip_stream
+from uframe import ncverify
+from uframe.lazy import lazy_module
+from uframe.timestamps import parse_timestamp
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+# Imported on first use (see uframe.lazy)
+requests = lazy_module('requests')
+relativedelta = lazy_module('dateutil.relativedelta')
 
 
 HTTP_STATUS_OK = 200
@@ -22,14 +35,43 @@ _valid_relativedeltatypes = ('years',
 
 __filename_extension = { 'netcdf':'nc', 'json':'json', 'zip':'zip' }
 
+def _connection_not_made(e):
+    '''Return True if the requests exception e means that no connection to the
+    server was made (connect timeout or connection refused), so that the
+    request cannot have been received'''
+
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(e, requests.ConnectionError) or not e.args:
+        return False
+
+    # urllib3 reports the failure to connect as the reason of the error
+    reason = getattr(e.args[0], 'reason', None)
+    return any([c.__name__ in ('NewConnectionError', 'ConnectTimeoutError') for c in type(reason).__mro__])
+
 
 class UFrame(object):
 
-    def __init__(self, base_url='http://uframe-test.ooi.rutgers.edu', port=12576, timeout=10):
+    def __init__(self, base_url='http://uframe-test.ooi.rutgers.edu', port=12576, timeout=10, request_log=None, retries=3, backoff=1.0, endpoints=None, cache_size=1024):
         self._base_url = base_url
         self._port = port
         self._timeout = timeout
         self._url = '{:s}:{:d}/sensor/inv'.format(self.base_url, self.port)
+        # JSON lines file to append per-request timing records to
+        self._request_log = request_log or os.getenv('UFRAME_REQUEST_LOG')
+        self._session = None
+        # Number of times a failed request is retried and the base, in
+        # seconds, of the exponential backoff between retries
+        self._retries = retries
+        self._backoff = backoff
+        # Timeouts learned per endpoint class and circuit breakers per host
+        self._timeouts = retry.AdaptiveTimeout()
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+        # Optional pool of uFrame replicas to distribute requests across
+        self._pool = pool.EndpointPool(endpoints, port=port) if endpoints else None
+        # Decoded inventory and metadata responses, shared by all callers
+        self._cache = InventoryCache(max_entries=cache_size)
 
     @property
     def base_url(self):
@@ -58,24 +100,232 @@ class UFrame(object):
     def url(self):
         return self._url
 
+    @property
+    def retries(self):
+        return self._retries
+    @retries.setter
+    def retries(self, value):
+        self._retries = value
+
+    @property
+    def backoff(self):
+        return self._backoff
+    @backoff.setter
+    def backoff(self, value):
+        self._backoff = value
+
+    @property
+    def timeouts(self):
+        return self._timeouts
+
+    @property
+    def pool(self):
+        return self._pool
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def breaker(self, host):
+        """
+        Return the circuit breaker for host (host:port)
+        """
+        with self._breakers_lock:
+            if host not in self._breakers:
+                self._breakers[host] = retry.CircuitBreaker()
+            return self._breakers[host]
+
+    @property
+    def request_log(self):
+        return self._request_log
+    @request_log.setter
+    def request_log(self, log_file):
+        self._request_log = log_file
+
+    @property
+    def session(self):
+        # Created on first use so that connections are kept alive across
+        # requests and connect times can be recorded
+        if not self._session:
+            self._session = requests.Session()
+            adapter = telemetry.timed_http_adapter()
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
+
+    def get(self, url, endpoint='inventory', stream=False, idempotent=True):
+        """
+        Send a GET request to url.  If the client has an endpoint pool, the
+        request is sent to the least loaded healthy replica.  Requests that time out, fail to connect or
+        return a retryable status (see uframe.retry.RETRY_STATUS_CODES) are
+        retried, up to retries times, with exponential backoff and jitter.  The
+        timeout is learned from the latency of previous requests to the same
+        endpoint class, and requests are paused while the circuit breaker for
+        the host is open.
+
+        Args:
+            url: fully qualified uFrame url
+            endpoint: endpoint class of the request (inventory, data or async)
+            stream: set to True to defer downloading the response body.  The
+                caller must then complete the timing record with
+                telemetry.finish_request, pass it to log_request and close
+                the response with close_response, which releases its replica
+                in the endpoint pool.
+            idempotent: set to False for requests that must not be sent twice
+                (e.g. asynchronous requests, which queue a job).  They are
+                only retried if the connection could not be made or uFrame
+                refused them (see uframe.retry.REFUSED_STATUS_CODES).
+
+        Returns:
+            (response, timing) tuple, where timing is the telemetry record for
+            the request
+
+        Raises:
+            requests.Timeout, requests.ConnectionError once all retries fail,
+            or any other requests.RequestException, which is not retried
+        """
+
+        timing = telemetry.start_request(url, endpoint)
+
+        # Path of the request relative to /sensor/inv, used to route the request
+        # to a replica in the endpoint pool
+        path = url[len(self.url):] if self.pool and url.startswith(self.url) else None
+
+        # Replicas that failed this request are avoided on retry
+        failed = []
+        attempt = 0
+        while True:
+
+            replica = None
+            request_url = url
+            if path is not None:
+                # Inventory requests for the same array go to the same replica
+                sticky_key = path.strip('/').split('/')[0] if endpoint == 'inventory' else None
+                replica = self.pool.acquire(self.session,
+                    sticky_key=sticky_key,
+                    exclude=lambda e: e in failed or self.breaker(e.host).state == retry.CircuitBreaker.OPEN)
+                request_url = replica.url + path
+                timing['url'] = request_url
+            breaker = self.breaker(urlparse(request_url).netloc)
+
+            # Pause while the host is recovering
+            wait = breaker.wait_time()
+            while wait > 0:
+                # Reported once per transition, not on every wait
+                state = breaker.state_changed()
+                if state == retry.CircuitBreaker.OPEN:
+                    sys.stderr.write('uFrame circuit open: pausing {:0.1f} seconds ({:s})\n'.format(wait, request_url))
+                elif state == retry.CircuitBreaker.HALF_OPEN:
+                    sys.stderr.write('uFrame circuit half-open: waiting for probe request ({:s})\n'.format(request_url))
+                sys.stderr.flush()
+                time.sleep(wait)
+                wait = breaker.wait_time()
+
+            t0 = time.time()
+            try:
+                r = self.session.get(request_url,
+                    stream=stream,
+                    timeout=self.timeouts.timeout(endpoint, self.timeout, attempt=attempt))
+            except requests.RequestException as e:
+                # Every failure must be recorded, so that a failed probe does
+                # not leave the circuit half-open, and the replica released
+                breaker.record(False)
+                if replica:
+                    self.pool.release(replica, False)
+                    failed.append(replica)
+                if idempotent:
+                    retryable = isinstance(e, (requests.Timeout, requests.ConnectionError))
+                else:
+                    retryable = _connection_not_made(e)
+                if not retryable or attempt >= self.retries:
+                    telemetry.finish_request(timing, error=e.__class__.__name__)
+                    self.log_request(timing)
+                    raise
+                sys.stderr.write('{:s}: retrying ({:d}/{:d}) {:s}\n'.format(e.__class__.__name__, attempt + 1, self.retries, request_url))
+                sys.stderr.flush()
+            else:
+                success = r.status_code not in retry.RETRY_STATUS_CODES
+                retryable = idempotent or r.status_code in retry.REFUSED_STATUS_CODES
+                breaker.record(success)
+                # Requests are outstanding until the response headers arrive,
+                # or until the caller closes a streamed response (see
+                # close_response), since downloading the body loads the replica
+                if replica and stream and success:
+                    r.uframe_replica = replica
+                elif replica:
+                    self.pool.release(replica, success)
+                    if not success:
+                        failed.append(replica)
+                if success:
+                    self.timeouts.observe(endpoint, time.time() - t0)
+                    break
+                if not retryable or attempt >= self.retries:
+                    break
+                sys.stderr.write('{:d} {:s}: retrying ({:d}/{:d}) {:s}\n'.format(r.status_code, r.reason, attempt + 1, self.retries, request_url))
+                sys.stderr.flush()
+                r.close()
+
+            time.sleep(retry.backoff_delay(attempt, base=self.backoff))
+            attempt += 1
+            timing['retries'] = attempt
+
+        telemetry.headers_received(timing, r)
+        if not stream:
+            telemetry.finish_request(timing, nbytes=len(r.content))
+            self.log_request(timing)
+
+        return (r, timing)
+
+    def close_response(self, r, success=True):
+        """
+        Close the streamed response r, returned by get, and release the replica
+        that sent it, recording whether the body was received (success)
+        """
+
+        replica = getattr(r, 'uframe_replica', None)
+        r.uframe_replica = None
+        r.close()
+        if replica:
+            self.pool.release(replica, success)
+
+    def get_inventory(self, url):
+        """
+        Return the decoded JSON response to the inventory or metadata request
+        url, from the inventory cache if it has been requested before (see
+        uframe.cache).  Returns None if the request fails.  The response is
+        shared with other callers and must not be modified.
+        """
+
+        def fetch():
+            try:
+                (r, timing) = self.get(url)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                sys.stderr.write('{:s}: {:s}\n'.format(e.__class__.__name__, url))
+                return None
+
+            if r.status_code != HTTP_STATUS_OK:
+                sys.stderr.write('Request failed: {:s} ({:s})\n'.format(r.reason, url))
+                return None
+
+            return r.json()
+
+        return self.cache.get(url, fetch)
+
+    def log_request(self, timing):
+        if self.request_log:
+            telemetry.log_request(timing, self.request_log)
+
     def __repr__(self):
+        if self.pool:
+            return '<UFrame(url={:s}, endpoints={:d})>'.format(self.url, len(self.pool.endpoints))
         return '<UFrame(url={:s})>'.format(self.url)
 
 def get_arrays(array_id=None, uframe_base=UFrame()):
 
-    arrays = []
+    arrays = uframe_base.get_inventory(uframe_base.url)
+    if arrays is None:
+        return []
 
-    try:
-        r = requests.get(uframe_base.url, timeout=uframe_base.timeout)
-    except (requests.Timeout, requests.ConnectionError) as e:
-        sys.stderr.write('{:s}: {:s}\n'.format(e.message[0], uframe_base.url))
-        return arrays
-
-    if r.status_code != HTTP_STATUS_OK:
-        sys.stderr.write('Request failed: {:s} ({:s})\n'.format(r.reason, uframe_base.url))
-        return arrays
-
-    arrays = r.json()
     if not array_id:
         return arrays
 
@@ -94,17 +344,11 @@ def get_platforms(array_id, uframe_base=UFrame()):
 
     url = uframe_base.url + '/{:s}'.format(array_id)
 
-    try:
-        r = requests.get(url, timeout=uframe_base.timeout)
-    except (requests.Timeout, requests.ConnectionError) as e:
-        sys.stderr.write('{:s}: {:s}\n'.format(e.message[0], url))
-        return platforms
-
-    if r.status_code != HTTP_STATUS_OK:
-        sys.stderr.write('Request failed: {:s} ({:s})\n'.format(r.reason, url))
+    response = uframe_base.get_inventory(url)
+    if response is None:
         return platforms
 
-    return r.json()
+    return response
 
 def get_platform_sensors(array_id, platform, uframe_base=UFrame()):
 
@@ -119,17 +363,11 @@ def get_platform_sensors(array_id, platform, uframe_base=UFrame()):
 
     url = uframe_base.url + '/{:s}/{:s}'.format(array_id, platform)
 
-    try:
-        r = requests.get(url, timeout=uframe_base.timeout)
-    except (requests.Timeout, requests.ConnectionError) as e:
-        sys.stderr.write('{:s}: {:s}\n'.format(e.message[0], url))
-        return sensors
-
-    if r.status_code != HTTP_STATUS_OK:
-        sys.stderr.write('Request failed: {:s} ({:s})\n'.format(r.reason, url))
+    response = uframe_base.get_inventory(url)
+    if response is None:
         return sensors
 
-    return r.json()
+    return response
 
 def get_sensor_metadata(array_id, platform, sensor, uframe_base=UFrame()):
 
@@ -151,20 +389,46 @@ def get_sensor_metadata(array_id, platform, sensor, uframe_base=UFrame()):
         sensor
     )
 
-    try:
-        r = requests.get(url, timeout=uframe_base.timeout)
-    except (requests.Timeout, requests.ConnectionError) as e:
-        sys.stderr.write('{:s}: {:s}\n'.format(e.message[0], url))
+    response = uframe_base.get_inventory(url)
+    if response is None:
         return metadata
 
-    if r.status_code != HTTP_STATUS_OK:
-        sys.stderr.write('Request failed: {:s} ({:s})\n'.format(r.reason, url))
-        return metadata
+    return response
+
+
+def stream_parameter_ids(metadata, stream, parameters=None):
+    """
+    Return the pdIds of the parameters of stream in the sensor metadata record
+    returned by get_sensor_metadata.
+
+    Args:
+        metadata: sensor metadata record
+        stream: name of the stream
+        parameters: optional list of particleKeys or pdIds.  Only these
+            parameters are returned, in the same order.  Parameters that are not
+            in the stream are reported and skipped.
+
+    Returns:
+        pd_ids: list of parameter pdIds
+    """
+
+    stream_params = [p for p in metadata.get('parameters', []) if p['stream'] == stream]
+    if not parameters:
+        return [p['pdId'] for p in stream_params]
+
+    pd_ids = []
+    for parameter in parameters:
+        matches = [p['pdId'] for p in stream_params if parameter in [p['particleKey'], p['pdId']]]
+        if not matches:
+            sys.stderr.write('{:s}: Parameter not found in stream: {:s}\n'.format(stream, parameter))
+            sys.stderr.flush()
+            continue
+        pd_ids.append(matches[0])
 
-    return r.json()
+    return pd_ids
 
 
-def get_uframe_array(array_id, out_dir=None, exec_dpa=True, urlonly=False, deltatype='days', deltaval=1, provenance=False, limit=True, uframe_base=UFrame(), file_format='netcdf'):
+def get_uframe_array(array_id, out_dir=None, exec_dpa=True, urlonly=False, deltatype='days', deltaval=1, provenance=False, limit=True, uframe_base=UFrame(), file_format='netcdf', unzip=True, rename=None, parameters=None, json_to_nc=False, quarantine_dir=None):
     """
     Download NetCDF / JSON files for the most recent 1-day worth of data for telemetered
     and recovered data streams for the specified array_id.
@@ -175,9 +439,22 @@ def get_uframe_array(array_id, out_dir=None, exec_dpa=True, urlonly=False, delta
             Defaults to the current working directory.
         exec_dpa: set to False to NOT execute L1/L2 data product algorithms prior
             to download.  Defaults to True
+        unzip: set to False to write zip archives returned by uFrame instead
+            of extracting their members while downloading.  Defaults to True
+        rename: optional function returning the new name of each extracted
+            file (e.g. tds.timestamp_nc_file)
+        parameters: optional dict mapping stream names to the list of
+            particleKeys or pdIds to request.  Streams not in parameters are
+            requested with all parameters.
+        json_to_nc: set to True, with file_format='json', to decode JSON
+            responses incrementally and write them as NetCDF files (see
+            uframe.particles) instead of writing the JSON.  Defaults to False
+        quarantine_dir: optional directory to which NetCDF files that are not
+            complete (see uframe.ncverify) are moved after downloading
 
     Returns:
-        urls: array of dictionaries containing the url, response code and reason
+        urls: array of dictionaries containing the url, response code, reason and
+            request timing record (see uframe.telemetry)
     """
 
     fetched_urls = []
@@ -266,17 +543,21 @@ def get_uframe_array(array_id, out_dir=None, exec_dpa=True, urlonly=False, delta
                 continue
 
             for metadata in meta['times']:
-                dt1 = parser.parse(metadata['endTime'])
+                dt1 = parse_timestamp(metadata['endTime'])
                 if dt1.year < 2000:
                     sys.stderr.write('{:s}: Invalid metadata endTime: {:s}\n'.format(p_name, metadata['endTime']))
                     sys.stderr.flush()
                     continue
 
-                dt0 = dt1 - tdelta(**dict({deltatype : deltaval}))
+                dt0 = dt1 - relativedelta.relativedelta(**dict({deltatype : deltaval}))
                 ts1 = metadata['endTime']
                 ts0 = dt0.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
                 stream = metadata['stream']
                 method = metadata['method']
+                # Request only a subset of the stream parameters
+                pd_ids = None
+                if parameters and stream in parameters:
+                    pd_ids = stream_parameter_ids(meta, stream, parameters[stream])
                 dest_dir = os.path.join(out_dir, p_name, method) if not urlonly else None
 
                 fetched_url = fetch_uframe_time_bound_stream(
@@ -293,7 +574,12 @@ def get_uframe_array(array_id, out_dir=None, exec_dpa=True, urlonly=False, delta
                     urlonly = urlonly,
                     dest_dir = dest_dir,
                     provenance = provenance,
-                    limit = str(limit)
+                    limit = str(limit),
+                    unzip = unzip,
+                    rename = rename,
+                    parameters = pd_ids,
+                    json_to_nc = json_to_nc,
+                    quarantine_dir = quarantine_dir
                 )
                 fetched_urls.append(fetched_url)
 
@@ -301,7 +587,19 @@ def get_uframe_array(array_id, out_dir=None, exec_dpa=True, urlonly=False, delta
 
 
 def fetch_uframe_time_bound_stream(uframe_base, subsite, node, sensor, method, stream, begin_datetime, end_datetime,
-                                     file_format, exec_dpa, urlonly, dest_dir, provenance, limit):
+                                     file_format, exec_dpa, urlonly, dest_dir, provenance, limit, unzip=True, rename=None, parameters=None, json_to_nc=False, quarantine_dir=None):
+    """
+    Fetch the stream data between begin_datetime and end_datetime and write it to
+    dest_dir.  If uFrame returns a zip archive and unzip is True, the archive
+    members are extracted into dest_dir as they are downloaded (see
+    uframe.unzip) and, if rename is specified, renamed to rename(member_file)
+    (e.g. tds.timestamp_nc_file).  The extracted files are listed in the 'files'
+    item of the returned dictionary.  If parameters, a list of pdIds (see
+    stream_parameter_ids), is specified only those parameters are requested.
+    If quarantine_dir is specified, the NetCDF files written are verified (see
+    uframe.ncverify) and invalid files are moved to quarantine_dir and listed in
+    the 'invalid' item instead of 'files'.
+    """
        
     url = '{:s}/{:s}/{:s}/{:s}/{:s}/{:s}?beginDT={:s}&endDT={:s}&format=application/{:s}&execDPA={:s}&limit={:s}&include_provenance={:s}'.format(
         uframe_base.url,
@@ -317,6 +615,8 @@ def fetch_uframe_time_bound_stream(uframe_base, subsite, node, sensor, method, s
         limit,
         str(provenance).lower()
     )
+    if parameters:
+        url = '{:s}&parameters={:s}'.format(url, ','.join(parameters))
 
     fetched_url = {
         'url' : url,
@@ -352,8 +652,12 @@ def fetch_uframe_time_bound_stream(uframe_base, subsite, node, sensor, method, s
         if os.path.exists(dest_dir):
             sys.stdout.write('Fetching url: {:s}\n'.format(url))
             sys.stdout.flush()
+            r = None
+            # Set once the response body has been received
+            received_body = False
             try:
-                r = requests.get(url, stream=True, timeout=uframe_base.timeout)
+                (r, timing) = uframe_base.get(url, endpoint='data', stream=True)
+                fetched_url['timing'] = timing
                 fetched_url['reason'] = r.reason
                 fetched_url['code'] = r.status_code
                 if r.status_code == HTTP_STATUS_OK:
@@ -377,28 +681,112 @@ def fetch_uframe_time_bound_stream(uframe_base, subsite, node, sensor, method, s
                         node,
                         stream,
                         method,
-                        parser.parse(begin_datetime).strftime('%Y%m%dT%H%M%S'),
-                        parser.parse(end_datetime).strftime('%Y%m%dT%H%M%S'),
+                        parse_timestamp(begin_datetime).strftime('%Y%m%dT%H%M%S'),
+                        parse_timestamp(end_datetime).strftime('%Y%m%dT%H%M%S'),
                         __filename_extension[file_format]
                     )
                     file_path = os.path.join(dest_dir, file_name)
-                    sys.stdout.write('Writing file: {:s}\n'.format(file_path))
-                    sys.stdout.flush()
-                    with open(file_path, 'wb') as fid:
-                        for chunk in r.iter_content(chunk_size=1024):
-                            if chunk:
-                                fid.write(chunk)
-                                fid.flush()
+                    if file_format == 'zip' and unzip:
+                        # Extract the members while downloading instead of
+                        # writing the archive
+                        sys.stdout.write('Extracting zip file to: {:s}\n'.format(dest_dir))
+                        sys.stdout.flush()
+                        try:
+                            (fetched_url['files'], nbytes) = unzip_stream.extract_zip_stream(r.iter_content(chunk_size=65536), dest_dir, rename=rename)
+                        except unzip_stream.ZipStreamError as e:
+                            sys.stderr.write('{:s}: {:s}\n'.format(str(e), url))
+                            sys.stderr.flush()
+                            fetched_url['reason'] = str(e)
+                            telemetry.finish_request(timing, error=str(e))
+                            uframe_base.log_request(timing)
+                            return fetched_url
+                        for f in fetched_url['files']:
+                            sys.stdout.write('Extracted file: {:s}\n'.format(f))
+                        telemetry.finish_request(timing, nbytes=nbytes, file_path=dest_dir)
+                    elif file_format == 'json' and json_to_nc:
+                        # Decode the particles while downloading and write
+                        # them in columns, never holding the whole response
+                        from uframe import particles
+                        file_path = '{:s}.{:s}'.format(os.path.splitext(file_path)[0], __filename_extension['netcdf'])
+                        sys.stdout.write('Writing file: {:s}\n'.format(file_path))
+                        sys.stdout.flush()
+                        received = [0]
+                        def chunks():
+                            for chunk in r.iter_content(chunk_size=65536):
+                                received[0] += len(chunk)
+                                yield chunk
+                        try:
+                            nrecords = particles.write_particles_netcdf(particles.iter_particle_blocks(chunks()),
+                                file_path,
+                                attributes={'source_url' : url})
+                        except (particles.ParticleStreamError, ValueError, RuntimeError) as e:
+                            sys.stderr.write('{:s}: {:s}\n'.format(str(e), url))
+                            sys.stderr.flush()
+                            fetched_url['reason'] = str(e)
+                            telemetry.finish_request(timing, error=str(e))
+                            uframe_base.log_request(timing)
+                            return fetched_url
+                        sys.stdout.write('Particles written: {:d}\n'.format(nrecords))
+                        fetched_url['files'] = [file_path]
+                        telemetry.finish_request(timing, nbytes=received[0], file_path=file_path)
+                    else:
+                        sys.stdout.write('Writing file: {:s}\n'.format(file_path))
+                        sys.stdout.flush()
+                        nbytes = 0
+                        with open(file_path, 'wb') as fid:
+                            for chunk in r.iter_content(chunk_size=1024):
+                                if chunk:
+                                    fid.write(chunk)
+                                    fid.flush()
+                                    nbytes += len(chunk)
+                        fetched_url['files'] = [file_path]
+                        telemetry.finish_request(timing, nbytes=nbytes, file_path=file_path)
+                    if quarantine_dir:
+                        # Move files that are not complete NetCDF files aside
+                        nc_files = [f for f in fetched_url.get('files', []) if f.endswith('.nc')]
+                        valid = ncverify.verify_and_quarantine(nc_files, quarantine_dir=quarantine_dir)
+                        fetched_url['invalid'] = [f for f in nc_files if f not in valid]
+                        fetched_url['files'] = [f for f in fetched_url['files'] if f not in fetched_url['invalid']]
                 else:
                     sys.stderr.write('Download failed: {:d} {:s}\n'.format(r.status_code, r.reason))
                     sys.stderr.flush()
+                    telemetry.finish_request(timing, nbytes=len(r.content))
+                received_body = True
+                uframe_base.log_request(timing)
             except (requests.Timeout, requests.ConnectionError) as e:
                 sys.stderr.write('{:s}: {:s}\n'.format(e.message[0], url))
                 sys.stderr.flush()
                 fetched_url['reason'] = 'ConnectTimeout'
                 fetched_url['code'] = 500
+            finally:
+                # The replica is busy until the whole body has been read
+                if r is not None:
+                    uframe_base.close_response(r, success=received_body)
 
     return fetched_url
     
+def send_async_request(url, uframe_base=UFrame()):
+    '''Send the asynchronous request url to UFrame and return the requestUUID
+    of the queued request, or None if the request was not accepted'''
+
+    try:
+        (r, timing) = uframe_base.get(url, endpoint='async', idempotent=False)
+    except requests.RequestException as e:
+        sys.stderr.write('{:s}: {:s}\n'.format(e.__class__.__name__, url))
+        sys.stderr.flush()
+        return None
+
+    if r.status_code != 200:
+        sys.stderr.write('{:s}: {:s}\n'.format(r.reason, url))
+        sys.stderr.flush()
+        return None
+
+    try:
+        return r.json().get('requestUUID')
+    except ValueError:
+        sys.stderr.write('Invalid async request response: {:s}\n'.format(url))
+        sys.stderr.flush()
+        return None
+
 def get_metadata_by_ref_des():
     return
@@ -67,9 +67,6 @@ def test_product_availability(test_csv, uframe=None, resultsdir=None, out_csv=No
     r_param = 5
     t_param = 6
     
-    # dict for holding metadata urls
-    all_metadata = {}
-    
     # First line of test_csv contains column headers
     headers = c.next()
     # Add test result columns
@@ -90,6 +87,10 @@ def test_product_availability(test_csv, uframe=None, resultsdir=None, out_csv=No
     # Write the output headers
     out_writer.writerow(headers) 
     
+    # Reference designators whose metadata request failed: failures are not
+    # cached by the uframe inventory cache, so they are skipped here instead
+    failed_refdes = set()
+    
     for row in c:
     
         # Add the test result cells               
@@ -105,25 +106,19 @@ def test_product_availability(test_csv, uframe=None, resultsdir=None, out_csv=No
             out_writer.writerow(row)
             continue
         
-        if row[refdes] in all_metadata.keys() and not all_metadata[row[refdes]]:
+        if row[refdes] in failed_refdes:
+            # Write the results to the output file
+            out_writer.writerow(row)
             continue
-        elif row[refdes] in all_metadata.keys():
-            meta = all_metadata[row[refdes]]
-        else:    
-            # Attempt to fetch the metadata
-            sys.stdout.write('{:s}: Fetching metadata\n'.format(row[refdes]))
-            sys.stdout.flush()
             
-            meta = get_sensor_metadata(ref_tokens[0], ref_tokens[1], '{:s}-{:s}'.format(ref_tokens[2], ref_tokens[3]))
-            if not meta:
-                all_metadata[row[refdes]] = None
-                # Write the results to the output file
-                out_writer.writerow(row)
-                continue
-            
-            # Cache the metadata record so we don't have to fetch it each time for 
-            # the same reference designator
-            all_metadata[row[refdes]] = meta   
+        # Metadata for the same reference designator is fetched once and then
+        # served from the uframe inventory cache
+        meta = get_sensor_metadata(ref_tokens[0], ref_tokens[1], '{:s}-{:s}'.format(ref_tokens[2], ref_tokens[3]), uframe_base=uframe)
+        if not meta:
+            failed_refdes.add(row[refdes])
+            # Write the results to the output file
+            out_writer.writerow(row)
+            continue
         
         # Create the metadata url
         url = uframe.url + '/{:s}/{:s}/{:s}/metadata'.format(
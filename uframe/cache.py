@@ -0,0 +1,106 @@
+"""
+Memoization of uFrame inventory and metadata responses.
+
+The same inventory urls (most often sensor metadata) are requested many times
+in one run by different code paths.  InventoryCache holds the decoded responses
+in least recently used order, evicting the oldest once max_entries are held,
+and counts hits, misses and evictions.  Concurrent requests for a url that is
+being fetched wait for that fetch instead of sending their own.  Failed
+requests are not cached.
+"""
+
+import threading
+from collections import OrderedDict
+
+class InventoryCache(object):
+
+    def __init__(self, max_entries=1024):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Events set when the fetch of each in-flight url completes
+        self._in_flight = {}
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def max_entries(self):
+        return self._max_entries
+
+    def get(self, url, fetch):
+        '''Return the cached response for url or, if not cached, the response
+        returned by fetch().  fetch returns None if the request fails, in which
+        case nothing is cached.  Cached responses are shared between callers
+        and must not be modified'''
+
+        while True:
+            with self._lock:
+                if url in self._entries:
+                    self._hits += 1
+                    value = self._entries.pop(url)
+                    self._entries[url] = value
+                    return value
+                event = self._in_flight.get(url)
+                if not event:
+                    self._misses += 1
+                    event = threading.Event()
+                    self._in_flight[url] = event
+                    break
+            # Another thread is fetching url: use its response, or fetch
+            # again if it failed
+            event.wait()
+            with self._lock:
+                if url in self._entries:
+                    self._hits += 1
+                    return self._entries[url]
+
+        value = None
+        try:
+            value = fetch()
+        finally:
+            with self._lock:
+                if value is not None and self._max_entries > 0:
+                    self._entries[url] = value
+                    while len(self._entries) > self._max_entries:
+                        self._entries.popitem(last=False)
+                        self._evictions += 1
+                del self._in_flight[url]
+            event.set()
+
+        return value
+
+    def invalidate(self, url=None):
+        '''Remove the cached response for url and for every url below it (e.g.
+        an array url invalidates the array's platforms, sensors and metadata).
+        Removes every response if url is not specified.  Returns the number of
+        responses removed'''
+
+        with self._lock:
+            if url is None:
+                urls = list(self._entries.keys())
+            else:
+                prefix = url.rstrip('/') + '/'
+                urls = [u for u in self._entries if u == url or u.startswith(prefix)]
+            for u in urls:
+                del self._entries[u]
+
+        return len(urls)
+
+    def stats(self):
+        '''Return a dict of the number of cached responses, hits, misses and
+        evictions'''
+
+        with self._lock:
+            return {'entries' : len(self._entries),
+                'max_entries' : self._max_entries,
+                'hits' : self._hits,
+                'misses' : self._misses,
+                'evictions' : self._evictions}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        stats = self.stats()
+        return '<InventoryCache(entries={:d}, hits={:d}, misses={:d})>'.format(stats['entries'], stats['hits'], stats['misses'])
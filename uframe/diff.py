@@ -0,0 +1,206 @@
+"""
+Vectorized change detection between two inventory snapshots.
+
+Checking known streams for updates used to take a metadata request and four
+timestamp parses per stream, one stream at a time.  diff_snapshots joins two
+InventorySnapshots (see uframe.inventory) on (sensor, method, stream) with
+integer keys and classifies every stream with array comparisons:
+
+    added             - in current only
+    removed           - in previous only
+    extended_forward  - endTime moved later
+    extended_backward - beginTime moved earlier
+    truncated         - endTime moved earlier or beginTime moved later
+
+A stream may be both extended_forward and extended_backward.  Time bounds
+that could not be parsed (NaT) in both snapshots are unchanged; streams whose
+current time bounds could not be parsed are reported as invalid and are not
+otherwise classified, since no window can be requested for them.
+InventoryDiff.request_windows returns the time windows to request: the whole
+stream if it was added or truncated (the published dataset has to be
+rebuilt), otherwise only the newly available data before the previous
+beginTime and after the previous endTime.
+"""
+
+from uframe.inventory import CATEGORIES, format_timestamps
+
+CHANGES = ('added', 'removed', 'extended_forward', 'extended_backward', 'truncated')
+
+def _recode(snapshot, categories):
+    '''Return the codes of the categorical columns of snapshot translated into
+    the sorted category lists categories, with -1 for values not in them'''
+
+    import numpy as np
+
+    codes = {}
+    for name in CATEGORIES:
+        target = np.array(categories[name], dtype=object).astype('U') if categories[name] else np.array([], dtype='U1')
+        source = np.array(snapshot.categories[name], dtype=object).astype('U') if snapshot.categories[name] else np.array([], dtype='U1')
+        i = np.searchsorted(target, source)
+        i[i >= len(target)] = 0
+        found = (target[i] == source) if len(target) else np.zeros(len(source), dtype=bool)
+        mapping = np.where(found, i, -1)
+        codes[name] = mapping[snapshot.table[name]] if len(mapping) else np.zeros(len(snapshot.table), dtype=int) - 1
+
+    return codes
+
+def _keys(codes, sizes):
+    '''Combine the categorical codes into one int64 key per row, -1 if any code
+    is -1'''
+
+    import numpy as np
+
+    keys = (codes['sensor'].astype('int64') * sizes['method'] + codes['method']) * sizes['stream'] + codes['stream']
+    missing = (codes['sensor'] < 0) | (codes['method'] < 0) | (codes['stream'] < 0)
+    keys[missing] = -1
+
+    return keys
+
+class InventoryDiff(object):
+    '''Differences between the previous and current InventorySnapshots.  added
+    and removed are row indices into current and previous.  matched_previous
+    and matched_current are the row indices of the streams in both, and
+    extended_forward, extended_backward, truncated and unchanged boolean masks
+    over them.  invalid are the row indices into current of the streams whose
+    time bounds could not be parsed'''
+
+    def __init__(self, previous, current):
+
+        import numpy as np
+
+        self.previous = previous
+        self.current = current
+
+        # Join on (sensor, method, stream) in the category space of current
+        sizes = dict([(name, max(len(current.categories[name]), 1)) for name in CATEGORIES])
+        current_keys = _keys(dict([(name, current.table[name]) for name in CATEGORIES]), sizes)
+        previous_keys = _keys(_recode(previous, current.categories), sizes)
+
+        (keys, self.matched_previous, self.matched_current) = np.intersect1d(previous_keys, current_keys, return_indices=True)
+        matched = keys >= 0
+        self.matched_previous = self.matched_previous[matched]
+        self.matched_current = self.matched_current[matched]
+
+        unmatched = np.ones(len(current_keys), dtype=bool)
+        unmatched[self.matched_current] = False
+        self.added = np.flatnonzero(unmatched)
+        unmatched = np.ones(len(previous_keys), dtype=bool)
+        unmatched[self.matched_previous] = False
+        self.removed = np.flatnonzero(unmatched)
+
+        pb = previous.table['begin'][self.matched_previous]
+        pe = previous.table['end'][self.matched_previous]
+        cb = current.table['begin'][self.matched_current]
+        ce = current.table['end'][self.matched_current]
+
+        # NaT compares unequal to itself: bounds unparseable in both
+        # snapshots have not changed
+        changed = ~(((cb == pb) | (np.isnat(cb) & np.isnat(pb))) & ((ce == pe) | (np.isnat(ce) & np.isnat(pe))))
+        invalid = np.isnat(cb) | np.isnat(ce)
+
+        self.extended_forward = (ce > pe) & ~invalid
+        self.extended_backward = (cb < pb) & ~invalid
+        # Any other change, including previous time bounds that could not be
+        # parsed, requires the whole stream
+        self.truncated = changed & ~invalid & ~((ce >= pe) & (cb <= pb))
+        self.unchanged = ~changed
+
+        table = current.table
+        added_invalid = np.isnat(table['begin'][self.added]) | np.isnat(table['end'][self.added])
+        self.invalid = np.sort(np.concatenate([self.added[added_invalid], self.matched_current[invalid]]))
+
+    def counts(self):
+        '''Return the number of streams with each kind of change'''
+
+        return {'added' : len(self.added),
+            'removed' : len(self.removed),
+            'extended_forward' : int(self.extended_forward.sum()),
+            'extended_backward' : int(self.extended_backward.sum()),
+            'truncated' : int(self.truncated.sum()),
+            'unchanged' : int(self.unchanged.sum()),
+            'invalid' : len(self.invalid)}
+
+    def __repr__(self):
+        return '<InventoryDiff({:s})>'.format(', '.join(['{:s}={:d}'.format(k, v) for (k, v) in sorted(self.counts().items())]))
+
+    def request_windows(self, changes=CHANGES):
+        '''Return the time windows to request for the streams with the
+        specified changes, as stream records (sensor, method, stream,
+        beginTime, endTime) with the change that caused each window.  Streams
+        with invalid time bounds have no windows'''
+
+        import numpy as np
+
+        rows = []
+        begins = []
+        ends = []
+        kinds = []
+
+        def add(current_rows, begin, end, change):
+            rows.append(current_rows)
+            begins.append(begin)
+            ends.append(end)
+            kinds.extend([change] * len(current_rows))
+
+        table = self.current.table
+        if 'added' in changes:
+            i = np.setdiff1d(self.added, self.invalid)
+            add(i, table['begin'][i], table['end'][i], 'added')
+
+        # Truncated streams are requested whole, and no partial windows
+        truncated = self.truncated if 'truncated' in changes else np.zeros(len(self.matched_current), dtype=bool)
+        if 'truncated' in changes:
+            i = self.matched_current[truncated]
+            add(i, table['begin'][i], table['end'][i], 'truncated')
+
+        if 'extended_backward' in changes:
+            mask = self.extended_backward & ~truncated
+            i = self.matched_current[mask]
+            add(i, table['begin'][i], self.previous.table['begin'][self.matched_previous[mask]], 'extended_backward')
+
+        if 'extended_forward' in changes:
+            mask = self.extended_forward & ~truncated
+            i = self.matched_current[mask]
+            add(i, self.previous.table['end'][self.matched_previous[mask]], table['end'][i], 'extended_forward')
+
+        if not rows:
+            return []
+
+        rows = np.concatenate(rows)
+        begins = format_timestamps(np.concatenate(begins))
+        ends = format_timestamps(np.concatenate(ends))
+        columns = [np.array(self.current.categories[name], dtype=object)[table[name][rows]].tolist() for name in CATEGORIES]
+
+        return [{'sensor' : sensor,
+            'method' : method,
+            'stream' : stream,
+            'beginTime' : begin,
+            'endTime' : end,
+            'change' : change} for (sensor, method, stream, begin, end, change) in zip(columns[0], columns[1], columns[2], begins, ends, kinds)]
+
+    def invalid_records(self):
+        '''Return the stream records of the current streams whose time bounds
+        could not be parsed'''
+
+        import numpy as np
+
+        mask = np.zeros(len(self.current), dtype=bool)
+        mask[self.invalid] = True
+
+        return self.current.records(mask)
+
+    def removed_records(self):
+        '''Return the stream records of the removed streams'''
+
+        import numpy as np
+
+        mask = np.zeros(len(self.previous), dtype=bool)
+        mask[self.removed] = True
+
+        return self.previous.records(mask)
+
+def diff_snapshots(previous, current):
+    '''Return the InventoryDiff between the previous and current
+    InventorySnapshots'''
+
+    return InventoryDiff(previous, current)
@@ -0,0 +1,324 @@
+"""
+Columnar snapshots of the uFrame inventory.
+
+Crawling the inventory (arrays, platforms, sensors and the metadata of each
+sensor) takes thousands of requests and every consumer used to repeat it and
+keep the result as nested dicts.  An InventorySnapshot holds one row per
+sensor, method and stream with the stream beginTime and endTime, its number of
+parameters and its particle count, in a NumPy structured array.  The sensor
+(reference designator), method and stream names are stored as integer codes
+into sorted category lists, so that the table is small and rows sort and join
+on integers.
+
+Snapshots are saved as:
+
+    .npy     - the structured array, which np.load memory maps, so that a
+               snapshot of the whole system loads instantly, and a .json
+               sidecar holding the categories and attributes
+    .parquet - dictionary encoded columns, if pyarrow is installed
+    .csv     - one row per stream, the fallback when pyarrow is not installed
+
+InventorySnapshot.records() returns rows in the format of the known stream
+files (sensor, method, stream, beginTime, endTime), from which
+tds.build_async_query_from_stream_meta builds request urls without contacting
+uFrame.
+"""
+
+import os
+import sys
+import csv
+import json
+import datetime
+from uframe import get_arrays, get_platforms, get_platform_sensors, get_sensor_metadata
+from uframe.timestamps import to_datetime64
+
+# Categorical columns, stored as int32 codes into their categories
+CATEGORIES = ('sensor', 'method', 'stream')
+
+DTYPE = [('sensor', '<i4'),
+    ('method', '<i4'),
+    ('stream', '<i4'),
+    ('begin', '<M8[ms]'),
+    ('end', '<M8[ms]'),
+    ('parameters', '<i4'),
+    ('count', '<i8')]
+
+CSV_COLUMNS = ['sensor', 'method', 'stream', 'beginTime', 'endTime', 'parameter_count', 'count']
+
+def crawl_inventory(uframe_base, array_id=None, threads=8):
+    '''Crawl the inventory of uframe_base, or of array_id only, and return one
+    record (sensor, method, stream, beginTime, endTime, parameter_count, count)
+    per stream.  Sensor metadata is requested by threads threads'''
+
+    sensors = []
+    for array in get_arrays(array_id, uframe_base=uframe_base):
+        for platform in get_platforms(array, uframe_base=uframe_base):
+            for sensor in get_platform_sensors(array, platform, uframe_base=uframe_base):
+                sensors.append((array, platform, sensor))
+
+    def fetch(args):
+        return get_sensor_metadata(args[0], args[1], args[2], uframe_base=uframe_base)
+
+    if threads > 1 and len(sensors) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(threads, len(sensors)))
+        try:
+            metadata = pool.map(fetch, sensors)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        metadata = [fetch(s) for s in sensors]
+
+    records = []
+    for ((array, platform, sensor), meta) in zip(sensors, metadata):
+        if not meta:
+            continue
+        refdes = '{:s}-{:s}-{:s}'.format(array, platform, sensor)
+        parameter_counts = {}
+        for p in meta.get('parameters', []):
+            parameter_counts[p.get('stream')] = parameter_counts.get(p.get('stream'), 0) + 1
+        for t in meta.get('times', []):
+            records.append({'sensor' : refdes,
+                'method' : t['method'],
+                'stream' : t['stream'],
+                'beginTime' : t['beginTime'],
+                'endTime' : t['endTime'],
+                'parameter_count' : parameter_counts.get(t['stream'], 0),
+                'count' : t.get('count') or 0})
+
+    return records
+
+def format_timestamps(values):
+    '''Format the datetime64 array values as UFrame timestamps
+    (YYYY-MM-DDTHH:MM:SS.fffZ).  NaT values are empty strings'''
+
+    import numpy as np
+
+    strings = np.datetime_as_string(values.astype('datetime64[ms]'), unit='ms')
+
+    return ['' if s == 'NaT' else '{:s}Z'.format(s) for s in strings]
+
+class InventorySnapshot(object):
+    '''Table of the streams in the uFrame inventory.  table is a NumPy
+    structured array (DTYPE) sorted by sensor, method and stream, categories
+    maps each categorical column to the sorted list of its values and
+    attributes holds the snapshot provenance (uframe url, creation time)'''
+
+    def __init__(self, table, categories, attributes=None):
+        self._table = table
+        self._categories = categories
+        self._attributes = attributes or {}
+        self._lookup = {}
+
+    @classmethod
+    def from_records(cls, records, attributes=None):
+        '''Build a snapshot from records as returned by crawl_inventory'''
+
+        import numpy as np
+
+        table = np.zeros(len(records), dtype=DTYPE)
+        categories = {}
+        for name in CATEGORIES:
+            (values, codes) = np.unique(np.array([r[name] for r in records] or [], dtype=object).astype('U'), return_inverse=True)
+            categories[name] = [str(v) for v in values]
+            table[name] = codes
+        table['begin'] = to_datetime64([r['beginTime'] for r in records])
+        table['end'] = to_datetime64([r['endTime'] for r in records])
+        table['parameters'] = [int(r.get('parameter_count') or 0) for r in records]
+        table['count'] = [int(r.get('count') or 0) for r in records]
+
+        table = table[np.lexsort((table['stream'], table['method'], table['sensor']))]
+
+        attributes = dict(attributes or {})
+        attributes.setdefault('created', datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+        return cls(table, categories, attributes)
+
+    @property
+    def table(self):
+        return self._table
+
+    @property
+    def categories(self):
+        return self._categories
+
+    @property
+    def attributes(self):
+        return self._attributes
+
+    def __len__(self):
+        return len(self._table)
+
+    def __repr__(self):
+        return '<InventorySnapshot(streams={:d}, sensors={:d})>'.format(len(self._table), len(self._categories['sensor']))
+
+    def code(self, name, value):
+        '''Return the code of value in the categorical column name, or -1 if
+        value is not in the snapshot'''
+
+        if name not in self._lookup:
+            self._lookup[name] = dict([(v, i) for (i, v) in enumerate(self._categories[name])])
+
+        return self._lookup[name].get(value, -1)
+
+    def column(self, name):
+        '''Return the column name, decoded to its values if categorical'''
+
+        import numpy as np
+
+        if name in CATEGORIES:
+            return np.array(self._categories[name], dtype=object)[self._table[name]]
+
+        return self._table[name]
+
+    def mask(self, sensor=None, method=None, stream=None, subsite=None):
+        '''Return the boolean mask of the rows matching all of the specified
+        sensor (reference designator), method, stream and subsite'''
+
+        import numpy as np
+
+        selected = np.ones(len(self._table), dtype=bool)
+        for (name, value) in [('sensor', sensor), ('method', method), ('stream', stream)]:
+            if value is not None:
+                selected &= self._table[name] == self.code(name, value)
+        if subsite is not None:
+            codes = [i for (i, s) in enumerate(self._categories['sensor']) if s.split('-')[0] == subsite]
+            selected &= np.isin(self._table['sensor'], codes)
+
+        return selected
+
+    def select(self, **kwargs):
+        '''Return a snapshot of the rows matching mask(**kwargs)'''
+
+        return InventorySnapshot(self._table[self.mask(**kwargs)], self._categories, self._attributes)
+
+    def records(self, mask=None):
+        '''Return the rows, or the rows selected by the boolean mask, as stream
+        records (sensor, method, stream, beginTime, endTime, parameter_count,
+        count)'''
+
+        table = self._table if mask is None else self._table[mask]
+        sensors = self._categories['sensor']
+        methods = self._categories['method']
+        streams = self._categories['stream']
+        begin = format_timestamps(table['begin'])
+        end = format_timestamps(table['end'])
+
+        return [{'sensor' : sensors[row['sensor']],
+            'method' : methods[row['method']],
+            'stream' : streams[row['stream']],
+            'beginTime' : begin[i],
+            'endTime' : end[i],
+            'parameter_count' : int(row['parameters']),
+            'count' : int(row['count'])} for (i, row) in enumerate(table)]
+
+    def save(self, snapshot_file):
+        '''Write the snapshot to snapshot_file, in the format given by its
+        extension (.npy, .parquet or .csv).  .parquet files are written as .csv
+        if pyarrow is not installed.  Returns the name of the file written'''
+
+        ext = os.path.splitext(snapshot_file)[1].lower()
+        if ext == '.parquet':
+            try:
+                return self._save_parquet(snapshot_file)
+            except ImportError:
+                snapshot_file = '{:s}.csv'.format(os.path.splitext(snapshot_file)[0])
+                sys.stderr.write('pyarrow not installed: writing {:s}\n'.format(snapshot_file))
+                ext = '.csv'
+
+        if ext == '.csv':
+            return self._save_csv(snapshot_file)
+
+        import numpy as np
+
+        if ext != '.npy':
+            snapshot_file = '{:s}.npy'.format(snapshot_file)
+        np.save(snapshot_file, self._table)
+        with open(sidecar_file(snapshot_file), 'w') as fid:
+            json.dump({'categories' : self._categories, 'attributes' : self._attributes}, fid, sort_keys=True)
+
+        return snapshot_file
+
+    def _save_parquet(self, snapshot_file):
+
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        columns = []
+        for name in CATEGORIES:
+            columns.append(pa.DictionaryArray.from_arrays(pa.array(np.ascontiguousarray(self._table[name])), pa.array(self._categories[name])))
+        for name in ['begin', 'end', 'parameters', 'count']:
+            columns.append(pa.array(np.ascontiguousarray(self._table[name])))
+        table = pa.Table.from_arrays(columns, names=list(CATEGORIES) + ['begin', 'end', 'parameters', 'count'])
+        table = table.replace_schema_metadata({'attributes' : json.dumps(self._attributes, sort_keys=True)})
+        pq.write_table(table, snapshot_file)
+
+        return snapshot_file
+
+    def _save_csv(self, snapshot_file):
+
+        with open(snapshot_file, 'w') as fid:
+            csv_writer = csv.writer(fid)
+            csv_writer.writerow(CSV_COLUMNS)
+            for r in self.records():
+                csv_writer.writerow([r[c] for c in CSV_COLUMNS])
+
+        return snapshot_file
+
+    @classmethod
+    def load(cls, snapshot_file, mmap=True):
+        '''Load the snapshot saved in snapshot_file.  .npy snapshots are memory
+        mapped unless mmap is False'''
+
+        ext = os.path.splitext(snapshot_file)[1].lower()
+        if ext == '.csv':
+            with open(snapshot_file, 'r') as fid:
+                return cls.from_records(list(csv.DictReader(fid)))
+        elif ext == '.parquet':
+            return cls._load_parquet(snapshot_file)
+
+        import numpy as np
+
+        table = np.load(snapshot_file, mmap_mode='r' if mmap else None)
+        with open(sidecar_file(snapshot_file), 'r') as fid:
+            sidecar = json.load(fid)
+
+        return cls(table, sidecar['categories'], sidecar.get('attributes'))
+
+    @classmethod
+    def _load_parquet(cls, snapshot_file):
+
+        import numpy as np
+        import pyarrow.parquet as pq
+
+        parquet_table = pq.read_table(snapshot_file)
+        table = np.zeros(parquet_table.num_rows, dtype=DTYPE)
+        categories = {}
+        for name in CATEGORIES:
+            column = parquet_table.column(name).combine_chunks()
+            categories[name] = column.dictionary.to_pylist()
+            table[name] = column.indices.to_numpy(zero_copy_only=False)
+        for name in ['begin', 'end', 'parameters', 'count']:
+            table[name] = parquet_table.column(name).to_numpy()
+
+        metadata = parquet_table.schema.metadata or {}
+        attributes = json.loads(metadata.get(b'attributes', b'{}').decode('utf-8'))
+
+        return cls(table, categories, attributes)
+
+def sidecar_file(snapshot_file):
+    '''Return the name of the .json file holding the categories and attributes
+    of the .npy snapshot_file'''
+
+    return '{:s}.json'.format(os.path.splitext(snapshot_file)[0])
+
+def snapshot_inventory(uframe_base, array_id=None, threads=8):
+    '''Crawl the inventory of uframe_base, or of array_id only, and return it as
+    an InventorySnapshot'''
+
+    records = crawl_inventory(uframe_base, array_id=array_id, threads=threads)
+
+    return InventorySnapshot.from_records(records, attributes={'uframe' : uframe_base.url,
+        'array' : array_id or ''})
@@ -0,0 +1,36 @@
+"""
+Deferred imports of heavy dependencies.
+
+requests, dateutil and netCDF4 take most of the start up time of the scripts,
+yet many runs (-v checks, debug runs, cron invocations with nothing to do)
+never use them.  lazy_module returns a stand-in for a module that imports it
+on first attribute access, so that the module is only loaded on the code
+paths that use it.
+"""
+
+import types
+import importlib
+
+class LazyModule(types.ModuleType):
+    '''Module proxy importing the named module on first attribute access'''
+
+    def __init__(self, name):
+        types.ModuleType.__init__(self, name)
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self.__dict__['_module'] is None:
+            self.__dict__['_module'] = importlib.import_module(self.__name__)
+        return self.__dict__['_module']
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+        return '<lazy module {:s} ({:s})>'.format(self.__name__, state)
+
+def lazy_module(name):
+    '''Return a LazyModule for the module name (e.g. dateutil.parser)'''
+
+    return LazyModule(name)
@@ -0,0 +1,306 @@
+"""
+Fast structural verification of NetCDF files.
+
+A truncated or corrupt NetCDF file that reaches THREDDS breaks the NCML
+aggregation of the whole stream.  verify_nc_file checks a file without
+decoding it: the file is memory mapped, the magic bytes identify it as
+classic (CDF-1), 64-bit offset (CDF-2), 64-bit data (CDF-5) or NetCDF4/HDF5,
+and the header is read to compute the length the file must have:
+
+    classic formats - the header is parsed and the file must extend to the
+                      end of the last fixed size variable and of the last
+                      record (numrecs records)
+    NetCDF4/HDF5    - the superblock, at offset 0 or after a user block, must
+                      be complete and the file must extend to its end of file
+                      address
+
+Only the header pages are read, so verifying a file costs about the same
+whatever its size.  verify_nc_files checks files in parallel and
+quarantine_file moves a bad file aside, with a .reason file, so that it is
+not published.
+"""
+
+import os
+import sys
+import mmap
+import time
+import errno
+import shutil
+import struct
+
+CLASSIC_MAGIC = {b'CDF\x01' : 'CDF-1', b'CDF\x02' : 'CDF-2', b'CDF\x05' : 'CDF-5'}
+HDF5_MAGIC = b'\x89HDF\r\n\x1a\n'
+
+# Superblock offsets searched for HDF5 files with a user block
+_HDF5_MAX_USERBLOCK = 1024 * 1024
+
+_NC_DIMENSION = 0x0A
+_NC_VARIABLE = 0x0B
+_NC_ATTRIBUTE = 0x0C
+
+# Sizes, in bytes, of the classic NetCDF external types
+_NC_TYPE_SIZES = {1 : 1, 2 : 1, 3 : 2, 4 : 4, 5 : 4, 6 : 8, 7 : 1, 8 : 2, 9 : 4, 10 : 8, 11 : 8}
+
+_STREAMING = (0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF)
+
+QUARANTINE_REASON_SUFFIX = '.reason'
+
+class NetCDFHeaderError(Exception):
+    pass
+
+class _HeaderReader(object):
+    '''Reads the big-endian fields of a classic NetCDF header from a buffer'''
+
+    def __init__(self, buf, version):
+        self._buf = buf
+        self._size = len(buf)
+        self.offset = 4
+        # CDF-5 uses 64-bit sizes and counts
+        self._count_format = '>Q' if version == 5 else '>I'
+        self._count_size = 8 if version == 5 else 4
+
+    def _unpack(self, fmt, size):
+        if self.offset + size > self._size:
+            raise NetCDFHeaderError('header extends past end of file')
+        value = struct.unpack_from(fmt, self._buf, self.offset)[0]
+        self.offset += size
+        return value
+
+    def int32(self):
+        return self._unpack('>I', 4)
+
+    def count(self):
+        return self._unpack(self._count_format, self._count_size)
+
+    def offset_value(self, size):
+        return self._unpack('>Q' if size == 8 else '>I', size)
+
+    def skip(self, nbytes):
+        # Values are padded to 4 byte boundaries
+        nbytes += (4 - nbytes % 4) % 4
+        if self.offset + nbytes > self._size:
+            raise NetCDFHeaderError('header extends past end of file')
+        self.offset += nbytes
+
+    def name(self):
+        nchars = self.count()
+        start = self.offset
+        self.skip(nchars)
+        return self._buf[start:start + nchars]
+
+    def list_header(self, tag):
+        list_tag = self.int32()
+        nelems = self.count()
+        if list_tag == 0 and nelems == 0:
+            return 0
+        if list_tag != tag:
+            raise NetCDFHeaderError('invalid list tag {:d} at byte {:d}'.format(list_tag, self.offset - 4 - self._count_size))
+        return nelems
+
+    def attributes(self):
+        for i in range(self.list_header(_NC_ATTRIBUTE)):
+            self.name()
+            nc_type = self.int32()
+            if nc_type not in _NC_TYPE_SIZES:
+                raise NetCDFHeaderError('invalid attribute type {:d}'.format(nc_type))
+            self.skip(self.count() * _NC_TYPE_SIZES[nc_type])
+
+def classic_expected_size(buf, version):
+    '''Return the minimum size, in bytes, of the classic format NetCDF file in
+    buf, computed from its header, or None if the file is being streamed
+    (numrecs is not set).  Raises NetCDFHeaderError if the header is invalid'''
+
+    header = _HeaderReader(buf, version)
+    numrecs = header.count()
+
+    dims = []
+    for i in range(header.list_header(_NC_DIMENSION)):
+        header.name()
+        dims.append(header.count())
+
+    header.attributes()
+
+    offset_size = 4 if version == 1 else 8
+    fixed_end = 0
+    record_vars = []
+    for i in range(header.list_header(_NC_VARIABLE)):
+        header.name()
+        dimids = [header.count() for d in range(header.count())]
+        header.attributes()
+        nc_type = header.int32()
+        header.count()
+        begin = header.offset_value(offset_size)
+        if nc_type not in _NC_TYPE_SIZES:
+            raise NetCDFHeaderError('invalid variable type {:d}'.format(nc_type))
+        if any([d >= len(dims) for d in dimids]):
+            raise NetCDFHeaderError('invalid dimension id')
+
+        is_record = bool(dimids) and dims[dimids[0]] == 0
+        size = _NC_TYPE_SIZES[nc_type]
+        for d in dimids[1 if is_record else 0:]:
+            size *= dims[d]
+
+        if is_record:
+            record_vars.append((begin, size))
+        else:
+            fixed_end = max(fixed_end, begin + size)
+
+    expected = max(fixed_end, header.offset)
+    if record_vars:
+        if numrecs in _STREAMING:
+            return None
+        if len(record_vars) == 1:
+            record_size = record_vars[0][1]
+        else:
+            record_size = sum([s + (4 - s % 4) % 4 for (b, s) in record_vars])
+        if numrecs:
+            expected = max([expected] + [b + (numrecs - 1) * record_size + s for (b, s) in record_vars])
+
+    return expected
+
+def hdf5_expected_size(buf, superblock):
+    '''Return the minimum size, in bytes, of the HDF5 file in buf whose
+    superblock starts at byte superblock, from the end of file address, or None
+    if it is undefined.  Raises NetCDFHeaderError if the superblock is
+    incomplete or its version unknown'''
+
+    size = len(buf)
+    if superblock + 16 > size:
+        raise NetCDFHeaderError('incomplete HDF5 superblock')
+
+    version = struct.unpack_from('B', buf, superblock + 8)[0]
+    if version in (0, 1):
+        offset_size = struct.unpack_from('B', buf, superblock + 13)[0]
+        base = superblock + (24 if version == 0 else 28)
+    elif version in (2, 3):
+        offset_size = struct.unpack_from('B', buf, superblock + 9)[0]
+        base = superblock + 12
+    else:
+        raise NetCDFHeaderError('unknown HDF5 superblock version {:d}'.format(version))
+
+    if offset_size not in (2, 4, 8):
+        raise NetCDFHeaderError('invalid HDF5 size of offsets {:d}'.format(offset_size))
+    fmt = {2 : '<H', 4 : '<I', 8 : '<Q'}[offset_size]
+    if base + 3 * offset_size > size:
+        raise NetCDFHeaderError('incomplete HDF5 superblock')
+
+    base_address = struct.unpack_from(fmt, buf, base)[0]
+    # Free space (v0/1) or superblock extension (v2/3) address, then the end
+    # of file address, relative to the base address
+    eof_address = struct.unpack_from(fmt, buf, base + 2 * offset_size)[0]
+    if eof_address == (1 << (8 * offset_size)) - 1:
+        return None
+
+    return base_address + eof_address
+
+def verify_nc_file(nc_file):
+    '''Check that nc_file is a complete NetCDF file.  Returns None if it is,
+    otherwise the reason it is not'''
+
+    try:
+        fid = open(nc_file, 'rb')
+    except IOError as e:
+        return e.strerror
+
+    try:
+        size = os.fstat(fid.fileno()).st_size
+        if size == 0:
+            return 'empty file'
+        if size < 4:
+            return 'truncated: {:d} bytes'.format(size)
+
+        buf = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic = buf[:4]
+            if magic in CLASSIC_MAGIC:
+                expected = classic_expected_size(buf, ord(magic[3:4]))
+            else:
+                superblock = 0
+                while superblock < min(size, _HDF5_MAX_USERBLOCK) and buf[superblock:superblock + 8] != HDF5_MAGIC:
+                    superblock = 512 if not superblock else superblock * 2
+                if superblock >= min(size, _HDF5_MAX_USERBLOCK):
+                    return 'not a NetCDF file'
+                expected = hdf5_expected_size(buf, superblock)
+        except NetCDFHeaderError as e:
+            return 'invalid header: {:s}'.format(str(e))
+        finally:
+            buf.close()
+    except (IOError, OSError, ValueError) as e:
+        return str(e)
+    finally:
+        fid.close()
+
+    if expected is not None and size < expected:
+        return 'truncated: {:d} of {:d} bytes'.format(size, expected)
+
+    return None
+
+def verify_nc_files(nc_files, processes=4):
+    '''Verify each file in nc_files in parallel.  Returns a dict mapping each
+    file to None if it is valid, or to the reason it is not'''
+
+    if not nc_files:
+        return {}
+
+    if processes < 2 or len(nc_files) == 1:
+        return dict([(f, verify_nc_file(f)) for f in nc_files])
+
+    # Verification waits on reading the header pages, so threads keep several
+    # reads in flight
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(processes, len(nc_files)))
+    try:
+        reasons = pool.map(verify_nc_file, nc_files)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(zip(nc_files, reasons))
+
+def quarantine_file(nc_file, quarantine_dir, reason):
+    '''Move nc_file to quarantine_dir, next to a .reason file recording its
+    original location, the time and reason.  Returns the quarantined file, or
+    None if it could not be moved'''
+
+    try:
+        os.makedirs(quarantine_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            sys.stderr.write('{:s}: {:s}\n'.format(quarantine_dir, e.strerror))
+            return None
+
+    quarantined = os.path.join(quarantine_dir, os.path.basename(nc_file))
+    if os.path.exists(quarantined):
+        quarantined = '{:s}.{:d}'.format(quarantined, int(time.time() * 1000))
+
+    try:
+        shutil.move(nc_file, quarantined)
+        with open('{:s}{:s}'.format(quarantined, QUARANTINE_REASON_SUFFIX), 'w') as fid:
+            fid.write('file: {:s}\n'.format(os.path.abspath(nc_file)))
+            fid.write('time: {:s}\n'.format(time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())))
+            fid.write('reason: {:s}\n'.format(reason))
+    except (IOError, OSError) as e:
+        sys.stderr.write('Failed to quarantine {:s}: {:s}\n'.format(nc_file, str(e)))
+        return None
+
+    return quarantined
+
+def verify_and_quarantine(nc_files, quarantine_dir=None, processes=4):
+    '''Verify nc_files and return the valid ones.  Invalid files are reported
+    and, if quarantine_dir is specified, moved to it'''
+
+    reasons = verify_nc_files(nc_files, processes=processes)
+
+    valid = []
+    for nc_file in nc_files:
+        reason = reasons[nc_file]
+        if reason is None:
+            valid.append(nc_file)
+            continue
+        sys.stderr.write('Invalid NetCDF file ({:s}): {:s}\n'.format(reason, nc_file))
+        if quarantine_dir:
+            quarantined = quarantine_file(nc_file, quarantine_dir, reason)
+            if quarantined:
+                sys.stderr.write('Quarantined: {:s}\n'.format(quarantined))
+
+    return valid
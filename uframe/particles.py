@@ -0,0 +1,252 @@
+"""
+Incremental decoding of uFrame JSON data responses into columnar NumPy arrays.
+
+A uFrame JSON data response is an array of particles, each an object mapping
+parameter names to values.  Decoding the whole response with json.loads creates
+one dict per particle, which for large responses uses many times the size of
+the data.  Here particles are decoded one at a time from the response chunks
+and collected into blocks of at most block_size particles, each block holding
+one NumPy array per parameter, so that only one block of particles is ever held
+as Python objects.  Blocks can be concatenated into columns or written, one at
+a time, to a NetCDF file.
+"""
+
+import re
+import sys
+import json
+import codecs
+import numpy as np
+
+DEFAULT_BLOCK_SIZE = 10000
+
+try:
+    _STRING_TYPES = (str, unicode)
+except NameError:
+    _STRING_TYPES = (str,)
+
+_WHITESPACE = re.compile(r'[\s,]*')
+
+class ParticleStreamError(Exception):
+    pass
+
+def iter_particles(chunks):
+    '''Yield the particles of the JSON array read from the iterator of chunks
+    (e.g. requests.Response.iter_content), decoding one particle at a time'''
+
+    decoder = json.JSONDecoder()
+    # Multi-byte characters may be split across chunks
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    started = False
+    done = False
+
+    while not done:
+        chunk = next(chunks, None)
+        if chunk is None:
+            done = True
+        else:
+            buf += text.decode(chunk) if isinstance(chunk, bytes) else chunk
+
+        if not started:
+            buf = buf.lstrip()
+            if not buf:
+                continue
+            if buf[0] != '[':
+                raise ParticleStreamError('uFrame JSON response is not an array')
+            buf = buf[1:]
+            started = True
+
+        i = 0
+        while True:
+            i = _WHITESPACE.match(buf, i).end()
+            if i >= len(buf):
+                break
+            if buf[i] == ']':
+                return
+            try:
+                (particle, end) = decoder.raw_decode(buf, i)
+            except ValueError:
+                # Incomplete particle: wait for the next chunk
+                if done:
+                    raise ParticleStreamError('Truncated uFrame JSON response')
+                break
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(buf) and not done and not isinstance(particle, (dict, list)):
+                break
+            yield particle
+            i = end
+        buf = buf[i:]
+
+    if started:
+        raise ParticleStreamError('Truncated uFrame JSON response')
+
+def flatten_particle(particle, prefix=''):
+    '''Flatten nested objects (e.g. the pk object) into name_key parameters'''
+
+    flat = {}
+    for (name, value) in particle.items():
+        if isinstance(value, dict):
+            flat.update(flatten_particle(value, '{:s}{:s}_'.format(prefix, name)))
+        else:
+            flat['{:s}{:s}'.format(prefix, name)] = value
+
+    return flat
+
+def _column(values):
+    '''Convert the list of values of one parameter, with None for missing values,
+    to a NumPy array: strings to an object array, lists of numbers to a 2-d
+    float array and numbers and booleans to a float array with NaN for missing
+    values'''
+
+    present = [v for v in values if v is not None]
+    if any([isinstance(v, _STRING_TYPES) for v in present]):
+        return np.array([v if isinstance(v, _STRING_TYPES) else ('' if v is None else json.dumps(v)) for v in values], dtype=object)
+
+    if any([isinstance(v, list) for v in present]):
+        width = max([len(v) for v in present if isinstance(v, list)])
+        column = np.empty((len(values), width))
+        column.fill(np.nan)
+        for (i, v) in enumerate(values):
+            if isinstance(v, list):
+                try:
+                    column[i, :len(v)] = [np.nan if x is None else x for x in v]
+                except (TypeError, ValueError):
+                    pass
+        return column
+
+    column = np.empty(len(values))
+    column.fill(np.nan)
+    for (i, v) in enumerate(values):
+        if v is not None:
+            column[i] = v
+
+    return column
+
+def iter_particle_blocks(chunks, block_size=DEFAULT_BLOCK_SIZE):
+    '''Yield blocks of the particles read from chunks as dicts mapping each
+    parameter to a NumPy array of block length.  Parameters missing from a
+    particle are NaN (numbers) or empty strings'''
+
+    block = []
+    for particle in iter_particles(chunks):
+        block.append(flatten_particle(particle))
+        if len(block) >= block_size:
+            yield _block_columns(block)
+            block = []
+
+    if block:
+        yield _block_columns(block)
+
+def _block_columns(block):
+
+    names = []
+    seen = set()
+    for particle in block:
+        for name in particle:
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+
+    return dict([(name, _column([p.get(name) for p in block])) for name in names])
+
+def particle_columns(chunks, block_size=DEFAULT_BLOCK_SIZE):
+    '''Return a dict mapping each parameter of the particles read from chunks to
+    a NumPy array of all of its values'''
+
+    blocks = []
+    nrecords = 0
+    names = []
+    for block in iter_particle_blocks(chunks, block_size=block_size):
+        n = len(next(iter(block.values())))
+        blocks.append((nrecords, n, block))
+        nrecords += n
+        names.extend([name for name in block if name not in names])
+
+    columns = {}
+    for name in names:
+        parts = []
+        for (start, n, block) in blocks:
+            if name in block:
+                parts.append(block[name])
+            else:
+                parts.append(_column([None] * n))
+        columns[name] = _concatenate(parts)
+
+    return columns
+
+def _concatenate(parts):
+
+    if any([p.dtype == object for p in parts]):
+        parts = [p if p.dtype == object else np.array(['' if np.isnan(x) else repr(x) for x in p.ravel()], dtype=object) for p in parts]
+        return np.concatenate(parts)
+
+    width = max([p.shape[1] if p.ndim > 1 else 1 for p in parts])
+    if width > 1 or any([p.ndim > 1 for p in parts]):
+        parts = [_widen(p, width) for p in parts]
+
+    return np.concatenate(parts)
+
+def _widen(part, width):
+
+    if part.ndim == 1:
+        part = part.reshape((-1, 1))
+    if part.shape[1] == width:
+        return part
+    wide = np.empty((part.shape[0], width))
+    wide.fill(np.nan)
+    wide[:, :part.shape[1]] = part
+    return wide
+
+def _variable_name(name):
+    return re.sub(r'[^\w]', '_', name)
+
+def write_particles_netcdf(blocks, nc_file, attributes=None):
+    '''Write the particle blocks (see iter_particle_blocks) to the NetCDF4 file
+    nc_file, one block at a time, along the unlimited obs dimension.  Strings are
+    written as variable length strings and list parameters as 2-d variables.
+    Returns the number of particles written'''
+
+    from netCDF4 import Dataset
+
+    nco = Dataset(nc_file, 'w', format='NETCDF4')
+    nrecords = 0
+    try:
+        nco.createDimension('obs', None)
+        if attributes:
+            nco.setncatts(attributes)
+
+        for block in blocks:
+            n = len(next(iter(block.values())))
+            for (name, column) in block.items():
+                var_name = _variable_name(name)
+                if var_name not in nco.variables:
+                    if column.dtype == object:
+                        var = nco.createVariable(var_name, str, ('obs',))
+                    elif column.ndim > 1:
+                        dim_name = '{:s}_dim_1'.format(var_name)
+                        nco.createDimension(dim_name, column.shape[1])
+                        var = nco.createVariable(var_name, 'f8', ('obs', dim_name), zlib=True, fill_value=np.nan)
+                    else:
+                        var = nco.createVariable(var_name, 'f8', ('obs',), zlib=True, fill_value=np.nan)
+                    if var_name != name:
+                        var.setncattr('parameter', name)
+                var = nco.variables[var_name]
+
+                if var.dtype == str:
+                    if column.dtype != object:
+                        column = np.array(['' if np.isnan(x) else repr(x) for x in column.ravel()], dtype=object)
+                    var[nrecords:nrecords + n] = column
+                elif column.dtype == object:
+                    sys.stderr.write('{:s}: string values in numeric parameter not written\n'.format(name))
+                elif var.ndim > 1:
+                    width = var.shape[1]
+                    column = _widen(column, max(width, column.shape[1] if column.ndim > 1 else 1))[:, :width]
+                    var[nrecords:nrecords + n, :] = column
+                else:
+                    var[nrecords:nrecords + n] = column if column.ndim == 1 else column[:, 0]
+            nrecords += n
+    finally:
+        nco.close()
+
+    return nrecords
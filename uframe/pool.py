@@ -0,0 +1,130 @@
+"""
+Distribution of uFrame requests across a pool of uFrame replicas.
+"""
+
+import sys
+import time
+import threading
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+class Endpoint(object):
+    '''A single uFrame server in an EndpointPool'''
+
+    def __init__(self, base_url, port):
+        u = urlparse(base_url)
+        if u.port:
+            base_url = '{:s}://{:s}'.format(u.scheme, u.hostname)
+            port = u.port
+        self._base_url = base_url
+        self._port = port
+        self._url = '{:s}:{:d}/sensor/inv'.format(base_url, port)
+        self.outstanding = 0
+        self.failures = 0
+        self.healthy = True
+        self.checked = 0
+
+    @property
+    def base_url(self):
+        return self._base_url
+
+    @property
+    def port(self):
+        return self._port
+
+    @property
+    def url(self):
+        return self._url
+
+    @property
+    def host(self):
+        return urlparse(self._url).netloc
+
+    def __repr__(self):
+        return '<Endpoint(url={:s}, outstanding={:d}, healthy={:s})>'.format(self.url, self.outstanding, str(self.healthy))
+
+class EndpointPool(object):
+    '''Pool of uFrame replicas.  Each request is routed to the healthy endpoint
+    with the fewest outstanding requests, except that requests given a sticky
+    key (e.g. inventory requests for one array) keep going to the endpoint first
+    chosen for that key while it remains healthy, so that a crawl sees a
+    consistent inventory.  An endpoint is marked unhealthy after max_failures
+    consecutive failed requests and is re-checked, with a GET of its
+    /sensor/inv url, every health_interval seconds.'''
+
+    def __init__(self, endpoints, port=12576, max_failures=3, health_interval=60.0, health_timeout=5.0):
+        self._endpoints = [Endpoint(e, port) for e in endpoints]
+        self._max_failures = max_failures
+        self._health_interval = health_interval
+        self._health_timeout = health_timeout
+        self._sticky = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @property
+    def endpoints(self):
+        return self._endpoints
+
+    def check_health(self, session, endpoints=None):
+        '''Send a GET request to the /sensor/inv url of each endpoint (all
+        endpoints by default) and mark it healthy if it responds'''
+
+        for endpoint in endpoints or self._endpoints:
+            try:
+                r = session.get(endpoint.url, timeout=self._health_timeout)
+                healthy = r.status_code == 200
+            except Exception:
+                healthy = False
+            with self._lock:
+                if healthy and not endpoint.healthy:
+                    sys.stderr.write('uFrame endpoint healthy: {:s}\n'.format(endpoint.url))
+                endpoint.healthy = healthy
+                endpoint.failures = 0 if healthy else endpoint.failures
+                endpoint.checked = time.time()
+
+    def acquire(self, session, sticky_key=None, exclude=None):
+        '''Choose the endpoint for a request and count the request as
+        outstanding.  The caller must pass the endpoint to release once the
+        response has been received.  Endpoints for which exclude(endpoint)
+        returns True (e.g. hosts whose circuit breaker is open) are avoided if
+        possible'''
+
+        # Re-check unhealthy endpoints whose health check is due
+        now = time.time()
+        due = [e for e in self._endpoints if not e.healthy and now - e.checked >= self._health_interval]
+        if due:
+            self.check_health(session, due)
+
+        with self._lock:
+            candidates = [e for e in self._endpoints if e.healthy and not (exclude and exclude(e))]
+            if not candidates:
+                candidates = [e for e in self._endpoints if e.healthy] or self._endpoints
+
+            endpoint = self._sticky.get(sticky_key) if sticky_key else None
+            if not endpoint or endpoint not in candidates:
+                # Rotate the candidates so that ties are broken round robin
+                i = self._next % len(candidates)
+                self._next += 1
+                endpoint = min(candidates[i:] + candidates[:i], key=lambda e: e.outstanding)
+                if sticky_key:
+                    self._sticky[sticky_key] = endpoint
+
+            endpoint.outstanding += 1
+
+        return endpoint
+
+    def release(self, endpoint, success):
+        '''Record the outcome of a request sent to endpoint'''
+
+        with self._lock:
+            endpoint.outstanding -= 1
+            if success:
+                endpoint.failures = 0
+                return
+            endpoint.failures += 1
+            if endpoint.healthy and endpoint.failures >= self._max_failures:
+                sys.stderr.write('uFrame endpoint unhealthy: {:s}\n'.format(endpoint.url))
+                endpoint.healthy = False
+                endpoint.checked = time.time()
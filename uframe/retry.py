@@ -0,0 +1,170 @@
+"""
+Retry, adaptive timeout and circuit breaker policies used by the UFrame client.
+"""
+
+import time
+import random
+import threading
+from collections import deque
+
+# HTTP status codes returned by an overloaded or restarting uFrame that are
+# worth retrying
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+# Retryable status codes that guarantee the request was not processed, the
+# only ones on which requests that are not idempotent are retried
+REFUSED_STATUS_CODES = (429, 503)
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    '''Return the number of seconds to wait before retry number attempt (0 based),
+    using exponential backoff with full jitter so that many clients retrying at
+    once do not synchronize'''
+
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class AdaptiveTimeout(object):
+    '''Per endpoint class (inventory, data, async) request timeouts learned from
+    observed response latencies.  The timeout is the smoothed latency plus 4
+    times its mean deviation (as for TCP retransmission timeouts), bounded by
+    minimum and maximum.  Until a latency has been observed the default timeout
+    is used.'''
+
+    def __init__(self, minimum=2.0, maximum=300.0, alpha=0.125, beta=0.25):
+        self._minimum = minimum
+        self._maximum = maximum
+        self._alpha = alpha
+        self._beta = beta
+        self._estimates = {}
+        self._lock = threading.Lock()
+
+    @property
+    def minimum(self):
+        return self._minimum
+    @minimum.setter
+    def minimum(self, value):
+        self._minimum = value
+
+    @property
+    def maximum(self):
+        return self._maximum
+    @maximum.setter
+    def maximum(self, value):
+        self._maximum = value
+
+    def observe(self, endpoint, latency):
+        '''Update the latency estimate for endpoint with an observed latency, in
+        seconds'''
+
+        with self._lock:
+            if endpoint not in self._estimates:
+                self._estimates[endpoint] = (latency, latency / 2.0)
+                return
+            (srtt, rttvar) = self._estimates[endpoint]
+            rttvar = (1 - self._beta) * rttvar + self._beta * abs(srtt - latency)
+            srtt = (1 - self._alpha) * srtt + self._alpha * latency
+            self._estimates[endpoint] = (srtt, rttvar)
+
+    def timeout(self, endpoint, default, attempt=0):
+        '''Return the timeout, in seconds, for the request attempt (0 based) to
+        endpoint.  The timeout is doubled for each retry'''
+
+        with self._lock:
+            estimate = self._estimates.get(endpoint)
+
+        if estimate:
+            timeout = estimate[0] + 4 * estimate[1]
+        else:
+            timeout = default
+
+        return min(self._maximum, max(self._minimum, timeout) * 2 ** attempt)
+
+class CircuitBreaker(object):
+    '''Per host circuit breaker.  The outcomes of the most recent window requests
+    are tracked and, if at least min_requests have been made and the ratio of
+    failures reaches failure_ratio, the circuit opens and requests are paused for
+    cooldown seconds.  A single probe request is then let through: if it
+    succeeds the circuit closes, otherwise it re-opens for twice as long, up to
+    max_cooldown seconds.'''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, window=20, min_requests=5, failure_ratio=0.5, cooldown=30.0, max_cooldown=600.0):
+        self._window = window
+        self._min_requests = min_requests
+        self._failure_ratio = failure_ratio
+        self._base_cooldown = cooldown
+        self._max_cooldown = max_cooldown
+        self._cooldown = cooldown
+        self._outcomes = deque(maxlen=window)
+        self._state = self.CLOSED
+        self._opened_until = 0
+        self._probe_in_flight = False
+        # Number of state transitions, and the number already reported
+        self._transitions = 0
+        self._reported = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        return self._state
+
+    def wait_time(self):
+        '''Return the number of seconds the caller must wait before sending a
+        request, or 0 if the request may be sent now'''
+
+        with self._lock:
+            if self._state == self.OPEN:
+                now = time.time()
+                if now < self._opened_until:
+                    return self._opened_until - now
+                # Cool down is over: this caller sends the probe request
+                self._state = self.HALF_OPEN
+                self._transitions += 1
+                self._probe_in_flight = True
+                return 0
+            elif self._state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    return 1.0
+                self._probe_in_flight = True
+            return 0
+
+    def state_changed(self):
+        '''Return the current state if it has changed since the last call, so
+        that each transition is reported once whatever the number of callers,
+        otherwise None'''
+
+        with self._lock:
+            if self._transitions == self._reported:
+                return None
+            self._reported = self._transitions
+            return self._state
+
+    def record(self, success):
+        '''Record the outcome of a request'''
+
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._probe_in_flight = False
+                if success:
+                    self._state = self.CLOSED
+                    self._transitions += 1
+                    self._outcomes.clear()
+                    self._cooldown = self._base_cooldown
+                else:
+                    self._cooldown = min(self._max_cooldown, self._cooldown * 2)
+                    self._open()
+                return
+
+            self._outcomes.append(success)
+            if self._state == self.CLOSED and len(self._outcomes) >= self._min_requests:
+                failures = len([o for o in self._outcomes if not o])
+                if float(failures) / len(self._outcomes) >= self._failure_ratio:
+                    self._open()
+
+    def _open(self):
+        self._state = self.OPEN
+        self._transitions += 1
+        self._opened_until = time.time() + self._cooldown
+        self._outcomes.clear()
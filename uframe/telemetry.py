@@ -0,0 +1,126 @@
+"""
+Per-request HTTP timing instrumentation for uFrame requests.
+
+Each request made through UFrame.get is described by a timing record (dict)
+containing the connect time, time to first byte, total time, number of bytes
+received, throughput, number of retries and, for downloads, the path of the file
+written.  Records are appended, one JSON object per line, to the log file
+configured on the UFrame instance.
+"""
+
+import json
+import time
+import datetime
+import threading
+
+# Connect times are accumulated per thread by the connection classes below
+_local = threading.local()
+_log_lock = threading.Lock()
+
+# Transport adapter class, defined on first use so that requests is only
+# imported by processes that make requests
+_adapter_class = None
+
+def _timed_adapter_class():
+
+    global _adapter_class
+    if _adapter_class is not None:
+        return _adapter_class
+
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    class _TimedHTTPConnection(HTTPConnectionPool.ConnectionCls):
+
+        def connect(self):
+            t0 = time.time()
+            HTTPConnectionPool.ConnectionCls.connect(self)
+            _local.connect_time = getattr(_local, 'connect_time', 0.0) + time.time() - t0
+
+    class _TimedHTTPSConnection(HTTPSConnectionPool.ConnectionCls):
+
+        def connect(self):
+            t0 = time.time()
+            HTTPSConnectionPool.ConnectionCls.connect(self)
+            _local.connect_time = getattr(_local, 'connect_time', 0.0) + time.time() - t0
+
+    class _TimedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = _TimedHTTPConnection
+
+    class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = _TimedHTTPSConnection
+
+    class TimedHTTPAdapter(HTTPAdapter):
+        '''requests transport adapter whose connections record the time spent
+        establishing the TCP (and TLS) connection'''
+
+        def init_poolmanager(self, *args, **kwargs):
+            HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {'http' : _TimedHTTPConnectionPool,
+                'https' : _TimedHTTPSConnectionPool}
+
+    _adapter_class = TimedHTTPAdapter
+    return _adapter_class
+
+def timed_http_adapter():
+    '''Return a requests transport adapter whose connections record the time
+    spent establishing the TCP (and TLS) connection'''
+
+    return _timed_adapter_class()()
+
+def start_request(url, endpoint):
+    '''Create the timing record for a request to url, of the specified endpoint
+    class (inventory or data), that is about to be sent'''
+
+    _local.connect_time = 0.0
+
+    return {'request_time' : datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        'url' : url,
+        'endpoint' : endpoint,
+        'code' : -1,
+        'reason' : None,
+        'connect_time' : None,
+        'ttfb' : None,
+        'total_time' : None,
+        'bytes' : 0,
+        'throughput' : None,
+        'retries' : 0,
+        'file' : None,
+        'error' : None,
+        '_t0' : time.time()}
+
+def headers_received(timing, r):
+    '''Record the response status and the connect and first byte times once the
+    response headers for the request have been received'''
+
+    timing['code'] = r.status_code
+    timing['reason'] = r.reason
+    timing['ttfb'] = round(time.time() - timing['_t0'], 6)
+    # A reused keep-alive connection has no connect time
+    timing['connect_time'] = round(getattr(_local, 'connect_time', 0.0), 6)
+
+def finish_request(timing, nbytes=0, file_path=None, error=None):
+    '''Complete the timing record once the response body has been consumed or
+    the request has failed'''
+
+    total_time = time.time() - timing['_t0']
+    timing['total_time'] = round(total_time, 6)
+    timing['bytes'] = nbytes
+    timing['throughput'] = round(nbytes / total_time, 1) if total_time > 0 else None
+    timing['file'] = file_path
+    if error:
+        timing['error'] = error
+
+    return timing
+
+def log_request(timing, log_file):
+    '''Append the timing record to log_file as a single JSON line'''
+
+    record = dict([(k, v) for (k, v) in timing.items() if not k.startswith('_')])
+    line = '{:s}\n'.format(json.dumps(record, sort_keys=True))
+
+    # Each record is written with a single append so that records from
+    # concurrent processes are not interleaved
+    with _log_lock:
+        with open(log_file, 'a') as fid:
+            fid.write(line)
@@ -0,0 +1,94 @@
+"""
+Parsing of UFrame ISO-8601 timestamps.
+
+UFrame writes every timestamp (metadata beginTime and endTime, request
+beginDT and endDT) in one fixed format, YYYY-MM-DDTHH:MM:SS.fffZ.
+dateutil.parser.parse handles it, but as a general purpose parser it is slow,
+and it is called for every stream of every sensor when crawling the inventory.
+parse_timestamp matches the fixed format with a single regular expression and
+only falls back to dateutil for anything else.  to_datetime64 converts whole
+columns of timestamps to NumPy datetime64 arrays, so that the time ranges of
+large inventories can be compared and sorted without a Python loop.
+"""
+
+import re
+import datetime
+from uframe.lazy import lazy_module
+
+parser = lazy_module('dateutil.parser')
+
+try:
+    UTC = datetime.timezone.utc
+except AttributeError:
+    class _UTC(datetime.tzinfo):
+        '''UTC tzinfo, for Python versions without datetime.timezone'''
+
+        def utcoffset(self, dt):
+            return datetime.timedelta(0)
+
+        def tzname(self, dt):
+            return 'UTC'
+
+        def dst(self, dt):
+            return datetime.timedelta(0)
+
+        def __repr__(self):
+            return 'UTC'
+
+    UTC = _UTC()
+
+_ISO8601 = re.compile(r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?(Z)?$')
+
+def parse_timestamp(timestamp):
+    '''Parse the timestamp string and return a datetime.  Timestamps in the UFrame
+    format (YYYY-MM-DDTHH:MM:SS[.ffffff][Z]) are parsed directly, anything else
+    by dateutil.parser.parse.  As with dateutil, timestamps ending with Z are UTC
+    aware and others naive.  Raises ValueError if timestamp cannot be parsed'''
+
+    m = _ISO8601.match(timestamp)
+    if not m:
+        return parser.parse(timestamp)
+
+    (year, month, day, hour, minute, second, fraction, zulu) = m.groups()
+    microsecond = int(fraction.ljust(6, '0')) if fraction else 0
+
+    return datetime.datetime(int(year),
+        int(month),
+        int(day),
+        int(hour),
+        int(minute),
+        int(second),
+        microsecond,
+        UTC if zulu else None)
+
+def to_datetime64(timestamps, unit='ms'):
+    '''Convert the sequence of timestamp strings to a NumPy datetime64 array of
+    UTC times with resolution unit (ms is the UFrame resolution).  Empty or None
+    timestamps, and timestamps that cannot be parsed, are NaT'''
+
+    import numpy as np
+
+    dtype = 'datetime64[{:s}]'.format(unit)
+    values = [t[:-1] if t and t.endswith('Z') else (t or 'NaT') for t in timestamps]
+    if not values:
+        return np.array([], dtype=dtype)
+
+    try:
+        # numpy parses ISO-8601 itself, a whole column at a time
+        return np.array(values, dtype=dtype)
+    except ValueError:
+        pass
+
+    # At least one timestamp is not ISO-8601: convert one at a time
+    converted = []
+    for t in timestamps:
+        try:
+            dt = parse_timestamp(t)
+        except (ValueError, OverflowError, TypeError, AttributeError):
+            converted.append(np.datetime64('NaT', unit))
+            continue
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(UTC).replace(tzinfo=None)
+        converted.append(np.datetime64(dt, unit))
+
+    return np.array(converted, dtype=dtype)
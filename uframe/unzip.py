@@ -0,0 +1,281 @@
+"""
+Extraction of zip archives, as returned by uFrame for multi-file products, while
+they are being downloaded.
+
+The archive is read as a stream of chunks, parsing each member's local file
+header and inflating its data straight into its destination file, so that the
+archive itself is never written to disk.  Members whose length cannot be known
+until their data descriptor is found (stored, rather than deflated, members
+written by a streaming zip writer) are spooled to a SpooledTemporaryFile, held
+in memory up to spool_size bytes, until the end of the member is found.  Larger
+members spill to a temporary file in the destination directory, so that such a
+member briefly takes up twice its size on disk there while it is copied to its
+destination file; the spool is removed as soon as the member is extracted.
+"""
+
+import os
+import sys
+import zlib
+import struct
+import shutil
+import tempfile
+
+_LOCAL_HEADER = b'PK\x03\x04'
+_DATA_DESCRIPTOR = b'PK\x07\x08'
+_CENTRAL_HEADER = b'PK\x01\x02'
+_END_RECORD = b'PK\x05\x06'
+
+_STORED = 0
+_DEFLATED = 8
+
+# General purpose flag bits
+_ENCRYPTED = 0x1
+_HAS_DESCRIPTOR = 0x8
+
+_ZIP64_EXTRA = 0x0001
+
+_CHUNK_SIZE = 64 * 1024
+
+class ZipStreamError(Exception):
+    pass
+
+class _ChunkReader(object):
+    '''File-like reader over an iterator of byte strings'''
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b''
+        self.nbytes = 0
+
+    def read(self, n):
+        '''Return up to n bytes, fewer only at the end of the stream'''
+
+        while len(self._buf) < n:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self.nbytes += len(chunk)
+            self._buf += chunk
+        (data, self._buf) = (self._buf[:n], self._buf[n:])
+        return data
+
+    def read_exact(self, n):
+
+        data = self.read(n)
+        if len(data) != n:
+            raise ZipStreamError('Truncated zip stream')
+        return data
+
+    def read_some(self, n=_CHUNK_SIZE):
+        '''Return the buffered bytes, or the next chunk, up to n bytes'''
+
+        if not self._buf:
+            return self.read(n)
+        (data, self._buf) = (self._buf[:n], self._buf[n:])
+        return data
+
+    def unread(self, data):
+        self._buf = data + self._buf
+
+    def drain(self):
+        '''Consume the rest of the stream'''
+
+        self._buf = b''
+        for chunk in self._chunks:
+            self.nbytes += len(chunk)
+
+def _zip64_sizes(extra, csize, usize):
+    '''Return the compressed and uncompressed sizes from the zip64 extended
+    information extra field, if present'''
+
+    i = 0
+    while i + 4 <= len(extra):
+        (tag, size) = struct.unpack('<HH', extra[i:i + 4])
+        if tag == _ZIP64_EXTRA:
+            data = extra[i + 4:i + 4 + size]
+            values = [struct.unpack('<Q', data[j:j + 8])[0] for j in range(0, len(data) - 7, 8)]
+            if usize == 0xFFFFFFFF and values:
+                usize = values.pop(0)
+            if csize == 0xFFFFFFFF and values:
+                csize = values.pop(0)
+            return (csize, usize, True)
+        i += 4 + size
+
+    return (csize, usize, False)
+
+def _member_path(dest_dir, name):
+    '''Return the destination of the member name, which is written to dest_dir
+    without any of its directory components'''
+
+    name = os.path.basename(name.replace('\\', '/'))
+    if not name or name in ['.', '..']:
+        return None
+    return os.path.join(dest_dir, name)
+
+def _inflate(reader, fid):
+    '''Inflate one deflated member from reader into fid.  Returns the crc and the
+    number of bytes written'''
+
+    d = zlib.decompressobj(-zlib.MAX_WBITS)
+    crc = 0
+    size = 0
+    while True:
+        chunk = reader.read_some()
+        if not chunk:
+            raise ZipStreamError('Truncated zip member')
+        data = d.decompress(chunk)
+        if data:
+            fid.write(data)
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+        if d.unused_data:
+            reader.unread(d.unused_data)
+            break
+        if getattr(d, 'eof', False):
+            break
+
+    data = d.flush()
+    if data:
+        fid.write(data)
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+
+    return (crc & 0xFFFFFFFF, size)
+
+def _copy_stored(reader, fid, size):
+    '''Copy size bytes of a stored member from reader into fid'''
+
+    crc = 0
+    remaining = size
+    while remaining:
+        chunk = reader.read_some(min(remaining, _CHUNK_SIZE))
+        if not chunk:
+            raise ZipStreamError('Truncated zip member')
+        fid.write(chunk)
+        crc = zlib.crc32(chunk, crc)
+        remaining -= len(chunk)
+
+    return (crc & 0xFFFFFFFF, size)
+
+def _spool_stored(reader, fid, spool_size, spool_dir, zip64):
+    '''Copy a stored member of unknown length into fid, spooling it until a data
+    descriptor matching the crc and length of the data read so far is found.
+    The data descriptor is left unread'''
+
+    desc_size = 20 if zip64 else 12
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_size, dir=spool_dir)
+    crc = 0
+    size = 0
+    tail = b''
+    try:
+        while True:
+            chunk = reader.read_some()
+            if not chunk:
+                raise ZipStreamError('Truncated zip member')
+            data = tail + chunk
+            i = data.find(_DATA_DESCRIPTOR)
+            while i >= 0:
+                candidate = data[i + 4:i + 4 + desc_size]
+                if len(candidate) < desc_size:
+                    break
+                member_crc = zlib.crc32(data[:i], crc) & 0xFFFFFFFF
+                fmt = '<LQQ' if zip64 else '<LLL'
+                (d_crc, d_csize, d_usize) = struct.unpack(fmt, candidate)
+                if d_crc == member_crc and d_usize == size + i:
+                    spool.write(data[:i])
+                    reader.unread(data[i:])
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, fid, _CHUNK_SIZE)
+                    return (member_crc, size + i)
+                i = data.find(_DATA_DESCRIPTOR, i + 1)
+            # Keep enough bytes to match a descriptor split across chunks
+            keep = min(len(data), 4 + desc_size - 1)
+            if i >= 0:
+                keep = max(keep, len(data) - i)
+            spool.write(data[:len(data) - keep])
+            crc = zlib.crc32(data[:len(data) - keep], crc)
+            size += len(data) - keep
+            tail = data[len(data) - keep:]
+    finally:
+        spool.close()
+
+def extract_zip_stream(chunks, dest_dir, rename=None, spool_size=32 * 1024 * 1024):
+    '''Extract the members of the zip archive read from the iterator of byte
+    string chunks (e.g. requests.Response.iter_content) into dest_dir.  Each
+    member is written to a temporary file in dest_dir, checked against its
+    crc and renamed to the base name of the member and then, if rename is
+    specified, to the base name returned by rename(member_file) (e.g.
+    tds.timestamp_nc_file for NetCDF members).  Members of unknown length that
+    must be spooled are held in memory up to spool_size bytes before spilling
+    to a temporary file in dest_dir.  Returns the list of extracted files and
+    the number of bytes read from chunks.  Raises ZipStreamError if the archive is invalid or uses
+    unsupported features (encryption, compression other than deflate)'''
+
+    reader = _ChunkReader(chunks)
+    files = []
+
+    while True:
+        signature = reader.read(4)
+        if signature in [_CENTRAL_HEADER, _END_RECORD] or (not signature and files):
+            break
+        if signature != _LOCAL_HEADER:
+            raise ZipStreamError('Invalid zip local file header')
+
+        (version, flags, method, mtime, mdate, crc, csize, usize, name_len, extra_len) = struct.unpack('<HHHHHLLLHH', reader.read_exact(26))
+        name = reader.read_exact(name_len).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = reader.read_exact(extra_len)
+        (csize, usize, zip64) = _zip64_sizes(extra, csize, usize)
+
+        if flags & _ENCRYPTED:
+            raise ZipStreamError('Encrypted zip member: {:s}'.format(name))
+        if method not in [_STORED, _DEFLATED]:
+            raise ZipStreamError('Unsupported zip compression method {:d}: {:s}'.format(method, name))
+
+        member_path = _member_path(dest_dir, name)
+        is_dir = name.endswith('/')
+        tmp_path = os.path.join(dest_dir, '.{:s}.part'.format(os.path.basename(member_path or 'member')))
+        descriptor = flags & _HAS_DESCRIPTOR
+
+        extracting = not is_dir and member_path
+        try:
+            with open(tmp_path if extracting else os.devnull, 'wb') as fid:
+                if method == _DEFLATED:
+                    (member_crc, size) = _inflate(reader, fid)
+                elif not descriptor:
+                    (member_crc, size) = _copy_stored(reader, fid, csize)
+                else:
+                    (member_crc, size) = _spool_stored(reader, fid, spool_size, dest_dir, zip64)
+
+            if descriptor:
+                d = reader.read_exact(4)
+                if d == _DATA_DESCRIPTOR:
+                    d = reader.read_exact(4)
+                crc = struct.unpack('<L', d)[0]
+                (csize, usize) = struct.unpack('<QQ' if zip64 else '<LL', reader.read_exact(16 if zip64 else 8))
+
+            if extracting and (member_crc != crc or size != usize):
+                raise ZipStreamError('Zip member failed crc check: {:s}'.format(name))
+        except BaseException:
+            # Do not leave a partial member behind, whatever the failure (e.g.
+            # the stream ended mid-member)
+            if extracting and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if not extracting:
+            continue
+
+        os.rename(tmp_path, member_path)
+        if rename:
+            final_name = rename(member_path)
+            if final_name:
+                final_path = os.path.join(dest_dir, os.path.basename(final_name))
+                os.rename(member_path, final_path)
+                member_path = final_path
+            else:
+                sys.stderr.write('Failed to rename zip member: {:s}\n'.format(name))
+        files.append(member_path)
+
+    reader.drain()
+
+    return (files, reader.nbytes)
@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import argparse
+
+# Scripts run by the prepare, export and edit commands
+_SCRIPTS = {'prepare' : 'prepare_uframe_tds_requests.py',
+    'export' : 'export_uframe_nc_to_tds-agg.py',
+    'edit' : 'edit_tds_datasets.py'}
+
+def run_script(command, script_args):
+    '''Run the script for command, as if run from the command line with the
+    arguments script_args, and return its exit status'''
+
+    import runpy
+
+    script = os.path.join(os.path.dirname(os.path.realpath(__file__)), _SCRIPTS[command])
+    sys.argv = [script] + script_args
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        sys.stderr.write('{:s}\n'.format(str(e.code)))
+        return 1
+
+    return 0
+
+def submit(args):
+    '''Send the asynchronous UFrame requests in URL_FILES, one request url per
+    line, and add them, with their requestUUIDs, to the queue store
+    (stream-queue/queue.db by default), from which export picks them up.  The
+    queue csv records are written to STDOUT.  With -a, requests are sent only
+    while fewer than a limit of our requests are in flight (sent, without a
+    complete status.txt under ASYNC_UFRAME_NC_ROOT), and the limit adapts to
+    the time UFrame takes to complete them (see tds.backpressure)'''
+
+    ASYNC_DATA_ROOT = os.getenv('ASYNC_DATA_HOME')
+    if not ASYNC_DATA_ROOT:
+        sys.stderr.write('ASYNC_DATA_HOME environment variable not set\n')
+        sys.stderr.flush()
+        return 1
+    elif not os.path.exists(ASYNC_DATA_ROOT):
+        sys.stderr.write('ASYNC_DATA_HOME is invalid: {:s}\n'.format(ASYNC_DATA_ROOT))
+        sys.stderr.flush()
+        return 1
+
+    for url_file in args.url_files:
+        if not os.path.exists(url_file):
+            sys.stderr.write('Invalid url file: {:s}\n'.format(url_file))
+            return 1
+
+    from tds.queue_store import DEFAULT_STORE, open_store
+
+    if args.adaptive:
+        UFRAME_NC_ROOT = os.getenv('ASYNC_UFRAME_NC_ROOT')
+        if not UFRAME_NC_ROOT:
+            sys.stderr.write('ASYNC_UFRAME_NC_ROOT environment variable not set\n')
+            return 1
+        UFRAME_NC_ROOT = os.path.join(UFRAME_NC_ROOT, args.user)
+        if not os.path.exists(UFRAME_NC_ROOT):
+            sys.stderr.write('ASYNC_UFRAME_NC_ROOT is invalid: {:s}\n'.format(UFRAME_NC_ROOT))
+            return 1
+
+    QUEUE_STORE = args.store or os.path.join(ASYNC_DATA_ROOT, DEFAULT_STORE)
+    sys.stderr.write('Queue store: {:s}\n'.format(QUEUE_STORE))
+    if args.validate:
+        return 0
+
+    from uframe import UFrame, send_async_request
+    from tds import write_queue_csv
+    from tds.harvester import IN_PROCESS, queue_record
+
+    store = open_store(QUEUE_STORE)
+    if not store:
+        return 1
+
+    uframe_base = UFrame()
+    records = []
+    for url_file in args.url_files:
+        with open(url_file, 'r') as fid:
+            urls = [line.strip() for line in fid if line.strip() and not line.startswith('#')]
+        records.extend([r for r in [queue_record(url) for url in urls] if r])
+
+    def send(record):
+        request_uuid = send_async_request(record['request_url'], uframe_base)
+        if request_uuid:
+            record.update(requestUUID=request_uuid, reason=IN_PROCESS)
+        else:
+            record['reason'] = 'No requestUUID created'
+        return request_uuid
+
+    def send_and_store(record):
+        # Stored as soon as it is sent, so that it is counted in flight and an
+        # interrupted submit does not lose the requestUUIDs already created
+        request_uuid = send(record)
+        store.add([record], replace=True)
+        return request_uuid
+
+    if args.adaptive:
+        from tds.backpressure import AIMDController, InFlightTracker, submit_with_backpressure
+
+        submit_with_backpressure(records,
+            send_and_store,
+            lambda: [r for r in store.pending(IN_PROCESS) if r['requestUUID']],
+            InFlightTracker(UFRAME_NC_ROOT),
+            AIMDController(limit=args.initial_in_flight, maximum=args.max_in_flight),
+            poll_interval=args.poll_interval)
+    else:
+        for record in records:
+            send_and_store(record)
+    store.close()
+
+    if records:
+        write_queue_csv(records, sys.stdout)
+
+    return 0
+
+def index(args):
+    '''Scan the product directories of the asynchronous UFrame requests under
+    ASYNC_UFRAME_NC_ROOT/USER, or only REQUEST_UUIDS, and write the status and
+    the number of NetCDF files of each stream of each request, one JSON object
+    per line, to STDOUT'''
+
+    UFRAME_NC_ROOT = os.getenv('ASYNC_UFRAME_NC_ROOT')
+    if not UFRAME_NC_ROOT:
+        sys.stderr.write('ASYNC_UFRAME_NC_ROOT environment variable not set\n')
+        sys.stderr.flush()
+        return 1
+
+    UFRAME_NC_ROOT = os.path.join(UFRAME_NC_ROOT, args.user)
+    if not os.path.exists(UFRAME_NC_ROOT):
+        sys.stderr.write('ASYNC_UFRAME_NC_ROOT is invalid: {:s}\n'.format(UFRAME_NC_ROOT))
+        sys.stderr.flush()
+        return 1
+
+    if args.validate:
+        return 0
+
+    import json
+    from tds.scan import scan_dir, scan_requests
+
+    request_uuids = args.request_uuids or [e.name for e in scan_dir(UFRAME_NC_ROOT) if e.is_dir()]
+    indexes = scan_requests(UFRAME_NC_ROOT, request_uuids, threads=args.threads)
+    for request_uuid in sorted(indexes.keys()):
+        product_index = indexes[request_uuid]
+        sys.stdout.write('{:s}\n'.format(json.dumps({'requestUUID' : request_uuid,
+            'exists' : product_index.exists,
+            'status' : product_index.status(),
+            'streams' : dict([(s, len(product_index.nc_files(s))) for s in product_index.streams()])},
+            sort_keys=True)))
+
+    return 0
+
+def snapshot(args):
+    '''Crawl the UFrame inventory, or the inventory of one ARRAY only, and save
+    it as a columnar snapshot (see uframe.inventory) to SNAPSHOT_FILE.  The
+    format is given by the extension: .npy (memory mappable, with a .json
+    sidecar), .parquet (requires pyarrow, .csv otherwise) or .csv'''
+
+    uframe_urls = args.base_url or os.getenv('UFRAME_BASE_URL')
+    if uframe_urls:
+        uframe_urls = [u.strip() for u in uframe_urls.split(',') if u.strip()]
+
+    snapshot_dir = os.path.dirname(os.path.abspath(args.snapshot_file))
+    if not os.path.isdir(snapshot_dir):
+        sys.stderr.write('Invalid snapshot destination: {:s}\n'.format(snapshot_dir))
+        return 1
+
+    if args.validate:
+        return 0
+
+    from uframe import UFrame
+    from uframe.inventory import snapshot_inventory
+
+    if uframe_urls:
+        uframe_base = UFrame(base_url=uframe_urls[0],
+            endpoints=uframe_urls if len(uframe_urls) > 1 else None)
+    else:
+        uframe_base = UFrame()
+
+    inventory = snapshot_inventory(uframe_base, array_id=args.array, threads=args.threads)
+    if not len(inventory):
+        sys.stderr.write('No streams found: {:s}\n'.format(uframe_base.url))
+        return 1
+
+    snapshot_file = inventory.save(args.snapshot_file)
+    sys.stdout.write('Saved {:d} streams of {:d} sensors: {:s}\n'.format(len(inventory),
+        len(inventory.categories['sensor']),
+        snapshot_file))
+
+    return 0
+
+def diff(args):
+    '''Compare the inventory snapshots PREVIOUS and CURRENT (see uframe.diff)
+    and write the time windows to request for the added, extended and
+    truncated streams, one JSON object per line, to STDOUT.  The number of
+    streams with each kind of change is written to STDERR'''
+
+    for snapshot_file in [args.previous, args.current]:
+        if not os.path.exists(snapshot_file):
+            sys.stderr.write('Invalid inventory snapshot: {:s}\n'.format(snapshot_file))
+            return 1
+
+    if args.validate:
+        return 0
+
+    import json
+    from uframe.inventory import InventorySnapshot
+    from uframe.diff import diff_snapshots
+
+    inventory_diff = diff_snapshots(InventorySnapshot.load(args.previous), InventorySnapshot.load(args.current))
+    for window in inventory_diff.request_windows():
+        sys.stdout.write('{:s}\n'.format(json.dumps(window, sort_keys=True)))
+    if args.removed:
+        for r in inventory_diff.removed_records():
+            r['change'] = 'removed'
+            sys.stdout.write('{:s}\n'.format(json.dumps(r, sort_keys=True)))
+
+    for r in inventory_diff.invalid_records():
+        sys.stderr.write('Invalid time bounds: {:s} {:s} {:s}\n'.format(r['sensor'], r['method'], r['stream']))
+
+    sys.stderr.write('{:s}\n'.format(json.dumps(inventory_diff.counts(), sort_keys=True)))
+
+    return 0
+
+def verify(args):
+    '''Verify the NetCDF files in PATHS, files or directories searched
+    recursively for .nc files, without decoding them (see uframe.ncverify), and
+    write each invalid file and the reason, one JSON object per line, to
+    STDOUT.  With -q, invalid files are moved to the quarantine directory.
+    Exits with status 1 if any file is invalid'''
+
+    for path in args.paths:
+        if not os.path.exists(path):
+            sys.stderr.write('Invalid path: {:s}\n'.format(path))
+            return 1
+
+    if args.validate:
+        return 0
+
+    import json
+    from uframe.ncverify import verify_nc_files, quarantine_file
+
+    nc_files = []
+    for path in args.paths:
+        if not os.path.isdir(path):
+            nc_files.append(path)
+            continue
+        for (root, dirs, files) in os.walk(path):
+            nc_files.extend([os.path.join(root, f) for f in sorted(files) if f.endswith('.nc')])
+
+    reasons = verify_nc_files(nc_files, processes=args.processes)
+    invalid = 0
+    for nc_file in nc_files:
+        if reasons[nc_file] is None:
+            continue
+        invalid += 1
+        record = {'file' : nc_file, 'reason' : reasons[nc_file]}
+        if args.quarantine:
+            record['quarantined'] = quarantine_file(nc_file, args.quarantine, reasons[nc_file])
+        sys.stdout.write('{:s}\n'.format(json.dumps(record, sort_keys=True)))
+
+    sys.stderr.write('Verified {:d} files: {:d} invalid\n'.format(len(nc_files), invalid))
+
+    return 1 if invalid else 0
+
+def catalog(args):
+    '''Update the THREDDS catalogs under CATALOG_ROOT from the stream
+    directories under ASYNC_TDS_NC_ROOT (see tds.catalog).  Only the catalogs
+    of the stream directories that changed since the last update are
+    rewritten, or, if STREAM_DIRS are specified, only the catalogs of those.
+    The number of catalogs written, removed and unchanged is written to
+    STDOUT'''
+
+    from tds.volumes import invalid_roots
+
+    tds_nc_root = args.tdsroot or os.getenv('ASYNC_TDS_NC_ROOT')
+    if not tds_nc_root:
+        sys.stderr.write('ASYNC_TDS_NC_ROOT environment variable not set\n')
+        return 1
+    if invalid_roots(tds_nc_root):
+        sys.stderr.write('ASYNC_TDS_NC_ROOT is invalid: {:s}\n'.format(', '.join(invalid_roots(tds_nc_root))))
+        return 1
+
+    if args.validate:
+        return 0
+
+    import json
+    from tds.catalog import update_catalogs
+
+    counts = update_catalogs(tds_nc_root,
+        args.catalog_root,
+        url_prefix=args.url_prefix,
+        stream_dirs=[os.path.abspath(d) for d in args.stream_dirs] or None,
+        force=args.force)
+
+    sys.stdout.write('{:s}\n'.format(json.dumps(counts, sort_keys=True)))
+
+    return 0
+
+def volumes(args):
+    '''Report the free space, I/O requests in flight and number of indexed
+    streams of each root of ASYNC_TDS_NC_ROOT (see tds.volumes), one JSON object
+    per line, to STDOUT.  With STREAMS, a list of stream directories relative to
+    the roots, report the root holding each stream instead or, with -p, the root
+    on which it would be placed'''
+
+    from tds.volumes import VolumeSet, invalid_roots
+
+    tds_nc_root = args.tdsroot or os.getenv('ASYNC_TDS_NC_ROOT')
+    if not tds_nc_root:
+        sys.stderr.write('ASYNC_TDS_NC_ROOT environment variable not set\n')
+        return 1
+    if invalid_roots(tds_nc_root):
+        sys.stderr.write('ASYNC_TDS_NC_ROOT is invalid: {:s}\n'.format(', '.join(invalid_roots(tds_nc_root))))
+        return 1
+
+    if args.validate:
+        return 0
+
+    import json
+
+    volume_set = VolumeSet(tds_nc_root)
+    try:
+        if not args.streams:
+            for usage in volume_set.usage():
+                sys.stdout.write('{:s}\n'.format(json.dumps(usage, sort_keys=True)))
+            return 0
+        for rel_path in args.streams:
+            root = volume_set.place(rel_path, record=False) if args.place else volume_set.locate(rel_path)
+            sys.stdout.write('{:s}\n'.format(json.dumps({'stream' : rel_path, 'root' : root}, sort_keys=True)))
+    finally:
+        volume_set.close()
+
+    return 0
+
+def main(args):
+    '''Single entry point for the UFrame to THREDDS scripts.  prepare, export and
+    edit run prepare_uframe_tds_requests.py, export_uframe_nc_to_tds-agg.py and
+    edit_tds_datasets.py with the remaining arguments (use COMMAND -h for their
+    options), submit sends request urls to UFrame, index reports the contents
+    of the request product directories, snapshot saves the UFrame inventory
+    to a local table, diff compares two snapshots, verify checks NetCDF
+    files, catalog updates the THREDDS catalogs and volumes reports
+    the THREDDS roots.  Heavy dependencies (requests, dateutil,
+    netCDF4, numpy) are only imported by the code paths that use them, so that
+    -v checks and runs with nothing to do start quickly'''
+
+    if args.command in _SCRIPTS:
+        return run_script(args.command, args.script_args)
+
+    return args.func(args)
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    subparsers = arg_parser.add_subparsers(dest='command', metavar='COMMAND')
+    subparsers.required = True
+
+    for (command, script) in sorted(_SCRIPTS.items()):
+        # All arguments, including -h, are passed to the script
+        subparsers.add_parser(command,
+            add_help=False,
+            help='Run {:s}'.format(script))
+
+    submit_parser = subparsers.add_parser('submit',
+        description=submit.__doc__,
+        help='Send request urls to UFrame')
+    submit_parser.add_argument('url_files',
+        nargs='+',
+        metavar='URL_FILES',
+        help='Files containing one asynchronous request url per line')
+    submit_parser.add_argument('-s', '--store',
+        help='Alternate queue store (ASYNC_DATA_HOME/stream-queue/queue.db is <default>)')
+    submit_parser.add_argument('-a', '--adaptive',
+        action='store_true',
+        help='Adapt the number of requests in flight to the UFrame completion latency')
+    submit_parser.add_argument('-u', '--user',
+        default='_nouser',
+        help='Alternate user name, whose product directories are checked with -a (_nouser is <default>)')
+    submit_parser.add_argument('-n', '--max-in-flight',
+        dest='max_in_flight',
+        type=int,
+        default=20,
+        help='Maximum number of requests in flight with -a (20 is <default>)')
+    submit_parser.add_argument('--initial-in-flight',
+        dest='initial_in_flight',
+        type=int,
+        default=4,
+        help='Number of requests in flight to start from with -a (4 is <default>)')
+    submit_parser.add_argument('--poll-interval',
+        dest='poll_interval',
+        type=float,
+        default=30.0,
+        help='Seconds between checks for completed requests with -a (30 is <default>)')
+    submit_parser.add_argument('-v', '--validate',
+        action='store_true',
+        help='Validate environment set up only.')
+    submit_parser.set_defaults(func=submit)
+
+    index_parser = subparsers.add_parser('index',
+        description=index.__doc__,
+        help='Report the contents of request product directories')
+    index_parser.add_argument('request_uuids',
+        nargs='*',
+        metavar='REQUEST_UUIDS',
+        help='Request product directories to scan (all is <default>)')
+    index_parser.add_argument('-u', '--user',
+        default='_nouser',
+        help='Alternate user name (_nouser is <default>)')
+    index_parser.add_argument('-t', '--threads',
+        type=int,
+        default=8,
+        help='Number of product directories scanned in parallel (8 is <default>)')
+    index_parser.add_argument('-v', '--validate',
+        action='store_true',
+        help='Validate environment set up only.')
+    index_parser.set_defaults(func=index)
+
+    snapshot_parser = subparsers.add_parser('snapshot',
+        description=snapshot.__doc__,
+        help='Save a columnar snapshot of the UFrame inventory')
+    snapshot_parser.add_argument('snapshot_file',
+        metavar='SNAPSHOT_FILE',
+        help='Snapshot file (.npy, .parquet or .csv)')
+    snapshot_parser.add_argument('-a', '--array',
+        help='Only crawl this array (all arrays is <default>)')
+    snapshot_parser.add_argument('-b', '--baseurl',
+        dest='base_url',
+        help='Specify an alternate uFrame server URL, or a comma-separated list of uFrame replica URLs. Must start with \'http://\'.')
+    snapshot_parser.add_argument('-t', '--threads',
+        type=int,
+        default=8,
+        help='Number of sensor metadata requests sent in parallel (8 is <default>)')
+    snapshot_parser.add_argument('-v', '--validate',
+        action='store_true',
+        help='Validate environment set up only.')
+    snapshot_parser.set_defaults(func=snapshot)
+
+    diff_parser = subparsers.add_parser('diff',
+        description=diff.__doc__,
+        help='Compare two inventory snapshots')
+    diff_parser.add_argument('previous',
+        metavar='PREVIOUS',
+        help='Previous inventory snapshot')
+    diff_parser.add_argument('current',
+        metavar='CURRENT',
+        help='Current inventory snapshot')
+    diff_parser.add_argument('-r', '--removed',
+        action='store_true',
+        help='Also write the streams removed from the inventory')
+    diff_parser.add_argument('-v', '--validate',
+        action='store_true',
+        help='Validate environment set up only.')
+    diff_parser.set_defaults(func=diff)
+
+    verify_parser = subparsers.add_parser('verify',
+        description=verify.__doc__,
+        help='Verify NetCDF files')
+    verify_parser.add_argument('paths',
+        nargs='+',
+        metavar='PATHS',
+        help='NetCDF files or directories')
+    verify_parser.add_argument('-q', '--quarantine',
+        help='Directory to which invalid files are moved')
+    verify_parser.add_argument('-p', '--processes',
+        type=int,
+        default=4,
+        help='Number of files verified in parallel (4 is <default>)')
+    verify_parser.add_argument('-v', '--validate',
+        action='store_true',
+        help='Validate environment set up only.')
+    verify_parser.set_defaults(func=verify)
+
+    catalog_parser = subparsers.add_parser('catalog',
+        description=catalog.__doc__,
+        help='Update the THREDDS catalogs of the stream directories')
+    catalog_parser.add_argument('catalog_root',
+        metavar='CATALOG_ROOT',
+        help='Directory under which the catalogs are written')
+    catalog_parser.add_argument('stream_dirs',
+        nargs='*',
+        metavar='STREAM_DIRS',
+        help='Stream directories to update (all that changed is <default>)')
+    catalog_parser.add_argument('--tdsroot',
+        help='Location of the THREDDS root directory.  Must be specified if ASYNC_TDS_NC_ROOT is not set')
+    catalog_parser.add_argument('-u', '--url-prefix',
+        dest='url_prefix',
+        default='uframe',
+        help='THREDDS datasetScan path under which ASYNC_TDS_NC_ROOT is served (uframe is <default>)')
+    catalog_parser.add_argument('-f', '--force',
+        action='store_true',
+        help='Rewrite every catalog')
+    catalog_parser.add_argument('-v', '--validate',
+        action='store_true',
+        help='Validate environment set up only.')
+    catalog_parser.set_defaults(func=catalog)
+
+    volumes_parser = subparsers.add_parser('volumes',
+        description=volumes.__doc__,
+        help='Report the THREDDS roots and stream placement')
+    volumes_parser.add_argument('streams',
+        nargs='*',
+        metavar='STREAMS',
+        help='Stream directories, relative to the roots, to locate')
+    volumes_parser.add_argument('--tdsroot',
+        help='Location of the THREDDS root directories.  Must be specified if ASYNC_TDS_NC_ROOT is not set')
+    volumes_parser.add_argument('-p', '--place',
+        action='store_true',
+        help='Report the root on which new STREAMS would be placed')
+    volumes_parser.add_argument('-v', '--validate',
+        action='store_true',
+        help='Validate environment set up only.')
+    volumes_parser.set_defaults(func=volumes)
+
+    (parsed_args, script_args) = arg_parser.parse_known_args()
+    if parsed_args.command not in _SCRIPTS and script_args:
+        arg_parser.error('unrecognized arguments: {:s}'.format(' '.join(script_args)))
+    parsed_args.script_args = script_args
+
+    sys.exit(main(parsed_args))
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import signal
+import argparse
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from uframe import UFrame
+from tds import *
+from tds.harvester import HarvesterState, prepare_stage, submit_stage, export_stage, run_stage
+from tds.queue_store import QUEUED, DEFAULT_STORE, open_store
+from tds.volumes import invalid_roots
+from tds.lease import LeaseDir
+
+def main(args):
+    '''Run prepare_uframe_tds_requests.py, send_requests_from_csv.sh and
+    export_uframe_nc_to_tds-agg.py as a single long-running harvester.  New
+    streams in the master stream files are requested every PREPARE_INTERVAL
+    seconds, the requests are sent to UFrame without exceeding MAX_IN_FLIGHT
+    requests in flight, and each request is published to THREDDS as soon as it
+    is complete.  With -a, requests are in flight until UFrame marks them
+    complete and the number allowed in flight starts at INITIAL_IN_FLIGHT and
+    adapts, up to MAX_IN_FLIGHT, to the time UFrame takes to complete them
+    (see tds.backpressure).  Known streams are saved to known-streams/ and requests to
+    the queue store (stream-queue/queue.db by default), from which the
+    harvester resumes when restarted.  Stop the harvester with SIGINT or SIGTERM.'''
+
+    # File locations from environment
+    ASYNC_DATA_ROOT = os.getenv('ASYNC_DATA_HOME')
+    if not ASYNC_DATA_ROOT:
+        sys.stderr.write('ASYNC_DATA_HOME environment variable not set\n')
+        sys.stderr.flush()
+        return 1
+    elif not os.path.exists(ASYNC_DATA_ROOT):
+        sys.stderr.write('ASYNC_DATA_HOME is invalid: {:s}\n'.format(ASYNC_DATA_ROOT))
+        sys.stderr.flush()
+        return 1
+
+    UFRAME_NC_ROOT = os.getenv('ASYNC_UFRAME_NC_ROOT')
+    if not UFRAME_NC_ROOT:
+        sys.stderr.write('ASYNC_UFRAME_NC_ROOT environment variable not set\n')
+        sys.stderr.flush()
+        return 1
+
+    # Append the user directory
+    UFRAME_NC_ROOT = os.path.join(UFRAME_NC_ROOT, args.user)
+    if not os.path.exists(UFRAME_NC_ROOT):
+        sys.stderr.write('ASYNC_UFRAME_NC_ROOT is invalid: {:s}\n'.format(UFRAME_NC_ROOT))
+        sys.stderr.flush()
+        return 1
+
+    TDS_NC_ROOT = os.getenv('ASYNC_TDS_NC_ROOT')
+    if not TDS_NC_ROOT:
+        sys.stderr.write('ASYNC_TDS_NC_ROOT environment variable not set\n')
+        sys.stderr.flush()
+        return 1
+    elif invalid_roots(TDS_NC_ROOT):
+        sys.stderr.write('ASYNC_TDS_NC_ROOT is invalid: {:s}\n'.format(', '.join(invalid_roots(TDS_NC_ROOT))))
+        sys.stderr.flush()
+        return 1
+
+    NCML_TEMPLATE = os.path.join(ASYNC_DATA_ROOT, 'catalogs', 'stream-agg-template.ncml')
+    if not os.path.exists(NCML_TEMPLATE):
+        sys.stderr.write('NCML stream agg template: {:s}\n'.format(NCML_TEMPLATE))
+        return 1
+
+    for master_streams_file in args.master_stream_csv:
+        if not os.path.exists(master_streams_file):
+            sys.stderr.write('Invalid master stream file: {:s}\n'.format(master_streams_file))
+            return 1
+
+    KNOWN_STREAMS_ROOT = os.path.join(ASYNC_DATA_ROOT, 'known-streams')
+    STREAMS_QUEUE_ROOT = os.path.join(ASYNC_DATA_ROOT, 'stream-queue')
+    for d in [KNOWN_STREAMS_ROOT, STREAMS_QUEUE_ROOT]:
+        if os.path.exists(d):
+            continue
+        sys.stdout.write('Creating directory: {:s}\n'.format(d))
+        try:
+            os.mkdir(d)
+        except OSError as e:
+            sys.stderr.write('Failed to create directory: {:s} (Reason: {:s})\n'.format(d, e.strerror))
+            sys.stderr.flush()
+            return 1
+
+    # Configure UFrame instance.  A comma-separated list of urls distributes
+    # requests across uFrame replicas, with the first url used to build request
+    # urls
+    uframe_urls = args.base_url or os.getenv('UFRAME_BASE_URL')
+    if uframe_urls:
+        uframe_urls = [u.strip() for u in uframe_urls.split(',') if u.strip()]
+        uframe_base = UFrame(base_url=uframe_urls[0],
+            endpoints=uframe_urls if len(uframe_urls) > 1 else None)
+    else:
+        uframe_base = UFrame()
+
+    QUEUE_STORE = args.store or os.path.join(ASYNC_DATA_ROOT, DEFAULT_STORE)
+    store = open_store(QUEUE_STORE)
+    if not store:
+        return 1
+    state = HarvesterState(store, KNOWN_STREAMS_ROOT)
+
+    # Print the requests for new streams, but do not send them
+    if args.debug:
+        for master_streams_file in args.master_stream_csv:
+            new_streams = find_new_streams(csv2json(master_streams_file) or [], state.known_streams(master_streams_file))
+            for url in build_async_query_from_stream_meta(uframe_base, new_streams, user=args.user):
+                sys.stdout.write('DEBUG> async query: {:s}\n'.format(url))
+        return 0
+
+    sys.stdout.write('Queue store: {:s} ({:d} queued, {:d} in flight)\n'.format(store.db_file,
+        len(state.requests(QUEUED)),
+        len(state.in_flight())))
+
+    stop = threading.Event()
+    def handle_signal(signum, frame):
+        sys.stdout.write('Stopping harvester (signal {:d})\n'.format(signum))
+        stop.set()
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    submit_kwargs = {'max_in_flight' : args.max_in_flight, 'poll_interval' : args.poll_interval}
+    if args.adaptive:
+        from tds.backpressure import AIMDController, InFlightTracker
+        submit_kwargs['controller'] = AIMDController(limit=args.initial_in_flight, maximum=args.max_in_flight)
+        submit_kwargs['tracker'] = InFlightTracker(UFRAME_NC_ROOT)
+
+    # Streams are exported under the same leases as the export workers
+    # draining the queue store
+    leases = LeaseDir(args.leases or os.path.join(os.path.dirname(QUEUE_STORE), 'leases'), ttl=args.lease_ttl)
+
+    # Set, with stop, if a stage dies
+    failed = threading.Event()
+
+    work_queue = queue.Queue(maxsize=args.queue_size)
+    stages = [threading.Thread(target=run_stage,
+            args=(prepare_stage, stop, failed, state, args.master_stream_csv, uframe_base, work_queue, stop),
+            kwargs={'user' : args.user, 'update' : args.update, 'interval' : args.prepare_interval}),
+        threading.Thread(target=run_stage,
+            args=(submit_stage, stop, failed, state, uframe_base, work_queue, stop),
+            kwargs=submit_kwargs),
+        threading.Thread(target=run_stage,
+            args=(export_stage, stop, failed, state, UFRAME_NC_ROOT, TDS_NC_ROOT, NCML_TEMPLATE, leases, stop),
+            kwargs={'delete' : args.delete,
+                'processes' : args.processes,
+                'poll_interval' : args.poll_interval,
+                'quarantine_dir' : args.quarantine or os.path.join(ASYNC_DATA_ROOT, 'quarantine')})]
+
+    for stage in stages:
+        stage.daemon = True
+        stage.start()
+
+    # Sleep in short intervals so that signals are handled promptly
+    while not stop.is_set():
+        stop.wait(1.0)
+
+    for stage in stages:
+        stage.join()
+
+    store.close()
+
+    return 1 if failed.is_set() else 0
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('master_stream_csv',
+        nargs='+',
+        help='Filenames containing stream request pieces.  Create these files using stream2ref_des_list.py')
+    arg_parser.add_argument('--user',
+        default='_nouser',
+        help='Alternate user name (_nouser is <default>)')
+    arg_parser.add_argument('--update',
+        action='store_true',
+        help='Check known streams for metadata updates')
+    arg_parser.add_argument('-b', '--baseurl',
+        dest='base_url',
+        help='Specify an alternate uFrame server URL, or a comma-separated list of uFrame replica URLs. Must start with \'http://\'.')
+    arg_parser.add_argument('-s', '--store',
+        help='Alternate queue store (ASYNC_DATA_HOME/stream-queue/queue.db is <default>)')
+    arg_parser.add_argument('-l', '--leases',
+        help='Alternate lease directory, shared with export_uframe_nc_to_tds-agg.py workers (stream-queue/leases next to the queue store is <default>)')
+    arg_parser.add_argument('--lease-ttl',
+        dest='lease_ttl',
+        type=float,
+        default=3600.0,
+        help='Seconds after which a lease that is no longer renewed may be broken (3600 is <default>)')
+    arg_parser.add_argument('--prepare-interval',
+        dest='prepare_interval',
+        type=float,
+        default=3600.0,
+        help='Seconds between checks of the master stream files for new streams (3600 is <default>)')
+    arg_parser.add_argument('--poll-interval',
+        dest='poll_interval',
+        type=float,
+        default=60.0,
+        help='Seconds between checks for completed requests (60 is <default>)')
+    arg_parser.add_argument('-n', '--max-in-flight',
+        dest='max_in_flight',
+        type=int,
+        default=20,
+        help='Maximum number of requests in flight (20 is <default>)')
+    arg_parser.add_argument('-a', '--adaptive',
+        action='store_true',
+        help='Adapt the number of requests in flight to the UFrame completion latency')
+    arg_parser.add_argument('--initial-in-flight',
+        dest='initial_in_flight',
+        type=int,
+        default=4,
+        help='Number of requests in flight to start from with --adaptive (4 is <default>)')
+    arg_parser.add_argument('-q', '--queue-size',
+        dest='queue_size',
+        type=int,
+        default=100,
+        help='Maximum number of requests waiting to be sent (100 is <default>)')
+    arg_parser.add_argument('-d', '--delete',
+        dest='delete',
+        action='store_true',
+        help='Delete the UFrame product destination once published')
+    arg_parser.add_argument('-p', '--processes',
+        type=int,
+        default=4,
+        help='Number of files to hash in parallel when publishing (4 is <default>)')
+    arg_parser.add_argument('--quarantine',
+        help='Directory to which invalid NetCDF files are moved (ASYNC_DATA_HOME/quarantine is <default>)')
+    arg_parser.add_argument('-x', '--debug',
+        dest='debug',
+        action='store_true',
+        help='Print the requests for new streams, but do not send them')
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))